@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Comment, Topic
+from .models import ArchivedTopic, Comment, Topic
 
 
 class TopicAdmin(admin.ModelAdmin):
@@ -14,5 +14,12 @@ class CommentAdmin(admin.ModelAdmin):
     search_fields = ["body"]
 
 
+class ArchivedTopicAdmin(admin.ModelAdmin):
+    list_display = ("title", "user", "closed_at", "archived_at", "comment_count")
+    search_fields = ["title"]
+    exclude = ["data"]
+
+
 admin.site.register(Topic, TopicAdmin)
 admin.site.register(Comment, CommentAdmin)
+admin.site.register(ArchivedTopic, ArchivedTopicAdmin)
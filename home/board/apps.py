@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BoardConfig(AppConfig):
     name = "home.board"
     verbose_name = "留言板"
+
+    def ready(self):
+        from . import signals  # noqa: F401
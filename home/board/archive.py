@@ -0,0 +1,176 @@
+"""话题归档
+
+关闭超过一定时间的话题会连同评论、历史版本与阅读进度一起序列化为 JSON，
+压缩后保存到 ArchivedTopic，并从原来的表中删除，让常用的表保持较小。
+恢复时使用原来的 ID 重新创建话题与评论。
+"""
+
+import base64
+from typing import Any
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+
+from .models import ArchivedTopic, Comment, CommentRevision, Topic, TopicReadState, TopicRevision
+from .utils import compress, decompress, update_rendered
+
+TOPIC_FIELDS = [
+    "title",
+    "description",
+    "is_closed",
+    "closed_at",
+    "user_id",
+    "created_at",
+    "edited_at",
+    "is_pinned",
+    "active_at",
+]
+COMMENT_FIELDS = [
+    "id",
+    "user_id",
+    "body",
+    "created_at",
+    "edited_at",
+    "parent_id",
+    "reply_to_id",
+    "tree_id",
+    "lft",
+    "rght",
+    "level",
+]
+REVISION_FIELDS = ["number", "is_snapshot", "data", "created_at"]
+READ_STATE_FIELDS = ["user_id", "last_read_comment_id", "read_at"]
+DATETIME_FIELDS = {"closed_at", "created_at", "edited_at", "active_at", "read_at"}
+
+
+def parse_datetimes(values: dict[str, Any]) -> dict[str, Any]:
+    """将 JSON 中的时间字符串转换回 datetime"""
+    return {key: parse_datetime(value) if key in DATETIME_FIELDS and value else value for key, value in values.items()}
+
+
+def dump_revisions(revisions) -> list[dict[str, Any]]:
+    """版本的压缩数据是二进制，使用 base64 保存到 JSON 中"""
+    return [{**values, "data": base64.b64encode(bytes(values["data"])).decode()} for values in revisions]
+
+
+def load_revision(values: dict[str, Any]) -> dict[str, Any]:
+    return {**parse_datetimes(values), "data": base64.b64decode(values["data"])}
+
+
+def existing_user_ids(data: dict[str, Any]) -> set[int]:
+    """归档中引用的用户里仍然存在的用户
+
+    话题与评论的作者不存在时无法恢复，回复的用户与阅读进度的用户不存在时忽略，
+    与删除用户时的处理（CASCADE、SET_NULL）一致
+    """
+    comments = data["comments"]
+    authors = {data["topic"]["user_id"], *(values["user_id"] for values in comments)}
+    user_ids = authors | {values["reply_to_id"] for values in comments if values["reply_to_id"]}
+    user_ids |= {values["user_id"] for values in data.get("read_states", [])}
+    existing = set(get_user_model().objects.filter(pk__in=user_ids).values_list("pk", flat=True))
+    if authors - existing:
+        raise ValidationError("话题或评论的作者已被删除，无法恢复")
+    return existing
+
+
+def lock_comments():
+    """锁定评论表直到事务结束，期间其他事务不能添加或者修改评论
+
+    避免分配树编号之后，其他事务同时添加的评论使用了相同的树编号。
+    仅支持 PostgreSQL，其他数据库直接跳过
+    """
+    if connection.vendor != "postgresql":
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {Comment._meta.db_table} IN SHARE ROW EXCLUSIVE MODE")
+
+
+def archive_topic(topic: Topic) -> ArchivedTopic:
+    """归档话题，并删除原话题与评论"""
+    comments = list(topic.comments.order_by("tree_id", "lft").values(*COMMENT_FIELDS))
+    data = {
+        "topic": {field: getattr(topic, field) for field in TOPIC_FIELDS},
+        "comments": comments,
+        "revisions": dump_revisions(topic.revisions.order_by("number").values(*REVISION_FIELDS)),  # type: ignore
+        "comment_revisions": dump_revisions(
+            CommentRevision.objects.filter(comment__topic=topic)
+            .order_by("comment_id", "number")
+            .values("comment_id", *REVISION_FIELDS)
+        ),
+        "read_states": list(topic.read_states.values(*READ_STATE_FIELDS)),  # type: ignore
+    }
+    with transaction.atomic():
+        archived = ArchivedTopic.objects.create(
+            topic_id=topic.pk,
+            title=topic.title,
+            user_id=topic.user_id,  # type: ignore
+            created_at=topic.created_at,
+            closed_at=topic.closed_at,
+            comment_count=len(comments),
+            data=compress(data),
+        )
+        topic.delete()
+    return archived
+
+
+def restore_topic(archived: ArchivedTopic) -> Topic:
+    """恢复归档的话题
+
+    恢复的话题会重新打开，不然下次归档时又会被归档。
+    评论的树编号可能已经被新的评论使用，所以按顺序分配新的树编号。
+    话题或评论的作者已被删除时抛出 ValidationError
+    """
+    data = decompress(archived.data)
+    with transaction.atomic():
+        user_ids = existing_user_ids(data)
+        values = parse_datetimes(data["topic"])
+        topic = Topic(id=archived.topic_id, **values)
+        topic.is_closed = False
+        topic.closed_at = None
+        topic.save()
+        # 保存时会自动设置发布时间，需要单独恢复
+        topic.created_at = values["created_at"]
+        Topic.objects.filter(pk=topic.pk).update(created_at=topic.created_at)
+
+        lock_comments()
+        max_tree_id = Comment.objects.aggregate(max_tree_id=Max("tree_id"))["max_tree_id"] or 0
+        tree_ids: dict[int, int] = {}
+        comments = []
+        for values in map(parse_datetimes, data["comments"]):
+            if values["reply_to_id"] not in user_ids:
+                values["reply_to_id"] = None
+            comment = Comment(topic=topic, **values)
+            comment.tree_id = tree_ids.setdefault(comment.tree_id, max_tree_id + len(tree_ids) + 1)  # type: ignore
+            update_rendered(comment, "body")
+            comments.append((comment, values))
+        # bulk_create 同样会自动设置发布与修改时间，之后再改回来
+        Comment.objects.bulk_create([comment for comment, _ in comments])
+        for comment, values in comments:
+            comment.created_at = values["created_at"]
+            comment.edited_at = values["edited_at"]
+        Comment.objects.bulk_update([comment for comment, _ in comments], ["created_at", "edited_at"])
+
+        # 之前的归档中没有历史版本与阅读进度
+        TopicRevision.objects.bulk_create(
+            TopicRevision(topic=topic, **load_revision(values)) for values in data.get("revisions", [])
+        )
+        CommentRevision.objects.bulk_create(
+            CommentRevision(**load_revision(values)) for values in data.get("comment_revisions", [])
+        )
+        read_states = [
+            (TopicReadState(topic=topic, **values), values)
+            for values in map(parse_datetimes, data.get("read_states", []))
+            if values["user_id"] in user_ids
+        ]
+        # 阅读时间同样会被自动设置
+        TopicReadState.objects.bulk_create([read_state for read_state, _ in read_states])
+        for read_state, values in read_states:
+            read_state.read_at = values["read_at"]
+        TopicReadState.objects.bulk_update([read_state for read_state, _ in read_states], ["read_at"])
+
+        topic.refresh_activity()
+        archived.delete()
+    return topic
@@ -0,0 +1,152 @@
+"""留言板首页缓存
+
+打开应用时都会查询话题列表，而列表只会在话题、评论、阅读状态或者其中显示的用户与头像变化时改变。
+只包含 topics 字段的查询结果按 用户 + 查询 + 变量 缓存，键中带有版本号，
+相关的模型保存或删除后更新版本号，之前的缓存自然失效，不需要逐个删除。
+
+版本号分为两级：话题与评论变化时更新全局版本号，所有用户的缓存失效；
+阅读状态只影响对应用户的未读数，只更新该用户的版本号。
+
+配置 Redis 等多个进程共享的缓存时（见 settings 中的 CACHES）使用该缓存，
+否则或者共享缓存出错时使用进程内的 LRU 缓存。各进程的版本号互不相通，
+所以进程内缓存的过期时间更短。默认缓存为 DummyCache 时不缓存。
+"""
+
+import hashlib
+import json
+import logging
+import time
+
+from django.core.cache import BaseCache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from graphql import ExecutionResult, FieldNode
+from graphql.utilities import get_operation_ast
+from strawberry.extensions import SchemaExtension
+from strawberry.types.graphql import OperationType
+
+from home.utils import aget_user, is_shared_cache
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "board:front_page:version"
+# 缓存的过期时间（秒），没有经过模型保存的修改（如 QuerySet.update）最多在这之后生效
+TIMEOUT = 300
+# 进程内缓存的过期时间（秒），其他进程中的修改最多在这之后生效
+LOCAL_TIMEOUT = 30
+# 进程内缓存的最大条目数，超过后移除最久没有使用的条目
+LOCAL_MAX_ENTRIES = 1000
+# 可以缓存的查询中允许出现的根字段
+CACHEABLE_FIELDS = {"topics", "__typename"}
+
+local_cache = LocMemCache("board-front-page", {"TIMEOUT": LOCAL_TIMEOUT, "OPTIONS": {"MAX_ENTRIES": LOCAL_MAX_ENTRIES}})
+
+
+def user_version_key(user_id: int) -> str:
+    return f"board:front_page:user:{user_id}:version"
+
+
+def get_cache() -> BaseCache:
+    """获取缓存首页使用的缓存"""
+    backend = caches["default"]
+    if isinstance(backend, DummyCache) or is_shared_cache(backend):
+        return backend
+    return local_cache
+
+
+def get_timeout(backend: BaseCache) -> int:
+    return LOCAL_TIMEOUT if backend is local_cache else TIMEOUT
+
+
+def bump_version(key: str = VERSION_KEY):
+    """更新版本号，让之前的缓存失效
+
+    共享缓存出错时可能改用了进程内缓存，所以进程内缓存的版本号也一起更新
+    """
+    version = time.time_ns()
+    backend = get_cache()
+    if backend is not local_cache:
+        try:
+            backend.set(key, version, None)
+        except Exception:
+            logger.warning("首页缓存版本号更新失败", exc_info=True)
+    local_cache.set(key, version, None)
+
+
+def invalidate(user_id: int | None = None):
+    """数据变化后调用，提供 user_id 时只让该用户的缓存失效
+
+    立即更新一次，让同一进程之后的查询不再命中旧缓存；
+    事务提交后再更新一次，避免提交前其他请求缓存了旧数据
+    """
+    key = VERSION_KEY if user_id is None else user_version_key(user_id)
+    bump_version(key)
+    transaction.on_commit(lambda: bump_version(key))
+
+
+def is_cacheable(execution_context) -> bool:
+    """是否是只查询话题列表的请求"""
+    document = execution_context.graphql_document
+    if document is None or execution_context.operation_type != OperationType.QUERY:
+        return False
+    operation = get_operation_ast(document, execution_context.operation_name)
+    if operation is None:
+        return False
+    names = set()
+    for selection in operation.selection_set.selections:
+        # 片段与指令都不处理，直接不缓存
+        if not isinstance(selection, FieldNode) or selection.directives:
+            return False
+        names.add(selection.name.value)
+    return "topics" in names and names <= CACHEABLE_FIELDS
+
+
+class FrontPageCache(SchemaExtension):
+    """缓存话题列表的查询结果
+
+    未读数等字段因人而异，所以缓存按用户区分，未登录或者已停用的用户不使用缓存
+    """
+
+    async def on_execute(self):
+        execution_context = self.execution_context
+        key = backend = None
+        if is_cacheable(execution_context):
+            user = await aget_user(execution_context.context)
+            # 与 topics 字段的权限检查一致，缓存命中时不会再经过权限检查
+            if user.is_authenticated and user.is_active:
+                backend = get_cache()
+                try:
+                    key = await self.get_key(backend, user.pk)
+                    data = await backend.aget(key)
+                except Exception:
+                    logger.warning("首页缓存读取失败，改用进程内缓存", exc_info=True)
+                    backend = local_cache
+                    key = await self.get_key(backend, user.pk)
+                    data = await backend.aget(key)
+                if data is not None:
+                    execution_context.result = ExecutionResult(data=data)
+                    key = None
+        yield
+        result = execution_context.result
+        if key and backend and isinstance(result, ExecutionResult) and not result.errors:
+            try:
+                await backend.aset(key, result.data, get_timeout(backend))
+            except Exception:
+                logger.warning("首页缓存保存失败", exc_info=True)
+
+    async def get_key(self, backend: BaseCache, user_id: int) -> str:
+        keys = [VERSION_KEY, user_version_key(user_id)]
+        versions = await backend.aget_many(keys)
+        for key in keys:
+            if key not in versions:
+                versions[key] = time.time_ns()
+                await backend.aset(key, versions[key], None)
+        execution_context = self.execution_context
+        digest = hashlib.sha256(
+            json.dumps(
+                [execution_context.query, execution_context.variables, execution_context.operation_name],
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+        return f"board:front_page:{versions[VERSION_KEY]}:{versions[keys[1]]}:{user_id}:{digest}"
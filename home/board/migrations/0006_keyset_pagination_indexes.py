@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("board", "0005_rename_topic_is_pinned_is_closed"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(fields=["topic", "created_at", "id"], name="board_comment_topic_created_id"),
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(fields=["tree_id", "lft"], name="board_comment_tree_id_lft_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="topic",
+            index=models.Index(fields=["created_at", "id"], name="board_topic_created_at_id"),
+        ),
+        migrations.AddIndex(
+            model_name="topic",
+            index=models.Index(fields=["edited_at", "id"], name="board_topic_edited_at_id"),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+
+
+def backfill_topic_activity(apps, schema_editor):
+    """根据现有的评论计算活跃时间、评论数与最新评论"""
+    Topic = apps.get_model("board", "Topic")
+    Comment = apps.get_model("board", "Comment")
+
+    latest = Comment.objects.filter(topic=OuterRef("pk")).order_by("-created_at", "-id")
+    topics = Topic.objects.annotate(
+        _comment_count=Count("comments"),
+        _last_created_at=Max("comments__created_at"),
+        _last_comment_id=Subquery(latest.values("id")[:1]),
+    )
+    for topic in topics:
+        topic.comment_count = topic._comment_count
+        topic.last_comment_id = topic._last_comment_id
+        topic.active_at = max(filter(None, [topic.edited_at, topic._last_created_at]))
+    Topic.objects.bulk_update(topics, ["comment_count", "last_comment", "active_at"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("board", "0006_keyset_pagination_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="topic",
+            name="active_at",
+            field=models.DateTimeField(editable=False, null=True, verbose_name="活跃时间"),
+        ),
+        migrations.AddField(
+            model_name="topic",
+            name="comment_count",
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name="评论数"),
+        ),
+        migrations.AddField(
+            model_name="topic",
+            name="last_comment",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="board.comment",
+                verbose_name="最新评论",
+            ),
+        ),
+        migrations.RunPython(backfill_topic_activity, reverse_code=migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="topic",
+            name="active_at",
+            field=models.DateTimeField(editable=False, verbose_name="活跃时间"),
+        ),
+        migrations.AddIndex(
+            model_name="topic",
+            index=models.Index(fields=["-is_pinned", "is_closed", "-active_at", "id"], name="board_topic_front_page"),
+        ),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:05
+
+import hashlib
+import html
+import re
+from io import StringIO
+from urllib.parse import urlsplit
+
+from django.db import migrations, models
+from markdown import Markdown, util
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+
+# 以下为迁移时 home.board.utils 中渲染逻辑的副本，之后修改渲染方式不影响这个迁移
+
+SAFE_URL_SCHEMES = {"http", "https", "mailto"}
+IGNORED_URL_CHARS = re.compile(r"[\x00-\x20\x7f]")
+
+
+def is_safe_url(url):
+    url = html.unescape(url.replace(util.AMP_SUBSTITUTE, "&"))
+    scheme = urlsplit(IGNORED_URL_CHARS.sub("", url)).scheme
+    return not scheme or scheme.lower() in SAFE_URL_SCHEMES
+
+
+class SafeUrlProcessor(Treeprocessor):
+    def run(self, root):
+        for element in root.iter():
+            for attr in ("href", "src"):
+                url = element.get(attr)
+                if url is not None and not is_safe_url(url):
+                    del element.attrib[attr]
+
+
+class EscapeHtmlExtension(Extension):
+    def extendMarkdown(self, md):
+        md.preprocessors.deregister("html_block")
+        md.inlinePatterns.deregister("html")
+        md.treeprocessors.register(SafeUrlProcessor(md), "safe_url", 0)
+
+
+def unmark_element(element, stream=None):
+    if stream is None:
+        stream = StringIO()
+    if element.text:
+        stream.write(element.text)
+    for sub in element:
+        unmark_element(sub, stream)
+    if element.tail:
+        stream.write(element.tail)
+    return stream.getvalue()
+
+
+def render_existing(apps, schema_editor):
+    """渲染现有的话题与评论"""
+    to_html = Markdown(output_format="html", extensions=[EscapeHtmlExtension()])
+    to_plain = Markdown(output_format="html", extensions=[EscapeHtmlExtension()])
+    # 只影响这个实例，不修改全局的 Markdown.output_formats
+    to_plain.serializer = unmark_element
+    to_plain.stripTopLevelTags = False
+    for model_name, field in [("Topic", "description"), ("Comment", "body")]:
+        model = apps.get_model("board", model_name)
+        objs = list(model.objects.all())
+        for obj in objs:
+            text = getattr(obj, field) or ""
+            setattr(obj, f"{field}_hash", hashlib.sha256(text.encode()).hexdigest())
+            setattr(obj, f"{field}_html", to_html.reset().convert(text))
+            setattr(obj, f"{field}_plain", to_plain.reset().convert(text))
+        model.objects.bulk_update(objs, [f"{field}_hash", f"{field}_html", f"{field}_plain"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("board", "0007_topic_activity"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="body_hash",
+            field=models.CharField(blank=True, editable=False, max_length=64, verbose_name="内容摘要"),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="body_html",
+            field=models.TextField(blank=True, editable=False, verbose_name="内容 HTML"),
+        ),
+        migrations.AddField(
+            model_name="comment",
+            name="body_plain",
+            field=models.TextField(blank=True, editable=False, verbose_name="内容纯文本"),
+        ),
+        migrations.AddField(
+            model_name="topic",
+            name="description_hash",
+            field=models.CharField(blank=True, editable=False, max_length=64, verbose_name="说明摘要"),
+        ),
+        migrations.AddField(
+            model_name="topic",
+            name="description_html",
+            field=models.TextField(blank=True, editable=False, verbose_name="说明 HTML"),
+        ),
+        migrations.AddField(
+            model_name="topic",
+            name="description_plain",
+            field=models.TextField(blank=True, editable=False, verbose_name="说明纯文本"),
+        ),
+        migrations.RunPython(render_existing, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:11
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+# 表名，触发器维护的搜索向量表达式（NEW 为新行）
+SEARCH_VECTORS = [
+    (
+        "board_topic",
+        "setweight(to_tsvector('simple', coalesce(NEW.title, '')), 'A')"
+        " || setweight(to_tsvector('simple', coalesce(NEW.description_plain, '')), 'B')",
+    ),
+    ("board_comment", "setweight(to_tsvector('simple', coalesce(NEW.body_plain, '')), 'B')"),
+]
+
+# 表名，字段名，索引名
+TRIGRAM_INDEXES = [
+    ("board_topic", "title", "board_topic_title_trgm"),
+    ("board_topic", "description_plain", "board_topic_description_trgm"),
+    ("board_comment", "body_plain", "board_comment_body_trgm"),
+]
+
+
+def create_search(apps, schema_editor):
+    """创建维护搜索向量的触发器、全文搜索与 pg_trgm 的 GIN 索引
+
+    仅支持 PostgreSQL，其他数据库直接跳过
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for table, vector in SEARCH_VECTORS:
+        schema_editor.execute(
+            f"""
+            CREATE OR REPLACE FUNCTION {table}_search_vector_update() RETURNS trigger AS $$
+            BEGIN
+                NEW.search_vector := {vector};
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+            """
+        )
+        schema_editor.execute(
+            f"CREATE TRIGGER {table}_search_vector BEFORE INSERT OR UPDATE ON {table} "
+            f"FOR EACH ROW EXECUTE FUNCTION {table}_search_vector_update()"
+        )
+        # 触发器会重新计算现有行的搜索向量
+        schema_editor.execute(f"UPDATE {table} SET search_vector = NULL")
+        schema_editor.execute(f"CREATE INDEX IF NOT EXISTS {table}_search_vector ON {table} USING gin (search_vector)")
+    for table, column, name in TRIGRAM_INDEXES:
+        schema_editor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)")
+
+
+def drop_search(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for table, _ in SEARCH_VECTORS:
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {table}_search_vector ON {table}")
+        schema_editor.execute(f"DROP FUNCTION IF EXISTS {table}_search_vector_update()")
+        schema_editor.execute(f"DROP INDEX IF EXISTS {table}_search_vector")
+    for _, _, name in TRIGRAM_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("board", "0008_markdown_render_cache"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="comment",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name="搜索向量"),
+        ),
+        migrations.AddField(
+            model_name="topic",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name="搜索向量"),
+        ),
+        migrations.RunPython(create_search, reverse_code=drop_search),
+    ]
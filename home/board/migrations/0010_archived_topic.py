@@ -0,0 +1,42 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("board", "0009_board_search"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedTopic",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("topic_id", models.PositiveIntegerField(unique=True, verbose_name="原话题 ID")),
+                ("title", models.CharField(max_length=200, verbose_name="标题")),
+                ("created_at", models.DateTimeField(verbose_name="发布时间")),
+                ("closed_at", models.DateTimeField(blank=True, null=True, verbose_name="关闭时间")),
+                ("archived_at", models.DateTimeField(auto_now_add=True, verbose_name="归档时间")),
+                ("comment_count", models.PositiveIntegerField(default=0, verbose_name="评论数")),
+                ("data", models.BinaryField(verbose_name="压缩数据")),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="archived_topics",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="创建者",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "归档话题",
+                "verbose_name_plural": "归档话题",
+                "ordering": ["-archived_at", "-id"],
+            },
+        ),
+    ]
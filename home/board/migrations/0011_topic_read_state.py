@@ -0,0 +1,55 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("board", "0010_archived_topic"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TopicReadState",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("last_read_comment_id", models.PositiveIntegerField(default=0, verbose_name="最后阅读的评论 ID")),
+                ("read_at", models.DateTimeField(auto_now=True, verbose_name="阅读时间")),
+            ],
+            options={
+                "verbose_name": "阅读进度",
+                "verbose_name_plural": "阅读进度",
+            },
+        ),
+        migrations.AddIndex(
+            model_name="comment",
+            index=models.Index(fields=["topic", "id"], name="board_comment_topic_id"),
+        ),
+        migrations.AddField(
+            model_name="topicreadstate",
+            name="topic",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="read_states",
+                to="board.topic",
+                verbose_name="话题",
+            ),
+        ),
+        migrations.AddField(
+            model_name="topicreadstate",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="topic_read_states",
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="用户",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="topicreadstate",
+            constraint=models.UniqueConstraint(fields=("user", "topic"), name="board_topicreadstate_user_topic"),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("board", "0011_topic_read_state"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CommentRevision",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("number", models.PositiveIntegerField(verbose_name="版本号")),
+                ("is_snapshot", models.BooleanField(default=False, verbose_name="完整内容")),
+                ("data", models.BinaryField(verbose_name="压缩数据")),
+                ("created_at", models.DateTimeField(verbose_name="发布时间")),
+                (
+                    "comment",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="revisions",
+                        to="board.comment",
+                        verbose_name="评论",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "评论历史版本",
+                "verbose_name_plural": "评论历史版本",
+                "ordering": ["-number"],
+                "abstract": False,
+                "constraints": [
+                    models.UniqueConstraint(fields=("comment", "number"), name="board_commentrevision_comment_number")
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="TopicRevision",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("number", models.PositiveIntegerField(verbose_name="版本号")),
+                ("is_snapshot", models.BooleanField(default=False, verbose_name="完整内容")),
+                ("data", models.BinaryField(verbose_name="压缩数据")),
+                ("created_at", models.DateTimeField(verbose_name="发布时间")),
+                (
+                    "topic",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="revisions",
+                        to="board.topic",
+                        verbose_name="话题",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "话题历史版本",
+                "verbose_name_plural": "话题历史版本",
+                "ordering": ["-number"],
+                "abstract": False,
+                "constraints": [
+                    models.UniqueConstraint(fields=("topic", "number"), name="board_topicrevision_topic_number")
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.8 on 2026-10-18 04:22
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("board", "0012_revisions"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="topic",
+            name="board_topic_front_page",
+        ),
+        migrations.AddIndex(
+            model_name="topic",
+            index=models.Index(fields=["-is_pinned", "-active_at", "id"], name="board_topic_front_page"),
+        ),
+    ]
@@ -0,0 +1,23 @@
+import html
+
+from django.db import migrations
+
+
+def unescape_plain(apps, schema_editor):
+    """之前保存的纯文本中代码等内容是转义后的，还原为原来的字符"""
+    for model_name, field in [("Topic", "description_plain"), ("Comment", "body_plain")]:
+        model = apps.get_model("board", model_name)
+        objs = list(model.objects.filter(**{f"{field}__contains": "&"}).only("pk", field))
+        for obj in objs:
+            setattr(obj, field, html.unescape(getattr(obj, field)))
+        model.objects.bulk_update(objs, [field], batch_size=500)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("board", "0013_topic_front_page_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(unescape_plain, reverse_code=migrations.RunPython.noop),
+    ]
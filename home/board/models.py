@@ -1,14 +1,54 @@
 from django.conf import settings
-from django.db import models
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.db.models import Count, Exists, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils.functional import cached_property
 from mptt.models import MPTTModel, TreeForeignKey
 
+from .utils import apply_delta, compress, decompress, make_delta, update_rendered
+
+
+def save_rendered(instance, field: str, kwargs: dict) -> bool:
+    """保存前更新渲染缓存，指定了 update_fields 时一并保存渲染结果
+
+    返回内容是否变化
+    """
+    update_fields = kwargs.get("update_fields")
+    if update_fields is not None and field not in update_fields:
+        return False
+    changed = update_rendered(instance, field)
+    if changed and update_fields is not None:
+        kwargs["update_fields"] = {*update_fields, f"{field}_hash", f"{field}_html", f"{field}_plain"}
+    return changed
+
+
+def previous_version(instance, field: str) -> dict | None:
+    """数据库中修改前的内容与修改时间，新建的对象返回 None
+
+    需要在事务中调用，先锁定该行再读取，直到保存完成前其他修改都需要等待，
+    同时修改时后保存的一方读到的是先保存的内容
+    """
+    if instance._state.adding:
+        return None
+    return type(instance)._base_manager.select_for_update().filter(pk=instance.pk).values(field, "edited_at").first()
+
 
 class Topic(models.Model):
     """话题"""
 
+    # 由评论信号通过 update 维护的字段，修改话题时不保存，避免覆盖同时发布的评论带来的修改
+    ACTIVITY_FIELDS = frozenset({"comment_count", "last_comment", "active_at"})
+
     id = models.AutoField("ID", primary_key=True, auto_created=True)
     title = models.CharField("标题", max_length=200)
     description = models.TextField("说明")
+    # 渲染后的说明，内容摘要变化时重新渲染
+    description_hash = models.CharField("说明摘要", max_length=64, blank=True, editable=False)
+    description_html = models.TextField("说明 HTML", blank=True, editable=False)
+    description_plain = models.TextField("说明纯文本", blank=True, editable=False)
+    # 由 PostgreSQL 触发器根据标题与说明的纯文本维护，见 search.py
+    search_vector = SearchVectorField("搜索向量", null=True, editable=False)
     is_closed = models.BooleanField("已关闭", default=False)
     closed_at = models.DateTimeField("关闭时间", null=True, blank=True)
     user = models.ForeignKey(
@@ -20,14 +60,102 @@ class Topic(models.Model):
     created_at = models.DateTimeField("发布时间", auto_now_add=True)
     edited_at = models.DateTimeField("修改时间")
     is_pinned = models.BooleanField("置顶", default=False)
+    # 以下字段根据评论自动维护，见 signals.py
+    active_at = models.DateTimeField("活跃时间", editable=False)
+    """ 修改时间与最新评论发布时间中较晚的那个 """
+    comment_count = models.PositiveIntegerField("评论数", default=0, editable=False)
+    last_comment = models.ForeignKey(
+        "Comment",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name="+",
+        verbose_name="最新评论",
+    )
 
     class Meta:
         verbose_name = "话题"
         verbose_name_plural = "话题"
+        indexes = [
+            # 游标分页时按 (排序字段, id) 定位
+            models.Index(fields=["created_at", "id"], name="board_topic_created_at_id"),
+            models.Index(fields=["edited_at", "id"], name="board_topic_edited_at_id"),
+            # 首页按 置顶、活跃时间 排序，与查询的排序一致才能直接按索引顺序读取
+            models.Index(fields=["-is_pinned", "-active_at", "id"], name="board_topic_front_page"),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # 话题被修改时也算作活跃
+        active_at = self.edited_at if self.active_at is None else max(self.active_at, self.edited_at)
+        self.active_at = active_at
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            update_fields = {field.name for field in self._meta.concrete_fields if not field.primary_key}
+            update_fields -= self.ACTIVITY_FIELDS
+            if active_at == self.edited_at:
+                # 只会让活跃时间变晚，不会覆盖同时发布的更晚的评论
+                self.active_at = Greatest("active_at", Value(self.edited_at))
+                update_fields.add("active_at")
+            kwargs["update_fields"] = update_fields
+        try:
+            if not save_rendered(self, "description", kwargs) or self._state.adding:
+                super().save(*args, **kwargs)
+                return
+            # 内容被修改时保存之前的版本
+            with transaction.atomic():
+                old = previous_version(self, "description")
+                super().save(*args, **kwargs)
+                if old is not None:
+                    TopicRevision.record(self, old["description"], old["edited_at"])
+        finally:
+            self.active_at = active_at
+
+    def refresh_activity(self):
+        """根据现有的评论重新计算活跃时间、评论数与最新评论
+
+        只更新这三个字段，不会覆盖其他字段的修改
+        """
+        stats = self.comments.aggregate(count=Count("id"), last_created_at=Max("created_at"))
+        last_comment_id = self.comments.order_by("-created_at", "-id").values_list("id", flat=True).first()
+        self.comment_count = stats["count"]
+        self.last_comment_id = last_comment_id
+        self.active_at = max(filter(None, [self.edited_at, stats["last_created_at"]]))
+        Topic.objects.filter(pk=self.pk).update(
+            comment_count=self.comment_count,
+            last_comment_id=self.last_comment_id,
+            active_at=self.active_at,
+        )
+
+    def comment_tree(self) -> list["Comment"]:
+        """一次查询获取所有评论，并组装成树
+
+        按 (tree_id, lft) 排序即为先序遍历，用栈即可还原父子关系。
+        返回根评论列表，子评论缓存在 get_children() 中，不会再次查询数据库
+        """
+        comments = (
+            self.comments.select_related("user", "user__avatar", "reply_to", "reply_to__avatar")
+            .order_by("tree_id", "lft")
+            .all()
+        )
+        roots: list[Comment] = []
+        stack: list[Comment] = []
+        for comment in comments:
+            comment.topic = self
+            comment._cached_children = []  # type: ignore
+            # 弹出不包含当前评论的祖先
+            while stack and not (stack[-1].tree_id == comment.tree_id and stack[-1].rght > comment.lft):  # type: ignore
+                stack.pop()
+            if stack:
+                comment.parent = stack[-1]
+                stack[-1]._cached_children.append(comment)  # type: ignore
+            else:
+                roots.append(comment)
+            stack.append(comment)
+        return roots
+
 
 class Comment(MPTTModel):
     """评论"""
@@ -41,6 +169,12 @@ class Comment(MPTTModel):
         verbose_name="评论者",
     )
     body = models.TextField("内容")
+    # 渲染后的内容，内容摘要变化时重新渲染
+    body_hash = models.CharField("内容摘要", max_length=64, blank=True, editable=False)
+    body_html = models.TextField("内容 HTML", blank=True, editable=False)
+    body_plain = models.TextField("内容纯文本", blank=True, editable=False)
+    # 由 PostgreSQL 触发器根据内容的纯文本维护，见 search.py
+    search_vector = SearchVectorField("搜索向量", null=True, editable=False)
     created_at = models.DateTimeField("发布时间", auto_now_add=True)
     edited_at = models.DateTimeField("修改时间", auto_now=True)
     parent = TreeForeignKey(
@@ -63,6 +197,240 @@ class Comment(MPTTModel):
     class Meta:  # type: ignore
         verbose_name = "评论"
         verbose_name_plural = "评论"
+        indexes = [
+            models.Index(fields=["topic", "created_at", "id"], name="board_comment_topic_created_id"),
+            # 按 ID 统计未读评论
+            models.Index(fields=["topic", "id"], name="board_comment_topic_id"),
+        ]
 
     def __str__(self):
         return self.body[:20]
+
+    def save(self, *args, **kwargs):
+        if not save_rendered(self, "body", kwargs) or self._state.adding:
+            super().save(*args, **kwargs)
+            return
+        with transaction.atomic():
+            old = previous_version(self, "body")
+            super().save(*args, **kwargs)
+            if old is not None:
+                CommentRevision.record(self, old["body"], old["edited_at"])
+
+
+class ArchivedTopic(models.Model):
+    """归档的话题
+
+    话题与评论序列化为 JSON 后压缩保存，见 archive.py
+    """
+
+    id = models.AutoField("ID", primary_key=True, auto_created=True)
+    # 恢复时使用原来的 ID，之前的链接仍然有效
+    topic_id = models.PositiveIntegerField("原话题 ID", unique=True)
+    title = models.CharField("标题", max_length=200)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="archived_topics",
+        verbose_name="创建者",
+    )
+    created_at = models.DateTimeField("发布时间")
+    closed_at = models.DateTimeField("关闭时间", null=True, blank=True)
+    archived_at = models.DateTimeField("归档时间", auto_now_add=True)
+    comment_count = models.PositiveIntegerField("评论数", default=0)
+    data = models.BinaryField("压缩数据")
+
+    class Meta:
+        verbose_name = "归档话题"
+        verbose_name_plural = "归档话题"
+        ordering = ["-archived_at", "-id"]
+
+    def __str__(self):
+        return self.title
+
+    @cached_property
+    def content(self) -> dict:
+        """解压后的话题与评论"""
+        return decompress(self.data)
+
+
+class RevisionQuerySet(models.QuerySet):
+    def _fetch_all(self):
+        super()._fetch_all()
+        # 同一次查询得到的版本共享一个列表，读取内容时一起获取差异链
+        revisions = [obj for obj in self._result_cache if isinstance(obj, Revision)]  # type: ignore
+        for revision in revisions:
+            revision._batch = revisions
+
+
+class Revision(models.Model):
+    """修改前的版本
+
+    每隔 SNAPSHOT_INTERVAL 个版本保存一次完整内容，其余版本只保存与上一个版本的差异，
+    读取时从最近的完整内容开始依次应用差异。
+    """
+
+    # 每隔多少个版本保存一次完整内容
+    SNAPSHOT_INTERVAL = 10
+    # 所属话题或评论的外键名
+    parent_field: str
+
+    id = models.AutoField("ID", primary_key=True, auto_created=True)
+    number = models.PositiveIntegerField("版本号")
+    is_snapshot = models.BooleanField("完整内容", default=False)
+    data = models.BinaryField("压缩数据")
+    created_at = models.DateTimeField("发布时间")
+
+    objects = RevisionQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+        ordering = ["-number"]
+
+    def __str__(self):
+        return f"版本 {self.number}"
+
+    @classmethod
+    def record(cls, parent: models.Model, text: str, created_at):
+        """添加新的版本
+
+        parent 为所属的话题或评论，需要在事务中调用。
+        先锁定所属的行，避免同时修改时得到相同的版本号
+        """
+        type(parent)._base_manager.select_for_update().filter(pk=parent.pk).values_list("pk").get()
+        revisions = cls._default_manager.filter(**{cls.parent_field: parent})
+        last = revisions.order_by("-number").first()
+        number = last.number + 1 if last else 1
+        data, is_snapshot = compress(text), True
+        if last and (number - 1) % cls.SNAPSHOT_INTERVAL:
+            delta = compress(make_delta(last.text, text))
+            # 差异不一定比完整内容小，比如全部重写时
+            if len(delta) < len(data):
+                data, is_snapshot = delta, False
+        return cls._default_manager.create(
+            **{cls.parent_field: parent}, number=number, is_snapshot=is_snapshot, data=data, created_at=created_at
+        )
+
+    @property
+    def parent_id(self) -> int:
+        return getattr(self, f"{self.parent_field}_id")
+
+    def get_siblings(self) -> models.QuerySet:
+        """同一话题或评论的所有版本"""
+        return type(self)._default_manager.filter(**{self.parent_field: self.parent_id})
+
+    @classmethod
+    def load_texts(cls, revisions: list["Revision"]):
+        """一次查询获取这些版本需要的差异链，并计算它们的内容"""
+        ranges: dict[int, tuple[int, int]] = {}
+        for revision in revisions:
+            if revision.is_snapshot:
+                continue
+            # 完整内容最多在 SNAPSHOT_INTERVAL 个版本之前
+            base = revision.number - (revision.number - 1) % cls.SNAPSHOT_INTERVAL
+            low, high = ranges.get(revision.parent_id, (base, revision.number))
+            ranges[revision.parent_id] = (min(low, base), max(high, revision.number))
+        rows = {(revision.parent_id, revision.number): revision for revision in revisions}
+        if ranges:
+            condition = models.Q()
+            for parent_id, (low, high) in ranges.items():
+                condition |= models.Q(**{cls.parent_field: parent_id, "number__gte": low, "number__lt": high})
+            for row in cls._default_manager.filter(condition).only(
+                f"{cls.parent_field}_id", "number", "is_snapshot", "data"
+            ):
+                rows.setdefault((row.parent_id, row.number), row)
+
+        texts: dict[tuple[int, int], str] = {}
+
+        def get_text(key: tuple[int, int]) -> str:
+            if key not in texts:
+                row = rows[key]
+                if row.is_snapshot:
+                    texts[key] = decompress(row.data)
+                else:
+                    texts[key] = apply_delta(get_text((key[0], key[1] - 1)), decompress(row.data))
+            return texts[key]
+
+        for revision in revisions:
+            revision.__dict__["text"] = get_text((revision.parent_id, revision.number))
+
+    @cached_property
+    def text(self) -> str:
+        type(self).load_texts(getattr(self, "_batch", [self]))
+        return self.__dict__["text"]
+
+
+class TopicRevision(Revision):
+    parent_field = "topic"
+
+    topic = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name="revisions", verbose_name="话题")
+
+    class Meta(Revision.Meta):
+        verbose_name = "话题历史版本"
+        verbose_name_plural = "话题历史版本"
+        constraints = [
+            models.UniqueConstraint(fields=["topic", "number"], name="board_topicrevision_topic_number"),
+        ]
+
+
+class CommentRevision(Revision):
+    parent_field = "comment"
+
+    comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name="revisions", verbose_name="评论")
+
+    class Meta(Revision.Meta):
+        verbose_name = "评论历史版本"
+        verbose_name_plural = "评论历史版本"
+        constraints = [
+            models.UniqueConstraint(fields=["comment", "number"], name="board_commentrevision_comment_number"),
+        ]
+
+
+class TopicReadState(models.Model):
+    """用户阅读话题的进度
+
+    评论 ID 是递增的，ID 大于 last_read_comment_id 的评论即为未读
+    """
+
+    id = models.AutoField("ID", primary_key=True, auto_created=True)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="topic_read_states",
+        verbose_name="用户",
+    )
+    topic = models.ForeignKey(Topic, on_delete=models.CASCADE, related_name="read_states", verbose_name="话题")
+    last_read_comment_id = models.PositiveIntegerField("最后阅读的评论 ID", default=0)
+    read_at = models.DateTimeField("阅读时间", auto_now=True)
+
+    class Meta:
+        verbose_name = "阅读进度"
+        verbose_name_plural = "阅读进度"
+        constraints = [
+            models.UniqueConstraint(fields=["user", "topic"], name="board_topicreadstate_user_topic"),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.topic}"
+
+
+def unread_comments(user) -> models.QuerySet[Comment]:
+    """外层话题中用户未读的评论，需要在话题的查询中使用
+
+    自己发布的评论不算未读
+    """
+    last_read = TopicReadState.objects.filter(topic=OuterRef(OuterRef("pk")), user=user).values("last_read_comment_id")[
+        :1
+    ]
+    return Comment.objects.filter(topic=OuterRef("pk"), id__gt=Coalesce(Subquery(last_read), Value(0))).exclude(
+        user=user
+    )
+
+
+def unread_count(user) -> Coalesce:
+    """话题中未读评论的数量，作为话题查询的注解"""
+    counts = unread_comments(user).order_by().values("topic").annotate(count=Count("id")).values("count")
+    return Coalesce(Subquery(counts), Value(0))
+
+
+def has_unread(user) -> Exists:
+    return Exists(unread_comments(user))
@@ -1,28 +1,104 @@
+from collections.abc import AsyncGenerator
+
 import strawberry
 import strawberry_django
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Max
 from django.utils import timezone
 from strawberry import relay
 from strawberry.types import Info
 
-from home.push.tasks import get_enable_reg_ids_except_user, push_to_users
-from home.utils import IsAuthenticated
+from home.utils import IsAuthenticated, channel_group_send
+
+from . import archive, models, search, tasks, types
+
+# 搜索最多返回的结果数
+MAX_SEARCH_RESULTS = 100
+
+# 通道层的组名
+TOPICS_GROUP = "board.topics"
+
+
+def comments_group(topic_id: int | str) -> str:
+    return f"board.topic.{topic_id}.comments"
 
-from . import models, types
-from .utils import unmark
+
+def publish_topic_updated(topic: models.Topic) -> None:
+    channel_group_send(TOPICS_GROUP, {"type": "topic.updated", "id": topic.pk})
+
+
+def publish_comment_added(comment: models.Comment) -> None:
+    channel_group_send(comments_group(comment.topic_id), {"type": "comment.added", "id": comment.pk})  # type: ignore
+    # 评论数与活跃时间也随之变化
+    publish_topic_updated(comment.topic)
 
 
 @strawberry.type
 class Query:
     topic: types.Topic = strawberry_django.node(permission_classes=[IsAuthenticated])
-    topics: strawberry_django.relay.DjangoListConnection[types.Topic] = strawberry_django.connection(
+    topics: strawberry_django.relay.DjangoCursorConnection[types.Topic] = strawberry_django.connection(
         permission_classes=[IsAuthenticated]
     )
     comment: types.Comment = strawberry_django.node(permission_classes=[IsAuthenticated])
-    comments: strawberry_django.relay.DjangoListConnection[types.Comment] = strawberry_django.connection(
+    comments: strawberry_django.relay.DjangoCursorConnection[types.Comment] = strawberry_django.connection(
+        permission_classes=[IsAuthenticated]
+    )
+
+    archived_topic: types.ArchivedTopic = strawberry_django.node(permission_classes=[IsAuthenticated])
+    archived_topics: strawberry_django.relay.DjangoCursorConnection[types.ArchivedTopic] = strawberry_django.connection(
         permission_classes=[IsAuthenticated]
     )
 
+    @strawberry_django.field(permission_classes=[IsAuthenticated])
+    def comment_tree(self, info: Info, topic_id: relay.GlobalID) -> list[types.CommentTreeNode]:
+        """话题下的所有评论，按回复关系组装成树"""
+        try:
+            topic = topic_id.resolve_node_sync(info, ensure_type=models.Topic)
+        except Exception:
+            raise ValidationError("话题不存在")
+
+        return [types.CommentTreeNode(comment=comment) for comment in topic.comment_tree()]  # type: ignore
+
+    @strawberry_django.field(permission_classes=[IsAuthenticated])
+    def search_board(self, info: Info, query: str, first: int = 20) -> list[types.BoardSearchResult]:
+        """搜索话题与评论，按相关度排序"""
+        if not 0 < first <= MAX_SEARCH_RESULTS:
+            raise ValidationError(f"first 需要在 1 到 {MAX_SEARCH_RESULTS} 之间")
+
+        return [
+            types.BoardSearchResult(
+                topic=result.topic,  # type: ignore
+                comment=result.comment,  # type: ignore
+                rank=result.rank,
+                snippet=result.snippet,
+            )
+            for result in search.search_board(query, first)
+        ]
+
+
+@strawberry.type
+class Subscription:
+    @strawberry.subscription(permission_classes=[IsAuthenticated])
+    async def topic_updated(self, info: Info) -> AsyncGenerator[types.Topic]:
+        """话题被添加、修改或者有新评论"""
+        ws = info.context["ws"]
+        async with ws.listen_to_channel("topic.updated", groups=[TOPICS_GROUP]) as messages:
+            async for message in messages:
+                topic = await models.Topic.objects.filter(pk=message["id"]).afirst()
+                if topic is not None:
+                    yield topic  # type: ignore
+
+    @strawberry.subscription(permission_classes=[IsAuthenticated])
+    async def comment_added(self, info: Info, topic_id: relay.GlobalID) -> AsyncGenerator[types.Comment]:
+        """话题下有新评论"""
+        ws = info.context["ws"]
+        async with ws.listen_to_channel("comment.added", groups=[comments_group(topic_id.node_id)]) as messages:
+            async for message in messages:
+                comment = await models.Comment.objects.filter(pk=message["id"]).afirst()
+                if comment is not None:
+                    yield comment  # type: ignore
+
 
 @strawberry.type
 class Mutation:
@@ -41,16 +117,9 @@ class Mutation:
 
         topic.edited_at = timezone.now()
         topic.save()
+        publish_topic_updated(topic)
 
-        reg_ids = get_enable_reg_ids_except_user(topic.user)
-        if reg_ids:
-            push_to_users.delay(
-                reg_ids,
-                f"{topic.user.username} 发布新话题",
-                f"{topic.title}\n{unmark(topic.description)}",
-                f"/topic/{relay.to_base64(types.Topic, topic.id)}",
-                True,
-            )  # type: ignore
+        transaction.on_commit(lambda: tasks.notify_new_topic.delay(topic.pk))  # type: ignore
 
         return topic  # type: ignore
 
@@ -81,6 +150,7 @@ class Mutation:
 
         topic.edited_at = timezone.now()
         topic.save()
+        publish_topic_updated(topic)
 
         return topic  # type: ignore
 
@@ -111,6 +181,7 @@ class Mutation:
         topic.is_closed = True
         topic.closed_at = timezone.now()
         topic.save()
+        publish_topic_updated(topic)
 
         return topic  # type: ignore
 
@@ -124,6 +195,7 @@ class Mutation:
         topic.is_closed = False
         topic.closed_at = None
         topic.save()
+        publish_topic_updated(topic)
 
         return topic  # type: ignore
 
@@ -136,6 +208,7 @@ class Mutation:
 
         topic.is_pinned = True
         topic.save()
+        publish_topic_updated(topic)
 
         return topic  # type: ignore
 
@@ -148,6 +221,56 @@ class Mutation:
 
         topic.is_pinned = False
         topic.save()
+        publish_topic_updated(topic)
+
+        return topic  # type: ignore
+
+    @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
+    def mark_topic_read(
+        self,
+        info: Info,
+        topic_id: relay.GlobalID,
+        comment_id: relay.GlobalID | None,
+    ) -> types.Topic:
+        """标记话题为已读
+
+        默认读到最新的评论，也可以指定读到哪一条评论
+        """
+        try:
+            topic = topic_id.resolve_node_sync(info, ensure_type=models.Topic)
+        except Exception:
+            raise ValidationError("话题不存在")
+
+        if comment_id:
+            try:
+                comment = comment_id.resolve_node_sync(info, ensure_type=models.Comment)
+            except Exception:
+                raise ValidationError("评论不存在")
+            if comment.topic_id != topic.pk:  # type: ignore
+                raise ValidationError("评论不属于该话题")
+            last_read_comment_id = comment.pk
+        else:
+            last_read_comment_id = topic.comments.aggregate(max_id=Max("id"))["max_id"] or 0
+
+        models.TopicReadState.objects.update_or_create(
+            user=info.context.request.user,
+            topic=topic,
+            defaults={"last_read_comment_id": last_read_comment_id},
+        )
+
+        # 获取话题时已经计算了未读数，需要重新获取
+        return topic_id.resolve_node_sync(info, ensure_type=models.Topic)  # type: ignore
+
+    @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
+    def restore_topic(self, info: Info, archived_topic_id: relay.GlobalID) -> types.Topic:
+        """恢复归档的话题，话题与评论使用原来的 ID"""
+        try:
+            archived = archived_topic_id.resolve_node_sync(info, ensure_type=models.ArchivedTopic)
+        except Exception:
+            raise ValidationError("归档话题不存在")
+
+        topic = archive.restore_topic(archived)
+        publish_topic_updated(topic)
 
         return topic  # type: ignore
 
@@ -182,16 +305,9 @@ class Mutation:
             # 被回复人
             comment.reply_to = parent_comment.user
         comment.save()
+        publish_comment_added(comment)
 
-        reg_ids = get_enable_reg_ids_except_user(comment.user)
-        if reg_ids:
-            push_to_users.delay(
-                reg_ids,
-                f"{comment.topic.title} 下有新回复",
-                f"{comment.user.username}：{unmark(comment.body)}",
-                f"/topic/{relay.to_base64(types.Topic, topic.id)}",
-                True,
-            )  # type: ignore
+        transaction.on_commit(lambda: tasks.notify_new_comment.delay(comment.pk))  # type: ignore
         return comment  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
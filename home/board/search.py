@@ -0,0 +1,143 @@
+"""留言板搜索
+
+PostgreSQL 下同时使用全文搜索与 pg_trgm：
+search_vector 由数据库触发器维护（见 0009_board_search），适合按空格分词的内容；
+中文没有分词，所以再用词相似度（word_similarity）匹配标题、说明与评论。
+两者都有 GIN 索引，取较高的分数排序。
+其他数据库（如测试使用的 SQLite）退化为 icontains 匹配，并按匹配字段粗略排序。
+
+摘要在 Python 中生成：ts_headline 无法在未分词的中文里标出关键词，
+而且每次只处理返回的少量结果。
+"""
+
+import re
+from dataclasses import dataclass
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db import connection
+from django.db.models import Case, F, FloatField, Q, QuerySet, Value, When
+from django.db.models.functions import Greatest
+from django.utils.html import escape
+
+from .models import Comment, Topic
+
+# 各字段在排序时的权重，标题最重要
+TITLE_WEIGHT = 1.0
+DESCRIPTION_WEIGHT = 0.6
+COMMENT_WEIGHT = 0.5
+
+# 摘要中关键词前后保留的字数
+SNIPPET_CONTEXT = 30
+
+
+@dataclass
+class SearchResult:
+    topic: Topic
+    comment: Comment | None
+    rank: float
+    snippet: str
+
+
+def search_board(query: str, limit: int = 20) -> list[SearchResult]:
+    """搜索话题与评论
+
+    结果按分数从高到低排序，分数相同时较新的排在前面。
+    """
+    query = query.strip()
+    if not query:
+        return []
+
+    topics = Topic.objects.select_related("user")
+    comments = Comment.objects.select_related("topic", "user")
+    if connection.vendor == "postgresql":
+        topics, comments = _postgres_search(topics, comments, query)
+    else:
+        topics, comments = _fallback_search(topics, comments, query)
+
+    topics = topics.order_by(F("rank").desc(), "-created_at", "-id")[:limit]
+    comments = comments.order_by(F("rank").desc(), "-created_at", "-id")[:limit]
+
+    results = [
+        SearchResult(topic=topic, comment=None, rank=topic.rank, snippet=highlight(topic.description_plain, query))  # type: ignore
+        for topic in topics
+    ]
+    for comment in comments:
+        results.append(
+            SearchResult(
+                topic=comment.topic,
+                comment=comment,
+                rank=comment.rank,  # type: ignore
+                snippet=highlight(comment.body_plain, query),
+            )
+        )
+    results.sort(key=lambda result: (-result.rank, -(result.comment or result.topic).created_at.timestamp()))
+    return results[:limit]
+
+
+def _postgres_search(topics: QuerySet[Topic], comments: QuerySet[Comment], query: str):
+    search_query = SearchQuery(query, config="simple", search_type="websearch")
+
+    topics = topics.filter(
+        Q(search_vector=search_query)
+        | Q(title__icontains=query)
+        | Q(title__trigram_word_similar=query)
+        | Q(description_plain__icontains=query)
+        | Q(description_plain__trigram_word_similar=query)
+    ).annotate(
+        rank=Greatest(
+            SearchRank(F("search_vector"), search_query),
+            TrigramWordSimilarity(query, "title") * TITLE_WEIGHT,
+            TrigramWordSimilarity(query, "description_plain") * DESCRIPTION_WEIGHT,
+        )
+    )
+    comments = comments.filter(
+        Q(search_vector=search_query) | Q(body_plain__icontains=query) | Q(body_plain__trigram_word_similar=query)
+    ).annotate(
+        rank=Greatest(
+            SearchRank(F("search_vector"), search_query) * COMMENT_WEIGHT,
+            TrigramWordSimilarity(query, "body_plain") * COMMENT_WEIGHT,
+        )
+    )
+    return topics, comments
+
+
+def _fallback_search(topics: QuerySet[Topic], comments: QuerySet[Comment], query: str):
+    """不支持全文搜索时仅做子串匹配，标题匹配 > 说明匹配 > 评论匹配"""
+    topics = topics.filter(Q(title__icontains=query) | Q(description_plain__icontains=query)).annotate(
+        rank=Case(
+            When(title__iexact=query, then=Value(TITLE_WEIGHT)),
+            When(title__icontains=query, then=Value(TITLE_WEIGHT * 0.8)),
+            default=Value(DESCRIPTION_WEIGHT),
+            output_field=FloatField(),
+        )
+    )
+    comments = comments.filter(body_plain__icontains=query).annotate(
+        rank=Value(COMMENT_WEIGHT, output_field=FloatField())
+    )
+    return topics, comments
+
+
+def highlight(text: str, query: str) -> str:
+    """截取关键词附近的内容，并用 <mark> 标出关键词
+
+    返回的内容已转义，可以直接作为 HTML 使用
+    """
+    terms = sorted({term for term in query.split() if term}, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE)
+
+    match = pattern.search(text)
+    start = max(match.start() - SNIPPET_CONTEXT, 0) if match else 0
+    end = min((match.end() if match else 0) + SNIPPET_CONTEXT, len(text))
+    snippet = text[start:end]
+
+    parts = []
+    last = 0
+    for m in pattern.finditer(snippet):
+        parts.append(escape(snippet[last : m.start()]))
+        parts.append(f"<mark>{escape(m.group())}</mark>")
+        last = m.end()
+    parts.append(escape(snippet[last:]))
+
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    return prefix + "".join(parts) + suffix
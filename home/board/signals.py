@@ -0,0 +1,73 @@
+from django.contrib.auth import get_user_model
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from home.users.models import Avatar
+
+from . import cache
+from .models import Comment, Topic, TopicReadState
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance: Comment, created: bool, raw: bool, **kwargs):
+    """新评论会成为话题的最新评论
+
+    只需要一次更新，不用重新统计话题下的所有评论
+    """
+    if raw or not created:
+        return
+    Topic.objects.filter(pk=instance.topic_id).update(  # type: ignore
+        comment_count=F("comment_count") + 1,
+        last_comment=instance,
+        active_at=Greatest("active_at", Value(instance.created_at)),
+    )
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance: Comment, origin=None, **kwargs):
+    """删除评论后重新统计
+
+    删除话题时连带删除的评论不需要统计，话题随后也会被删除；
+    删除评论时连带删除的回复与它属于同一个话题，只在被删除的评论上统计一次。
+    同一次删除的所有评论都删除后才会发送信号，统计结果不会包括它们
+    """
+    if isinstance(origin, Topic):
+        return
+    if isinstance(origin, Comment) and instance is not origin:
+        return
+    topic = Topic.objects.filter(pk=instance.topic_id).first()  # type: ignore
+    if topic:
+        topic.refresh_activity()
+
+
+@receiver([post_save, post_delete], sender=Topic)
+@receiver([post_save, post_delete], sender=Comment)
+def invalidate_front_page(sender, **kwargs):
+    """话题与评论变化后所有用户的首页缓存失效"""
+    cache.invalidate()
+
+
+# 只修改这些字段时不影响首页显示的用户信息，比如每次登录都会更新的 last_login
+USER_HIDDEN_FIELDS = frozenset({"last_login", "password"})
+
+
+@receiver([post_save, post_delete], sender=get_user_model())
+def invalidate_front_page_user(sender, update_fields=None, **kwargs):
+    """首页缓存中包含评论者的用户名等信息，用户变化后所有用户的首页缓存失效"""
+    if update_fields is not None and update_fields <= USER_HIDDEN_FIELDS:
+        return
+    cache.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Avatar)
+def invalidate_front_page_avatar(sender, **kwargs):
+    """首页缓存中包含头像的地址"""
+    cache.invalidate()
+
+
+@receiver([post_save, post_delete], sender=TopicReadState)
+def invalidate_user_front_page(sender, instance: TopicReadState, **kwargs):
+    """阅读状态只影响该用户的未读数"""
+    cache.invalidate(instance.user_id)  # type: ignore
@@ -0,0 +1,72 @@
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.utils import timezone
+from strawberry import relay
+
+from home.push.tasks import get_enable_reg_ids_except_user, push_to_users
+
+from . import types
+from .archive import archive_topic
+from .models import Comment, Topic
+
+
+@shared_task
+def notify_new_topic(topic_id: int):
+    """推送新话题通知
+
+    在话题提交到数据库后由接口调用，只传递 ID，接收者与通知内容在这里获取
+    """
+    topic = Topic.objects.select_related("user").filter(pk=topic_id).first()
+    if topic is None:
+        return "话题不存在"
+
+    reg_ids = get_enable_reg_ids_except_user(topic.user)
+    if not reg_ids:
+        return "没有启用推送的设备"
+
+    push_to_users.delay(
+        reg_ids,
+        f"{topic.user.username} 发布新话题",
+        f"{topic.title}\n{topic.description_plain}",
+        f"/topic/{relay.to_base64(types.Topic, topic.pk)}",
+        True,
+    )  # type: ignore
+    return f"推送给 {len(reg_ids)} 个设备"
+
+
+@shared_task
+def notify_new_comment(comment_id: int):
+    """推送新评论通知"""
+    comment = Comment.objects.select_related("user", "topic").filter(pk=comment_id).first()
+    if comment is None:
+        return "评论不存在"
+
+    reg_ids = get_enable_reg_ids_except_user(comment.user)
+    if not reg_ids:
+        return "没有启用推送的设备"
+
+    push_to_users.delay(
+        reg_ids,
+        f"{comment.topic.title} 下有新回复",
+        f"{comment.user.username}：{comment.body_plain}",
+        f"/topic/{relay.to_base64(types.Topic, comment.topic_id)}",  # type: ignore
+        True,
+    )  # type: ignore
+    return f"推送给 {len(reg_ids)} 个设备"
+
+
+@shared_task
+def archive_closed_topics():
+    """归档关闭超过一定时间的话题
+
+    需要在后台添加定时任务，每个话题在单独的事务中归档
+    """
+    closed_before = timezone.now() - timedelta(days=settings.ARCHIVE_CLOSED_TOPICS_AFTER_DAYS)
+    topics = Topic.objects.filter(is_closed=True, closed_at__lt=closed_before)
+    count = 0
+    for topic in topics.iterator():
+        archive_topic(topic)
+        count += 1
+    return f"归档了 {count} 个话题"
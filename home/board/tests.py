@@ -1,12 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from strawberry import relay
 
-from home.tests import GraphQLTestCase
+from home.tests import IN_MEMORY_CHANNEL_LAYERS, GraphQLTestCase, get_ws_client, subscribe
+from home.users.models import Avatar
 
 from . import types
-from .models import Comment, Topic
-from .utils import unmark
+from .archive import archive_topic
+from .cache import VERSION_KEY, local_cache
+from .models import ArchivedTopic, Comment, CommentRevision, Topic, TopicReadState, TopicRevision
+from .search import highlight
+from .tasks import archive_closed_topics, notify_new_comment, notify_new_topic
+from .utils import apply_delta, content_hash, make_delta, markdown_to_html, unmark
 
 
 class ModelTests(TestCase):
@@ -22,6 +37,108 @@ class ModelTests(TestCase):
 
         self.assertEqual(str(comment), "测试评论一")
 
+    def test_topic_activity(self):
+        """添加和删除评论时更新话题的活跃时间、评论数与最新评论"""
+        topic = Topic.objects.get(pk=1)
+        user = get_user_model().objects.get(pk=1)
+
+        comment = Comment.objects.create(topic=topic, user=user, body="新评论")
+
+        topic.refresh_from_db()
+        self.assertEqual(topic.comment_count, 4)
+        self.assertEqual(topic.last_comment, comment)
+        self.assertEqual(topic.active_at, comment.created_at)
+
+        comment.body = "修改后的评论"
+        comment.save()
+
+        topic.refresh_from_db()
+        self.assertEqual(topic.comment_count, 4)
+
+        comment.delete()
+
+        topic.refresh_from_db()
+        self.assertEqual(topic.comment_count, 3)
+        self.assertEqual(topic.last_comment_id, 3)
+        self.assertEqual(topic.active_at, topic.edited_at)
+
+        # 删除父评论时子评论也会被删除
+        Comment.objects.get(pk=1).delete()
+
+        topic.refresh_from_db()
+        self.assertEqual(topic.comment_count, 1)
+        self.assertEqual(topic.last_comment_id, 2)
+
+    def test_topic_save_keeps_activity(self):
+        """修改话题时不会覆盖同时发布的评论更新的评论数与最新评论"""
+        topic = Topic.objects.get(pk=1)
+        user = get_user_model().objects.get(pk=1)
+
+        # 话题读取之后，保存之前发布了评论
+        comment = Comment.objects.create(topic=Topic.objects.get(pk=1), user=user, body="新评论")
+        topic.title = "新标题"
+        topic.edited_at = comment.created_at - timedelta(seconds=1)
+        topic.save()
+
+        topic.refresh_from_db()
+        self.assertEqual(topic.title, "新标题")
+        self.assertEqual(topic.comment_count, 4)
+        self.assertEqual(topic.last_comment, comment)
+        self.assertEqual(topic.active_at, comment.created_at)
+
+        # 修改时间更晚时更新活跃时间
+        topic.edited_at = timezone.now()
+        topic.save()
+        self.assertEqual(topic.active_at, topic.edited_at)
+        topic.refresh_from_db()
+        self.assertEqual(topic.active_at, topic.edited_at)
+        self.assertEqual(topic.comment_count, 4)
+
+    def test_delete_topic_skips_activity(self):
+        """删除话题时连带删除的评论不需要重新统计，删除评论时只统计一次"""
+        with mock.patch.object(Topic, "refresh_activity") as mocked:
+            # 评论 1 有一条回复
+            Comment.objects.get(pk=1).delete()
+            self.assertFalse(Comment.objects.filter(pk=3).exists())
+            mocked.assert_called_once()
+
+            mocked.reset_mock()
+            Topic.objects.get(pk=1).delete()
+            mocked.assert_not_called()
+
+    def test_rendered_markdown(self):
+        """内容变化时才重新渲染"""
+        comment = Comment.objects.get(pk=1)
+
+        with mock.patch("home.board.utils.markdown_to_html", wraps=markdown_to_html) as mocked:
+            comment.save()
+            mocked.assert_not_called()
+
+            comment.body = "# 标题"
+            comment.save(update_fields=["body"])
+            mocked.assert_called_once_with("# 标题")
+
+        comment.refresh_from_db()
+        self.assertEqual(comment.body_html, "<h1>标题</h1>")
+        self.assertEqual(comment.body_plain, "标题")
+        self.assertEqual(comment.body_hash, content_hash("# 标题"))
+
+    def test_rendered_markdown_script(self):
+        """保存的 HTML 中不包含评论里的脚本"""
+        comment = Comment.objects.get(pk=1)
+        comment.body = "<script>alert(1)</script>"
+        comment.save(update_fields=["body"])
+
+        comment.refresh_from_db()
+        self.assertEqual(comment.body_html, "<p>&lt;script&gt;alert(1)&lt;/script&gt;</p>")
+
+    def test_topic_active_at_follows_edited_at(self):
+        topic = Topic.objects.get(pk=3)
+        topic.edited_at = timezone.now()
+        topic.save()
+
+        self.assertEqual(topic.active_at, topic.edited_at)
+
 
 class TopicTests(GraphQLTestCase):
     fixtures = ["users", "board", "push_disabled"]
@@ -124,6 +241,8 @@ class TopicTests(GraphQLTestCase):
                         __typename
                         title
                         description
+                        descriptionHtml
+                        descriptionPlain
                         isClosed
                     }
                 }
@@ -136,12 +255,17 @@ class TopicTests(GraphQLTestCase):
             }
         }
 
-        content = self.client.execute(mutation, variables)
+        with mock.patch.object(notify_new_topic, "delay") as mock_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                content = self.client.execute(mutation, variables)
 
         topic = content.data["addTopic"]
+        mock_delay.assert_called_once_with(Topic.objects.get(title="test").pk)
         self.assertEqual(topic["__typename"], "Topic")
         self.assertEqual(topic["title"], "test")
         self.assertEqual(topic["description"], "some")
+        self.assertEqual(topic["descriptionHtml"], "<p>some</p>")
+        self.assertEqual(topic["descriptionPlain"], "some")
         self.assertEqual(topic["isClosed"], False)
 
     def test_delete_topic(self):
@@ -543,6 +667,100 @@ class CommentTests(GraphQLTestCase):
         self.user = get_user_model().objects.get(username="he0119")
         self.client.authenticate(self.user)
 
+    def test_comment_tree(self):
+        """获取评论树"""
+        query = """
+            query commentTree($topicId: ID!) {
+                commentTree(topicId: $topicId) {
+                    comment {
+                        body
+                    }
+                    children {
+                        comment {
+                            body
+                            parent {
+                                body
+                            }
+                            replyTo {
+                                username
+                            }
+                        }
+                        children {
+                            comment {
+                                body
+                            }
+                        }
+                    }
+                }
+            }
+        """
+        variables = {"topicId": relay.to_base64(types.Topic, 1)}
+
+        content = self.client.execute(query, variables)
+
+        tree = content.data["commentTree"]
+        self.assertEqual([node["comment"]["body"] for node in tree], ["测试评论一", "测试评论二"])
+        self.assertEqual(
+            tree[0]["children"],
+            [
+                {
+                    "comment": {
+                        "body": "评论测试评论一",
+                        "parent": {"body": "测试评论一"},
+                        "replyTo": {"username": "he0119"},
+                    },
+                    "children": [],
+                }
+            ],
+        )
+        self.assertEqual(tree[1]["children"], [])
+
+    def test_comment_tree_num_queries(self):
+        """评论数量不影响查询次数"""
+        query = """
+            query commentTree($topicId: ID!) {
+                commentTree(topicId: $topicId) {
+                    comment {
+                        body
+                        user {
+                            username
+                            avatarUrl
+                        }
+                    }
+                    children {
+                        comment {
+                            body
+                            user {
+                                username
+                                avatarUrl
+                            }
+                            replyTo {
+                                username
+                            }
+                        }
+                    }
+                }
+            }
+        """
+        topic = Topic.objects.get(pk=1)
+        variables = {"topicId": relay.to_base64(types.Topic, topic.pk)}
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as context:
+                self.client.execute(query, variables)
+            return len(context.captured_queries)
+
+        few = count_queries()
+
+        users = list(get_user_model().objects.all())
+        for i in range(20):
+            root = Comment.objects.create(topic=topic, user=users[i % len(users)], body=f"评论{i}")
+            Comment.objects.create(topic=topic, user=users[(i + 1) % len(users)], body=f"回复{i}", parent=root)
+
+        many = count_queries()
+
+        self.assertEqual(few, many)
+
     def test_get_comment(self):
         """通过 Node 来获得指定评论"""
         test_comment = Comment.objects.get(body="测试评论一")
@@ -707,11 +925,14 @@ class CommentTests(GraphQLTestCase):
             }
         }
 
-        content = self.client.execute(mutation, variables)
+        with mock.patch.object(notify_new_comment, "delay") as mock_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                content = self.client.execute(mutation, variables)
 
         comment = content.data["addComment"]
         self.assertEqual(comment["__typename"], "Comment")
         self.assertEqual(comment["body"], "test")
+        mock_delay.assert_called_once_with(Comment.objects.get(body="test").pk)
 
     def test_add_comment_with_parent_id(self):
         mutation = """
@@ -804,6 +1025,8 @@ class CommentTests(GraphQLTestCase):
                         __typename
                         id
                         body
+                        bodyHtml
+                        bodyPlain
                     }
                 }
             }
@@ -811,7 +1034,7 @@ class CommentTests(GraphQLTestCase):
         variables = {
             "input": {
                 "id": relay.to_base64(types.Comment, "1"),
-                "body": "hello",
+                "body": "**hello**",
             }
         }
 
@@ -823,7 +1046,9 @@ class CommentTests(GraphQLTestCase):
         comment = content.data["updateComment"]
         self.assertEqual(comment["__typename"], "Comment")
         self.assertEqual(comment["id"], relay.to_base64(types.Comment, "1"))
-        self.assertEqual(comment["body"], "hello")
+        self.assertEqual(comment["body"], "**hello**")
+        self.assertEqual(comment["bodyHtml"], "<p><strong>hello</strong></p>")
+        self.assertEqual(comment["bodyPlain"], "hello")
 
     def test_add_comment_not_exist(self):
         mutation = """
@@ -1107,6 +1332,711 @@ class DifferentUserCommentTests(GraphQLTestCase):
         self.assertEqual(data["messages"][0]["message"], "只能修改自己创建的评论")
 
 
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class SubscriptionTests(GraphQLTestCase):
+    fixtures = ["users", "board", "push_disabled"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+    async def test_comment_added(self):
+        query = """
+            subscription commentAdded($topicId: ID!) {
+                commentAdded(topicId: $topicId) {
+                    body
+                    user {
+                        username
+                    }
+                }
+            }
+        """
+        mutation = """
+            mutation addComment($input: AddCommentInput!) {
+                addComment(input: $input) {
+                    __typename
+                }
+            }
+        """
+        topic_id = relay.to_base64(types.Topic, 1)
+        ws_client = get_ws_client(self.user)
+        await subscribe(ws_client, query, {"topicId": topic_id}, group="board.topic.1.comments")
+
+        await sync_to_async(self.execute_on_commit)(mutation, {"input": {"topicId": topic_id, "body": "新评论"}})
+
+        response = await ws_client.receive_json_from()
+        self.assertEqual(response["type"], "next")
+        self.assertEqual(
+            response["payload"]["data"]["commentAdded"], {"body": "新评论", "user": {"username": "he0119"}}
+        )
+        await ws_client.disconnect()
+
+    async def test_topic_updated(self):
+        query = """
+            subscription topicUpdated {
+                topicUpdated {
+                    title
+                    isPinned
+                    unreadCount
+                    hasUnread
+                }
+            }
+        """
+        mutation = """
+            mutation pinTopic($input: PinTopicInput!) {
+                pinTopic(input: $input) {
+                    __typename
+                }
+            }
+        """
+        ws_client = get_ws_client(self.user)
+        await subscribe(ws_client, query, group="board.topics")
+
+        await sync_to_async(self.execute_on_commit)(mutation, {"input": {"topicId": relay.to_base64(types.Topic, 1)}})
+
+        response = await ws_client.receive_json_from()
+        # WebSocket 的上下文中同样可以获取未读数
+        self.assertEqual(
+            response["payload"]["data"]["topicUpdated"],
+            {"title": "你好世界", "isPinned": True, "unreadCount": 2, "hasUnread": True},
+        )
+        await ws_client.disconnect()
+
+    async def test_subscription_not_authenticated(self):
+        query = """
+            subscription topicUpdated {
+                topicUpdated {
+                    title
+                }
+            }
+        """
+        ws_client = get_ws_client(AnonymousUser())
+        await subscribe(ws_client, query)
+
+        response = await ws_client.receive_json_from()
+        self.assertEqual(response["type"], "error")
+        self.assertEqual(response["payload"][0]["message"], "User is not authenticated")
+        await ws_client.disconnect()
+
+
+class SearchTests(GraphQLTestCase):
+    fixtures = ["users", "board"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+    def test_search_board(self):
+        query = """
+            query searchBoard($query: String!, $first: Int) {
+                searchBoard(query: $query, first: $first) {
+                    topic {
+                        title
+                    }
+                    comment {
+                        body
+                    }
+                    snippet
+                }
+            }
+        """
+
+        content = self.client.execute(query, {"query": "测试", "first": 3})
+
+        results = content.data["searchBoard"]
+        # 话题排在评论前面，评论按时间倒序
+        self.assertEqual(
+            results,
+            [
+                {"topic": {"title": "你好世界"}, "comment": None, "snippet": "这是一个<mark>测试</mark>话题"},
+                {
+                    "topic": {"title": "关闭的话题"},
+                    "comment": {"body": "测试评论关闭的话题"},
+                    "snippet": "<mark>测试</mark>评论关闭的话题",
+                },
+                {
+                    "topic": {"title": "你好世界"},
+                    "comment": {"body": "评论测试评论一"},
+                    "snippet": "评论<mark>测试</mark>评论一",
+                },
+            ],
+        )
+
+        content = self.client.execute(query, {"query": "置顶"})
+
+        titles = [result["topic"]["title"] for result in content.data["searchBoard"]]
+        self.assertEqual(titles, ["置顶的话题"])
+
+        content = self.client.execute(query, {"query": " "})
+
+        self.assertEqual(content.data["searchBoard"], [])
+
+    def test_search_board_invalid_first(self):
+        query = """
+            query searchBoard($query: String!, $first: Int) {
+                searchBoard(query: $query, first: $first) {
+                    snippet
+                }
+            }
+        """
+
+        content = self.client.execute(query, {"query": "测试", "first": 1000}, asserts_errors=False)
+
+        self.assertEqual(content.errors[0]["message"], "first 需要在 1 到 100 之间")
+
+
+class ArchiveTests(GraphQLTestCase):
+    fixtures = ["users", "board", "push_disabled"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+    def test_archive_closed_topics(self):
+        """只归档关闭超过一定时间的话题"""
+        Topic.objects.filter(pk=3).update(closed_at=timezone.now())
+
+        self.assertEqual(archive_closed_topics(), "归档了 1 个话题")
+
+        self.assertEqual(set(Topic.objects.values_list("pk", flat=True)), {1, 3})
+        self.assertFalse(Comment.objects.filter(pk=4).exists())
+        archived = ArchivedTopic.objects.get()
+        self.assertEqual(archived.topic_id, 2)
+        self.assertEqual(archived.title, "关闭的话题")
+        self.assertEqual(archived.comment_count, 1)
+        self.assertEqual(archived.content["comments"][0]["body"], "测试评论关闭的话题")
+
+    def test_archived_topics(self):
+        archive_topic(Topic.objects.get(pk=1))
+
+        query = """
+            query archivedTopics {
+                archivedTopics(first: 10) {
+                    edges {
+                        node {
+                            title
+                            description
+                            commentCount
+                            comments {
+                                id
+                                body
+                                parentId
+                                user {
+                                    username
+                                }
+                                replyTo {
+                                    username
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        """
+
+        content = self.client.execute(query)
+
+        topic = content.data["archivedTopics"]["edges"][0]["node"]
+        self.assertEqual(topic["title"], "你好世界")
+        self.assertEqual(topic["description"], "这是一个测试话题")
+        self.assertEqual(topic["commentCount"], 3)
+        self.assertEqual(
+            topic["comments"],
+            [
+                {"id": 1, "body": "测试评论一", "parentId": None, "user": {"username": "he0119"}, "replyTo": None},
+                {
+                    "id": 3,
+                    "body": "评论测试评论一",
+                    "parentId": 1,
+                    "user": {"username": "test"},
+                    "replyTo": {"username": "he0119"},
+                },
+                {"id": 2, "body": "测试评论二", "parentId": None, "user": {"username": "test"}, "replyTo": None},
+            ],
+        )
+
+    def test_restore_topic(self):
+        topic = Topic.objects.get(pk=1)
+        topic.description = "新的说明"
+        topic.save()
+        comment = Comment.objects.get(pk=3)
+        comment.body = "修改后的评论"
+        comment.save()
+        read_at = (timezone.now() - timedelta(days=1)).replace(microsecond=0)
+        TopicReadState.objects.create(user=self.user, topic=topic, last_read_comment_id=3)
+        TopicReadState.objects.filter(topic=topic).update(read_at=read_at)
+        archived = archive_topic(topic)
+        self.assertFalse(TopicRevision.objects.exists())
+        # 归档后新评论可能会使用原来的树编号
+        new_comment = Comment.objects.create(topic=Topic.objects.get(pk=3), user=self.user, body="新评论")
+
+        mutation = """
+            mutation restoreTopic($input: RestoreTopicInput!) {
+                restoreTopic(input: $input) {
+                    ... on Topic {
+                        id
+                        isClosed
+                        commentCount
+                        lastComment {
+                            body
+                        }
+                    }
+                }
+            }
+        """
+        variables = {"input": {"archivedTopicId": relay.to_base64(types.ArchivedTopic, archived.pk)}}
+
+        content = self.client.execute(mutation, variables)
+
+        data = content.data["restoreTopic"]
+        self.assertEqual(data["id"], relay.to_base64(types.Topic, 1))
+        self.assertEqual(data["isClosed"], False)
+        self.assertEqual(data["commentCount"], 3)
+        self.assertEqual(data["lastComment"], {"body": "修改后的评论"})
+        self.assertFalse(ArchivedTopic.objects.exists())
+
+        restored = Topic.objects.get(pk=1)
+        self.assertEqual(restored.created_at, topic.created_at)
+        self.assertEqual(restored.description_plain, "新的说明")
+        comment = Comment.objects.get(pk=3)
+        self.assertEqual(comment.created_at.isoformat(), "2020-07-11T02:00:00+00:00")
+        self.assertEqual(comment.body_html, "<p>修改后的评论</p>")
+        self.assertEqual(comment.get_root().pk, 1)
+        self.assertNotEqual(comment.tree_id, new_comment.tree_id)
+        self.assertEqual([c.pk for c in restored.comment_tree()], [1, 2])
+        # 历史版本与阅读进度一起恢复
+        self.assertEqual([revision.text for revision in restored.revisions.all()], ["这是一个测试话题"])  # type: ignore
+        self.assertEqual([revision.text for revision in comment.revisions.all()], ["评论测试评论一"])  # type: ignore
+        read_state = TopicReadState.objects.get(topic=restored)
+        self.assertEqual((read_state.user, read_state.last_read_comment_id), (self.user, 3))
+        self.assertEqual(read_state.read_at, read_at)
+
+    def test_restore_topic_deleted_users(self):
+        """回复的用户与阅读进度的用户被删除时忽略，评论的作者被删除时无法恢复"""
+        other = get_user_model().objects.create_user(username="other")
+        topic = Topic.objects.get(pk=1)
+        Comment.objects.filter(pk=1).update(reply_to=other)
+        TopicReadState.objects.create(user=other, topic=topic, last_read_comment_id=3)
+        archived = archive_topic(topic)
+        other.delete()
+
+        mutation = """
+            mutation restoreTopic($input: RestoreTopicInput!) {
+                restoreTopic(input: $input) {
+                    __typename
+                    ... on OperationInfo {
+                        messages {
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {"input": {"archivedTopicId": relay.to_base64(types.ArchivedTopic, archived.pk)}}
+
+        content = self.client.execute(mutation, variables)
+
+        self.assertEqual(content.data["restoreTopic"]["__typename"], "Topic")
+        self.assertIsNone(Comment.objects.get(pk=1).reply_to)
+        self.assertFalse(TopicReadState.objects.exists())
+
+        archived = archive_topic(Topic.objects.get(pk=1))
+        get_user_model().objects.filter(username="test").delete()
+        variables = {"input": {"archivedTopicId": relay.to_base64(types.ArchivedTopic, archived.pk)}}
+        content = self.client.execute(mutation, variables)
+
+        self.assertEqual(content.data["restoreTopic"]["messages"][0]["message"], "话题或评论的作者已被删除，无法恢复")
+        self.assertTrue(ArchivedTopic.objects.filter(pk=archived.pk).exists())
+        self.assertFalse(Topic.objects.filter(pk=1).exists())
+
+    def test_restore_topic_not_exist(self):
+        mutation = """
+            mutation restoreTopic($input: RestoreTopicInput!) {
+                restoreTopic(input: $input) {
+                    __typename
+                    ... on OperationInfo {
+                        messages {
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {"input": {"archivedTopicId": relay.to_base64(types.ArchivedTopic, 1)}}
+
+        content = self.client.execute(mutation, variables)
+
+        self.assertEqual(content.data["restoreTopic"]["messages"][0]["message"], "归档话题不存在")
+
+
+# 不使用缓存，避免缓存的结果影响查询次数与其他测试
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}})
+class ReadStateTests(GraphQLTestCase):
+    fixtures = ["users", "board"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+    def get_unread(self, fields="unreadCount hasUnread"):
+        query = f"""
+            query topics {{
+                topics(first: 10, order: {{createdAt: ASC}}) {{
+                    edges {{
+                        node {{
+                            title
+                            {fields}
+                        }}
+                    }}
+                }}
+            }}
+        """
+        content = self.client.execute(query)
+        return [edge["node"] for edge in content.data["topics"]["edges"]]
+
+    def test_unread_count(self):
+        """自己的评论不算未读"""
+        self.assertEqual(
+            self.get_unread(),
+            [
+                {"title": "你好世界", "unreadCount": 2, "hasUnread": True},
+                {"title": "关闭的话题", "unreadCount": 0, "hasUnread": False},
+                {"title": "置顶的话题", "unreadCount": 0, "hasUnread": False},
+            ],
+        )
+
+    def test_unread_count_num_queries(self):
+        """未读数通过子查询获取，不增加查询次数"""
+
+        def count_queries(fields):
+            with CaptureQueriesContext(connection) as context:
+                self.get_unread(fields)
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(""), count_queries("unreadCount hasUnread"))
+
+    def test_mark_topic_read(self):
+        mutation = """
+            mutation markTopicRead($input: MarkTopicReadInput!) {
+                markTopicRead(input: $input) {
+                    ... on Topic {
+                        unreadCount
+                        hasUnread
+                    }
+                }
+            }
+        """
+        topic_id = relay.to_base64(types.Topic, 1)
+
+        content = self.client.execute(
+            mutation, {"input": {"topicId": topic_id, "commentId": relay.to_base64(types.Comment, 2)}}
+        )
+
+        self.assertEqual(content.data["markTopicRead"], {"unreadCount": 1, "hasUnread": True})
+
+        content = self.client.execute(mutation, {"input": {"topicId": topic_id}})
+
+        self.assertEqual(content.data["markTopicRead"], {"unreadCount": 0, "hasUnread": False})
+        self.assertEqual(TopicReadState.objects.get(user=self.user, topic_id=1).last_read_comment_id, 3)
+
+        # 新的评论是未读的
+        Comment.objects.create(topic_id=1, user=get_user_model().objects.get(username="test"), body="新评论")
+        self.assertEqual(self.get_unread("unreadCount")[0]["unreadCount"], 1)
+
+    def test_mark_topic_read_wrong_comment(self):
+        mutation = """
+            mutation markTopicRead($input: MarkTopicReadInput!) {
+                markTopicRead(input: $input) {
+                    ... on OperationInfo {
+                        messages {
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {
+            "input": {
+                "topicId": relay.to_base64(types.Topic, 1),
+                "commentId": relay.to_base64(types.Comment, 4),
+            }
+        }
+
+        content = self.client.execute(mutation, variables)
+
+        self.assertEqual(content.data["markTopicRead"]["messages"][0]["message"], "评论不属于该话题")
+
+
+class NotifyTests(TestCase):
+    fixtures = ["users", "board", "push_disabled"]
+
+    @mock.patch("home.board.tasks.push_to_users.delay")
+    def test_notify_new_topic(self, mock_push):
+        self.assertEqual(notify_new_topic(1), "推送给 2 个设备")
+
+        mock_push.assert_called_once_with(
+            ["regidofuser2", "regid2ofuser2"],
+            "he0119 发布新话题",
+            "你好世界\n这是一个测试话题",
+            f"/topic/{relay.to_base64(types.Topic, 1)}",
+            True,
+        )
+
+    @mock.patch("home.board.tasks.push_to_users.delay")
+    def test_notify_new_comment(self, mock_push):
+        Comment.objects.filter(pk=1).update(body="**加粗**", body_plain="加粗")
+
+        self.assertEqual(notify_new_comment(1), "推送给 2 个设备")
+
+        mock_push.assert_called_once_with(
+            ["regidofuser2", "regid2ofuser2"],
+            "你好世界 下有新回复",
+            "he0119：加粗",
+            f"/topic/{relay.to_base64(types.Topic, 1)}",
+            True,
+        )
+
+    @mock.patch("home.board.tasks.push_to_users.delay")
+    def test_notify_without_devices(self, mock_push):
+        """评论者以外的用户都没有启用推送"""
+        self.assertEqual(notify_new_comment(3), "没有启用推送的设备")
+        self.assertEqual(notify_new_comment(100), "评论不存在")
+        self.assertEqual(notify_new_topic(100), "话题不存在")
+
+        mock_push.assert_not_called()
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class FrontPageCacheTests(GraphQLTestCase):
+    fixtures = ["users", "board"]
+
+    query = """
+        query topics {
+            topics(first: 1, order: {isPinned: DESC, activeAt: DESC}) {
+                edges {
+                    node {
+                        title
+                        isPinned
+                        unreadCount
+                    }
+                }
+            }
+        }
+    """
+
+    def setUp(self):
+        local_cache.clear()
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+    def get_topics(self):
+        with CaptureQueriesContext(connection) as context:
+            content = self.client.execute(self.query)
+        hit = not any("board_topic" in query["sql"] for query in context.captured_queries)
+        return [edge["node"] for edge in content.data["topics"]["edges"]], hit
+
+    def test_cache(self):
+        self.assertEqual(self.get_topics(), ([{"title": "置顶的话题", "isPinned": True, "unreadCount": 0}], False))
+        self.assertEqual(self.get_topics(), ([{"title": "置顶的话题", "isPinned": True, "unreadCount": 0}], True))
+
+        # 未读数因人而异，每个用户分别缓存
+        self.client.authenticate(get_user_model().objects.get(username="test"))
+        self.assertFalse(self.get_topics()[1])
+        self.assertTrue(self.get_topics()[1])
+
+    def test_invalidate(self):
+        self.get_topics()
+
+        mutation = """
+            mutation pinTopic($input: PinTopicInput!) {
+                pinTopic(input: $input) {
+                    ... on Topic {
+                        isPinned
+                    }
+                }
+            }
+        """
+        self.client.execute(mutation, {"input": {"topicId": relay.to_base64(types.Topic, "2")}})
+
+        self.assertEqual(self.get_topics(), ([{"title": "关闭的话题", "isPinned": True, "unreadCount": 0}], False))
+
+        # 评论变化同样会让缓存失效
+        comment = Comment.objects.create(topic_id=2, user=get_user_model().objects.get(username="test"), body="新评论")
+        self.assertEqual(self.get_topics(), ([{"title": "关闭的话题", "isPinned": True, "unreadCount": 1}], False))
+
+        # 阅读状态只让该用户的缓存失效
+        other = get_user_model().objects.get(username="test")
+        self.client.authenticate(other)
+        self.get_topics()
+        TopicReadState.objects.create(user=self.user, topic_id=2, last_read_comment_id=comment.pk)
+        self.assertTrue(self.get_topics()[1])
+        self.client.authenticate(self.user)
+        self.assertEqual(self.get_topics(), ([{"title": "关闭的话题", "isPinned": True, "unreadCount": 0}], False))
+
+    def test_invalidate_user(self):
+        """缓存中包含用户信息，用户或头像变化后缓存失效，登录不影响"""
+        self.get_topics()
+        self.client.authenticate(self.user)
+        self.assertTrue(self.get_topics()[1])
+
+        other = get_user_model().objects.get(username="test")
+        other.username = "new"
+        other.save()
+        self.assertFalse(self.get_topics()[1])
+
+        Avatar.objects.create(user=other, avatar="avatar.jpg")
+        self.assertFalse(self.get_topics()[1])
+
+    def test_inactive_user(self):
+        """停用的用户不能读取之前的缓存"""
+        self.get_topics()
+        self.user.is_active = False
+        self.user.save()
+
+        content = self.client.execute(self.query, asserts_errors=False)
+
+        self.assertIsNotNone(content.errors)
+
+    def test_shared_cache_error(self):
+        """共享缓存出错时改用进程内缓存"""
+        with (
+            mock.patch("home.board.cache.is_shared_cache", return_value=True),
+            mock.patch.object(cache, "aget_many", side_effect=ConnectionError),
+            self.assertLogs("home.board.cache", "WARNING"),
+        ):
+            self.assertFalse(self.get_topics()[1])
+            self.assertTrue(self.get_topics()[1])
+
+    def test_not_cacheable(self):
+        """包含其他字段或未登录的查询不缓存"""
+        query = """
+            query topics {
+                topics(first: 1) {
+                    edges {
+                        node {
+                            title
+                        }
+                    }
+                }
+                viewer {
+                    username
+                }
+            }
+        """
+        self.client.execute(query)
+        self.client.execute(query)
+        self.assertEqual(local_cache.get(VERSION_KEY), None)
+
+        self.client.client.logout()
+        content = self.client.execute(self.query, asserts_errors=False)
+        self.assertIsNotNone(content.errors)
+        self.assertEqual(local_cache.get(VERSION_KEY), None)
+
+
+class RevisionTests(GraphQLTestCase):
+    fixtures = ["users", "board"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+    def test_comment_revisions(self):
+        lines = [f"第 {i} 行，" + "这是一段比较长的评论内容。" * 5 for i in range(20)]
+        Comment.objects.filter(pk=1).update(body="\n".join(lines))
+        comment = Comment.objects.get(pk=1)
+        versions = [comment.body]
+        for i in range(1, 25):
+            lines[i % 20] = f"修改 {i}"
+            comment.body = "\n".join(lines)
+            comment.save()
+            versions.append(comment.body)
+
+        revisions = list(CommentRevision.objects.filter(comment=comment).order_by("number"))
+        self.assertEqual([revision.number for revision in revisions], list(range(1, 25)))
+        # 每隔 SNAPSHOT_INTERVAL 个版本保存一次完整内容
+        self.assertEqual([revision.number for revision in revisions if revision.is_snapshot], [1, 11, 21])
+        for revision in revisions:
+            fresh = CommentRevision.objects.get(pk=revision.pk)
+            self.assertEqual(fresh.text, versions[revision.number - 1])
+            self.assertEqual(fresh.get_siblings().count(), 24)
+
+        # 同一次查询得到的版本一次获取所有差异链
+        revisions = list(CommentRevision.objects.filter(comment=comment).order_by("number")[5:])
+        with self.assertNumQueries(1):
+            self.assertEqual([revision.text for revision in revisions], versions[5:24])
+
+        # 内容没有变化时不保存版本
+        comment.save()
+        comment.save(update_fields=["edited_at"])
+        self.assertEqual(comment.revisions.count(), 24)  # type: ignore
+
+    def test_topic_revisions(self):
+        topic = Topic.objects.get(pk=1)
+        old_description = topic.description
+        old_edited_at = topic.edited_at
+        topic.description = "新的说明"
+        topic.save()
+        # 完全不同的内容直接保存完整内容
+        topic.description = "完全不同"
+        topic.save()
+
+        first, second = TopicRevision.objects.filter(topic=topic).order_by("number")
+        self.assertEqual(first.text, old_description)
+        self.assertEqual(first.created_at, old_edited_at)
+        self.assertEqual(second.text, "新的说明")
+        self.assertTrue(second.is_snapshot)
+
+        # 新建的话题没有历史版本
+        new_topic = Topic.objects.create(title="新话题", description="说明", user=self.user, edited_at=timezone.now())
+        self.assertEqual(new_topic.revisions.count(), 0)  # type: ignore
+
+    def test_revisions_query(self):
+        mutation = """
+            mutation updateComment($input: UpdateCommentInput!) {
+                updateComment(input: $input) {
+                    ... on Comment {
+                        id
+                    }
+                }
+            }
+        """
+        query = """
+            query comment($id: ID!, $first: Int!) {
+                comment(id: $id) {
+                    revisions(first: $first) {
+                        edges {
+                            node {
+                                number
+                                body
+                            }
+                        }
+                    }
+                }
+            }
+        """
+        comment_id = relay.to_base64(types.Comment, "1")
+        for body in ["一", "一\n二", "一\n二\n三"]:
+            self.client.execute(mutation, {"input": {"id": comment_id, "body": body}})
+
+        content = self.client.execute(query, {"id": comment_id, "first": 2})
+
+        revisions = [edge["node"] for edge in content.data["comment"]["revisions"]["edges"]]
+        self.assertEqual(revisions, [{"number": 3, "body": "一\n二"}, {"number": 2, "body": "一"}])
+
+        # 查询次数不随版本数量增加
+        def count_queries(first):
+            with CaptureQueriesContext(connection) as context:
+                self.client.execute(query, {"id": comment_id, "first": first})
+            return len(context.captured_queries)
+
+        self.assertEqual(count_queries(1), count_queries(3))
+
+    def test_delta(self):
+        old = "一\n二\n三\n"
+        for new in ["一\n二\n三\n", "零\n一\n三\n四", "", "一\r\n二"]:
+            self.assertEqual(apply_delta(old, make_delta(old, new)), new)
+
+
 class MarkdownTests(TestCase):
     def test_unmark(self):
         markdown = "# 标题\n\n- 列表一\n- 列表二"
@@ -1121,3 +2051,43 @@ class MarkdownTests(TestCase):
         plaintext = unmark(markdown)
 
         self.assertEqual(plaintext, "标题\n\n列表一\n列表二")
+
+    def test_unmark_escaped(self):
+        """代码中的字符不会被转义"""
+        self.assertEqual(unmark("`a<b` & `&lt;`"), "a<b & &lt;")
+
+    def test_highlight(self):
+        text = "<b>" + "前" * 40 + "关键词" + "后" * 40
+
+        snippet = highlight(text, "关键词")
+
+        self.assertEqual(snippet, "…" + "前" * 30 + "<mark>关键词</mark>" + "后" * 30 + "…")
+        self.assertEqual(highlight("a <b> A", "a"), "<mark>a</mark> &lt;b&gt; <mark>A</mark>")
+        self.assertEqual(highlight("没有匹配", "关键词"), "没有匹配")
+
+    def test_markdown_to_html(self):
+        html = markdown_to_html("# 标题\n\n- 列表一")
+
+        self.assertEqual(html, "<h1>标题</h1>\n<ul>\n<li>列表一</li>\n</ul>")
+
+    def test_markdown_escape_html(self):
+        """原始 HTML 会被转义，不安全协议的地址会被移除"""
+        html = markdown_to_html("<script>alert(1)</script>\n\n<img src=x onerror=alert(1)>")
+
+        self.assertNotIn("<script>", html)
+        self.assertNotIn("<img", html)
+        self.assertIn("&lt;script&gt;alert(1)&lt;/script&gt;", html)
+
+        html = markdown_to_html("[链接](javascript:alert(1)) [图片](JaVa&#115;cript:x) [网页](https://test.com)")
+
+        self.assertNotIn("script:", html)
+        self.assertIn('<a href="https://test.com">网页</a>', html)
+
+    def test_markdown_per_thread(self):
+        """每个线程使用独立的 Markdown 实例"""
+        texts = [f"# 标题{i}\n\n- 列表{i}" for i in range(50)]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(unmark, texts))
+
+        self.assertEqual(results, [f"标题{i}\n\n列表{i}" for i in range(50)])
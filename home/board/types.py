@@ -1,12 +1,15 @@
+from datetime import datetime
 from typing import Optional
 
 import strawberry
 import strawberry_django
-from django.db.models import Max
-from django.db.models.functions import Greatest
+from django.contrib.auth import get_user_model
+from django.utils.dateparse import parse_datetime
 from strawberry import relay
+from strawberry.types import Info
 
 from home.users.types import User
+from home.utils import get_user, loaded_resolver
 
 from . import models
 
@@ -37,31 +40,162 @@ class TopicFilter:
     title: strawberry.auto
 
 
-@strawberry_django.type(models.Topic, filters=TopicFilter, order=TopicOrder)
+# 游标分页需要读取排序字段，嵌套的连接在优化器 only 之前就生成了游标，所以在类型上声明这些字段总是加载
+@strawberry_django.type(
+    models.Topic,
+    filters=TopicFilter,
+    order=TopicOrder,
+    only=["created_at", "edited_at", "is_closed", "is_pinned", "active_at"],
+)
 class Topic(relay.Node):
     title: strawberry.auto
     description: strawberry.auto
+    description_html: strawberry.auto
+    description_plain: strawberry.auto
     is_closed: strawberry.auto
     closed_at: strawberry.auto
     user: User
     created_at: strawberry.auto
     edited_at: strawberry.auto
     is_pinned: strawberry.auto
-    comments: strawberry_django.relay.DjangoListConnection["Comment"] = strawberry_django.connection(
+    active_at: strawberry.auto
+    comment_count: strawberry.auto
+    last_comment: Optional["Comment"]
+    comments: strawberry_django.relay.DjangoCursorConnection["Comment"] = strawberry_django.connection(
         filters=CommentFilter, order=CommentOrder
     )
+    revisions: strawberry_django.relay.DjangoCursorConnection["TopicRevision"] = strawberry_django.connection(
+        description="说明修改前的版本，从新到旧排列"
+    )
 
-    @classmethod
-    def get_queryset(cls, queryset, info, **kwargs):
-        return queryset.annotate(active_at=Greatest(Max("comments__created_at"), "edited_at"))
-
-
-@strawberry_django.type(models.Comment, filters=CommentFilter, order=CommentOrder)
+    # 列表中通过子查询注解一次获取，单独返回的话题（如修改后）才需要额外查询
+    @strawberry_django.field(annotate={"unread_count": lambda info: models.unread_count(get_user(info.context))})
+    async def unread_count(self, info: Info) -> int:
+        """当前用户未读的评论数"""
+        if not hasattr(self, "unread_count"):
+            user = get_user(info.context)
+            return (await models.Topic.objects.filter(pk=self.pk).values_list(models.unread_count(user)).aget())[0]  # type: ignore
+        return self.unread_count  # type: ignore
+
+    @strawberry_django.field(annotate={"has_unread": lambda info: models.has_unread(get_user(info.context))})
+    async def has_unread(self, info: Info) -> bool:
+        """当前用户是否有未读的评论"""
+        if not hasattr(self, "has_unread"):
+            user = get_user(info.context)
+            return (await models.Topic.objects.filter(pk=self.pk).values_list(models.has_unread(user)).aget())[0]  # type: ignore
+        return self.has_unread  # type: ignore
+
+
+@strawberry_django.type(models.Comment, filters=CommentFilter, order=CommentOrder, only=["created_at"])
 class Comment(relay.Node):
     topic: Topic
     user: User
     body: strawberry.auto
+    body_html: strawberry.auto
+    body_plain: strawberry.auto
     created_at: strawberry.auto
     edited_at: strawberry.auto
     parent: Optional["Comment"]
     reply_to: User | None
+    revisions: strawberry_django.relay.DjangoCursorConnection["CommentRevision"] = strawberry_django.connection(
+        description="内容修改前的版本，从新到旧排列"
+    )
+
+
+@strawberry_django.type(models.TopicRevision, only=["number"])
+class TopicRevision(relay.Node):
+    number: strawberry.auto
+    created_at: strawberry.auto
+
+    @classmethod
+    def get_queryset(cls, queryset, info, **kwargs):
+        # 历史版本从新到旧排列
+        return queryset.order_by("-number")
+
+    @strawberry_django.field(only=["topic_id", "number", "is_snapshot", "data"])
+    @loaded_resolver("text")
+    def description(self) -> str:
+        return self.text  # type: ignore
+
+
+@strawberry_django.type(models.CommentRevision, only=["number"])
+class CommentRevision(relay.Node):
+    number: strawberry.auto
+    created_at: strawberry.auto
+
+    @classmethod
+    def get_queryset(cls, queryset, info, **kwargs):
+        # 历史版本从新到旧排列
+        return queryset.order_by("-number")
+
+    @strawberry_django.field(only=["comment_id", "number", "is_snapshot", "data"])
+    @loaded_resolver("text")
+    def body(self) -> str:
+        return self.text  # type: ignore
+
+
+@strawberry.type
+class CommentTreeNode:
+    """评论树中的节点"""
+
+    comment: Comment
+
+    @strawberry.field
+    def children(self) -> list["CommentTreeNode"]:
+        return [CommentTreeNode(comment=child) for child in self.comment.get_children()]  # type: ignore
+
+
+@strawberry.type
+class BoardSearchResult:
+    """搜索结果，匹配评论时 comment 不为空"""
+
+    topic: Topic
+    comment: Comment | None
+    rank: float
+    snippet: str = strawberry.field(description="关键词附近的内容，关键词用 <mark> 标出，已转义 HTML")
+
+
+@strawberry.type
+class ArchivedComment:
+    id: int
+    user: User | None
+    body: str
+    created_at: datetime
+    edited_at: datetime
+    parent_id: int | None
+    reply_to: User | None
+
+
+@strawberry_django.type(models.ArchivedTopic, only=["archived_at"])
+class ArchivedTopic(relay.Node):
+    topic_id: strawberry.auto
+    title: strawberry.auto
+    user: User
+    created_at: strawberry.auto
+    closed_at: strawberry.auto
+    archived_at: strawberry.auto
+    comment_count: strawberry.auto
+
+    @strawberry_django.field(only=["data"])
+    @loaded_resolver("data")
+    def description(self) -> str:
+        return self.content["topic"]["description"]  # type: ignore
+
+    @strawberry_django.field(only=["data"])
+    def comments(self) -> list[ArchivedComment]:
+        """按回复关系的先序排列，评论者一次查询获取"""
+        comments = self.content["comments"]  # type: ignore
+        user_ids = {comment["user_id"] for comment in comments} | {comment["reply_to_id"] for comment in comments}
+        users = get_user_model().objects.in_bulk(user_ids - {None})
+        return [
+            ArchivedComment(
+                id=comment["id"],
+                user=users.get(comment["user_id"]),  # type: ignore
+                body=comment["body"],
+                created_at=parse_datetime(comment["created_at"]),  # type: ignore
+                edited_at=parse_datetime(comment["edited_at"]),  # type: ignore
+                parent_id=comment["parent_id"],
+                reply_to=users.get(comment["reply_to_id"]),  # type: ignore
+            )
+            for comment in comments
+        ]
@@ -1,8 +1,20 @@
 """https://stackoverflow.com/a/54923798"""
 
+import hashlib
+import html
+import json
+import re
+import threading
+import zlib
+from difflib import SequenceMatcher
 from io import StringIO
+from typing import Any, NamedTuple
+from urllib.parse import urlsplit
 
-from markdown import Markdown
+from django.core.serializers.json import DjangoJSONEncoder
+from markdown import Markdown, util
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
 
 
 def unmark_element(element, stream=None):
@@ -19,9 +31,125 @@ def unmark_element(element, stream=None):
 
 # patching Markdown
 Markdown.output_formats["plain"] = unmark_element  # type: ignore
-__md = Markdown(output_format="plain")  # type: ignore
-__md.stripTopLevelTags = False  # type: ignore
+
+# 链接与图片允许使用的协议，没有协议的相对地址也允许
+SAFE_URL_SCHEMES = {"http", "https", "mailto"}
+# 浏览器解析地址时会忽略的空白与控制字符
+_IGNORED_URL_CHARS = re.compile(r"[\x00-\x20\x7f]")
+
+
+def is_safe_url(url: str) -> bool:
+    """地址是否没有使用 javascript: 等不安全的协议"""
+    url = html.unescape(url.replace(util.AMP_SUBSTITUTE, "&"))
+    scheme = urlsplit(_IGNORED_URL_CHARS.sub("", url)).scheme
+    return not scheme or scheme.lower() in SAFE_URL_SCHEMES
+
+
+class SafeUrlProcessor(Treeprocessor):
+    """移除使用不安全协议的链接与图片地址"""
+
+    def run(self, root):
+        for element in root.iter():
+            for attr in ("href", "src"):
+                url = element.get(attr)
+                if url is not None and not is_safe_url(url):
+                    del element.attrib[attr]
+
+
+class EscapeHtmlExtension(Extension):
+    """转义内容中的原始 HTML
+
+    渲染结果会直接展示在页面中，不能允许用户插入脚本等任意标签
+    """
+
+    def extendMarkdown(self, md):
+        md.preprocessors.deregister("html_block")
+        md.inlinePatterns.deregister("html")
+        md.treeprocessors.register(SafeUrlProcessor(md), "safe_url", 0)
+
+
+# Markdown 实例在转换时会保存状态，不能在多个线程间共享
+# 每个线程各自持有一份实例
+_local = threading.local()
+
+
+def _get_markdown(output_format: str) -> Markdown:
+    md = getattr(_local, output_format, None)
+    if md is None:
+        md = Markdown(output_format=output_format, extensions=[EscapeHtmlExtension()])  # type: ignore
+        if output_format == "plain":
+            md.stripTopLevelTags = False  # type: ignore
+        setattr(_local, output_format, md)
+    return md.reset()
 
 
 def unmark(text):
-    return __md.convert(text)
+    """转换为纯文本
+
+    代码等内容在渲染时会被转义，纯文本不会作为 HTML 展示，需要还原
+    """
+    return html.unescape(_get_markdown("plain").convert(text))
+
+
+def markdown_to_html(text):
+    return _get_markdown("html").convert(text)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class Rendered(NamedTuple):
+    hash: str
+    html: str
+    plain: str
+
+
+def render_markdown(text: str) -> Rendered:
+    return Rendered(content_hash(text), markdown_to_html(text), unmark(text))
+
+
+def update_rendered(instance, field: str) -> bool:
+    """更新模型中缓存的渲染结果
+
+    渲染结果保存在 {field}_hash, {field}_html, {field}_plain 三个字段中，
+    仅当内容摘要变化时才重新渲染，返回是否重新渲染
+    """
+    text = getattr(instance, field) or ""
+    if getattr(instance, f"{field}_hash") == content_hash(text):
+        return False
+    rendered = render_markdown(text)
+    setattr(instance, f"{field}_hash", rendered.hash)
+    setattr(instance, f"{field}_html", rendered.html)
+    setattr(instance, f"{field}_plain", rendered.plain)
+    return True
+
+
+def compress(data: Any) -> bytes:
+    """序列化为 JSON 并压缩"""
+    return zlib.compress(json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False).encode())
+
+
+def decompress(data: bytes) -> Any:
+    return json.loads(zlib.decompress(data))
+
+
+def make_delta(old: str, new: str) -> list[list[int] | str]:
+    """按行生成从 old 到 new 的差异
+
+    [开始, 结束] 表示复制 old 中对应的行，字符串表示新插入的内容
+    """
+    a = old.splitlines(keepends=True)
+    b = new.splitlines(keepends=True)
+    delta: list[list[int] | str] = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == "equal":
+            delta.append([i1, i2])
+        elif j1 < j2:
+            delta.append("".join(b[j1:j2]))
+    return delta
+
+
+def apply_delta(old: str, delta: list[list[int] | str]) -> str:
+    lines = old.splitlines(keepends=True)
+    return "".join(op if isinstance(op, str) else "".join(lines[op[0] : op[1]]) for op in delta)
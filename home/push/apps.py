@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class PushConfig(AppConfig):
     name = "home.push"
     verbose_name = "推送"
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .health import CacheHealthStore
+        from .mipush.APIHostSwitch import ServerSwitch
+
+        # 服务器的熔断状态在所有 worker 之间共享
+        ServerSwitch().set_health_store(CacheHealthStore())
@@ -0,0 +1,47 @@
+"""推送服务器的健康状态
+
+小米推送 SDK 默认在进程内记录各服务器连续失败的次数与熔断状态，
+每个 Celery worker 进程各自判断。这里改为保存在 Django 的默认缓存中，
+配置 Redis 时所有进程共享，一个进程发现服务器故障后其他进程也会避开。
+"""
+
+import time
+
+from django.core.cache import cache
+
+# 失败次数在这段时间（秒）内没有新的失败则清零
+FAILURES_TIMEOUT = 10 * 60
+
+
+def failures_key(host: str) -> str:
+    return f"push:host:{host}:failures"
+
+
+def open_key(host: str) -> str:
+    return f"push:host:{host}:open_until"
+
+
+class CacheHealthStore:
+    """使用 Django 缓存保存服务器的健康状态"""
+
+    def record_failure(self, host: str) -> int:
+        key = failures_key(host)
+        cache.add(key, 0, FAILURES_TIMEOUT)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # 在 add 与 incr 之间过期
+            cache.set(key, 1, FAILURES_TIMEOUT)
+            return 1
+
+    def reset(self, host: str):
+        cache.delete_many([failures_key(host), open_key(host)])
+
+    def open(self, host: str, until: float):
+        # 熔断结束后自动过期
+        cache.set(open_key(host), until, max(until - time.time(), 0) + 1)
+
+    def open_hosts(self, hosts: list[str]) -> set[str]:
+        now = time.time()
+        values = cache.get_many([open_key(host) for host in hosts])
+        return {host for host in hosts if values.get(open_key(host), 0) > now}
@@ -27,6 +27,12 @@ class Constants:
     max_message_length = 140
     auto_switch_host = True
     access_timeout = 5000
+    # 连接池大小
+    max_connections = 100
+    max_keepalive_connections = 20
+    # 熔断: 同一个host连续失败次数达到阈值后, 在reset时间(秒)内不再请求该host
+    circuit_breaker_threshold = 5
+    circuit_breaker_reset_timeout = 30
     http_protocol = "https"
 
     """
@@ -1,11 +1,12 @@
+import bisect
+import itertools
 import random
 import time
-from functools import reduce
-from threading import Lock
 
 from .APIConstants import Constants
 
-lock = Lock()
+# 权重范围分成的区间数, 权重越过区间边界或到达上下限时才重新计算前缀和
+PRIORITY_BANDS = 4
 
 
 class Singleton(type):
@@ -23,6 +24,42 @@ class Singleton(type):
         return cls._instance
 
 
+class LocalHealthStore:
+    """
+    host健康状态(熔断)存储, 默认保存在进程内
+    需要在多个进程间共享时, 通过 ServerSwitch().set_health_store 替换为实现了相同方法的存储
+    """
+
+    def __init__(self):
+        self._failures = {}
+        self._open_until = {}
+
+    def record_failure(self, host):
+        """
+        记录一次失败, 返回连续失败次数
+        """
+        failures = self._failures.get(host, 0) + 1
+        self._failures[host] = failures
+        return failures
+
+    def reset(self, host):
+        self._failures.pop(host, None)
+        self._open_until.pop(host, None)
+
+    def open(self, host, until):
+        """
+        打开熔断, 直到 until(时间戳)
+        """
+        self._open_until[host] = until
+
+    def open_hosts(self, hosts):
+        """
+        返回熔断中的host集合
+        """
+        now = time.time()
+        return {host for host in hosts if self._open_until.get(host, 0) > now}
+
+
 class Server:
     """
     服务model(包含host, 最小权重, 最大权重, 权重速率)
@@ -35,28 +72,61 @@ class Server:
         self.max_priority = max_priority
         self.decr_step = decr_step
         self.incr_step = incr_step
+        # 本进程记录过失败, 成功后才需要清除健康状态
+        self.failed = False
+
+    def is_available(self):
+        """
+        熔断打开期间不可用, 超过reset时间后放行请求(半开), 再次失败则重新打开
+        """
+        return not ServerSwitch().health_store.open_hosts([self.host])
+
+    def record_success(self):
+        """
+        只在之前失败过时清除, 大部分请求成功时不需要访问健康状态存储
+        其他进程记录的失败次数在一段时间没有新的失败后自动清零
+        """
+        if self.failed:
+            self.failed = False
+            ServerSwitch().health_store.reset(self.host)
+
+    def record_failure(self):
+        self.failed = True
+        store = ServerSwitch().health_store
+        if store.record_failure(self.host) >= Constants.circuit_breaker_threshold:
+            store.open(self.host, time.time() + Constants.circuit_breaker_reset_timeout)
 
     def incr_priority(self):
-        self.__change_priority(True, self.incr_step)
+        self.__change_priority(self.priority + self.incr_step)
 
     def decr_priority(self):
-        self.__change_priority(False, self.decr_step)
+        self.__change_priority(self.priority - self.decr_step)
 
-    def __change_priority(self, incr, step):
-        lock.acquire()
-        change_priority = self.priority + step if incr else self.priority - step
-        if change_priority < self.min_priority:
-            change_priority = self.min_priority
-        elif change_priority > self.max_priority:
-            change_priority = self.max_priority
-        self.priority = change_priority
-        lock.release()
+    def __change_priority(self, priority):
+        # 不加锁: 权重只是选择host的参考, 并发修改时丢失一次调整没有影响
+        priority = min(max(priority, self.min_priority), self.max_priority)
+        if priority == self.priority:
+            return
+        crossed = (
+            priority in (self.min_priority, self.max_priority)
+            or self.__band(priority) != self.__band(self.priority)
+        )
+        self.priority = priority
+        if crossed:
+            ServerSwitch().invalidate()
+
+    def __band(self, priority):
+        if self.max_priority <= self.min_priority:
+            return 0
+        return (priority - self.min_priority) * PRIORITY_BANDS // (
+            self.max_priority - self.min_priority
+        )
 
 
 class ServerSwitch(metaclass=Singleton):
     """
     服务host选举类(单例)
-    加权轮询算法
+    加权随机算法: 预先计算权重的前缀和, 选择时二分查找
     """
 
     def __init__(self):
@@ -66,9 +136,15 @@ class ServerSwitch(metaclass=Singleton):
         self.emq = Server(Constants.host_emq, 100, 100, 0, 0)
         self.default_server = Server(Constants.host_production, 1, 90, 10, 5)
         self.servers = []
+        self.health_store = LocalHealthStore()
+        # (servers, 前缀和), 整体替换, 读取时不需要加锁
+        self._table = None
         self.inited = False
         self.last_refresh_time = time.time()
 
+    def set_health_store(self, store):
+        self.health_store = store
+
     def need_refresh_host_list(self):
         return (
             not self.inited
@@ -77,47 +153,83 @@ class ServerSwitch(metaclass=Singleton):
         )
 
     def initialize(self, host_list):
+        """
+        使用服务端返回的host列表替换当前列表, 相同的host只保留一个
+        已有的host保留当前权重
+        """
         if not self.need_refresh_host_list():
             return
-        vs = host_list.split(",")
-        for s in vs:
+        known = {server.host: server for server in self.servers}
+        servers = {}
+        for s in host_list.split(","):
             sp = s.split(":")
             if len(sp) < 5:
-                self.servers.append(self.default_server)
+                servers[self.default_server.host] = self.default_server
                 continue
-            self.servers.append(
-                Server(sp[0], int(sp[1]), int(sp[2]), int(sp[3]), int(sp[4]))
+            host = sp[0]
+            server = known.get(host) or Server(
+                host, int(sp[1]), int(sp[2]), int(sp[3]), int(sp[4])
             )
+            server.min_priority, server.max_priority = int(sp[1]), int(sp[2])
+            server.decr_step, server.incr_step = int(sp[3]), int(sp[4])
+            servers[host] = server
 
+        self.servers = list(servers.values())
+        self.invalidate()
         self.inited = True
         self.last_refresh_time = time.time()
 
-    def select_server(self, request_path):
-        if Constants.host:
-            return self.specified
+    def invalidate(self):
+        """
+        权重或host列表变化后重新计算前缀和
+        """
+        self._table = None
 
-        if Constants.is_sandbox:
-            return self.sandbox
+    def _get_table(self):
+        table = self._table
+        if table is None:
+            servers = tuple(self.servers)
+            table = (servers, list(itertools.accumulate(s.priority for s in servers)))
+            self._table = table
+        return table
 
-        if len(request_path) == 2:
-            if request_path[1] == 2:
-                return self.feedback
-            if request_path[1] == 3:
-                return self.emq
+    def select_server(self, request_path):
+        return self.select_available_server(request_path)[0]
+
+    def select_available_server(self, request_path):
+        """
+        返回 (server, 是否可用)
+        加权选择时已经查询过熔断状态, 直接使用该结果, 不需要再调用 server.is_available
+        """
+        if Constants.host:
+            server = self.specified
+        elif Constants.is_sandbox:
+            server = self.sandbox
+        elif len(request_path) == 2 and request_path[1] == 2:
+            server = self.feedback
+        elif len(request_path) == 2 and request_path[1] == 3:
+            server = self.emq
+        else:
             return self.__select_server()
-        return self.__select_server()
+        return server, server.is_available()
 
     def __select_server(self):
         if not Constants.auto_switch_host:
-            return self.default_server
-
-        priority_list = [sever.priority for sever in self.servers]
-        all_priority = reduce(lambda x, y: x + [x[-1] + y], priority_list, [0])[-1]
-        random_point = random.randint(0, all_priority)
-
-        priority_sum = 0
-        for index, priority in enumerate(priority_list):
-            priority_sum += priority
-            if random_point <= priority_sum:
-                return self.servers[index]
-        return self.default_server
+            return self.default_server, self.default_server.is_available()
+
+        servers, cumulative = self._get_table()
+        if not servers or cumulative[-1] <= 0:
+            return self.default_server, self.default_server.is_available()
+
+        open_hosts = self.health_store.open_hosts([s.host for s in servers])
+        # 全部熔断时照常选择, 请求时直接失败
+        available = len(open_hosts) < len(servers)
+        if open_hosts and available:
+            # 跳过熔断中的host, 只在这种情况下临时计算
+            servers = tuple(s for s in servers if s.host not in open_hosts)
+            cumulative = list(itertools.accumulate(s.priority for s in servers))
+            if cumulative[-1] <= 0:
+                return servers[0], True
+
+        point = random.random() * cumulative[-1]
+        return servers[bisect.bisect_right(cumulative, point)], available
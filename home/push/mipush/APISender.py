@@ -26,6 +26,18 @@ class APISender(Base):
             Constants.request_path.V3_REGID_MESSAGE, retry_times, **push_message
         )
 
+    async def asend(self, push_message, reg_id, retry_times=3):
+        """
+        发送reg_id消息(异步)
+        :param push_message: 消息体(请求参数对象)
+        :param reg_id: reg_id(多个reg_id - list)
+        :param retry_times: 重试次数
+        """
+        push_message[Constants.http_param_registration_id] = reg_id
+        return await self._atry_http_request(
+            Constants.request_path.V3_REGID_MESSAGE, retry_times, **push_message
+        )
+
     def send_to_alias(self, push_message, alias, retry_times=3):
         """
         发送alias消息
@@ -1,15 +1,57 @@
+import asyncio
+import collections
 import json
 import logging
+import random
+import threading
 import time
 import typing
-import urllib.error
 import urllib.parse
-import urllib.request
+import weakref
+
+import httpx
 
 from .APIError import APIError
 from .APIHostSwitch import *
 
-_MAX_BACKOFF_DELAY = 1024000
+# 两次重试之间最长等待的秒数, 同步发送时会阻塞当前线程
+_MAX_BACKOFF_DELAY = 4
+
+# 请求计数(进程内), 键为 名称 与 名称:host
+# request/success/error/retry/circuit_open
+# 会在多个线程中同时更新, 读写都需要持有 _metrics_lock, 读取使用 metrics_snapshot
+metrics = collections.Counter()
+_metrics_lock = threading.Lock()
+
+
+def _count(name, host=None):
+    with _metrics_lock:
+        metrics[name] += 1
+        if host:
+            metrics["%s:%s" % (name, host)] += 1
+
+
+def metrics_snapshot():
+    """
+    请求计数的副本
+    """
+    with _metrics_lock:
+        return dict(metrics)
+
+
+def _backoff(try_time):
+    """
+    指数退避(带随机抖动)
+    """
+    return random.uniform(0, min(_MAX_BACKOFF_DELAY, 2 ** try_time))
+
+try:
+    import h2  # noqa: F401
+
+    _HTTP2 = True
+except ImportError:
+    # 未安装 h2 时使用 HTTP/1.1
+    _HTTP2 = False
 
 
 class JsonDict(dict):
@@ -42,40 +84,42 @@ def _build_request_url(server, request_path):
     return Constants.http_protocol + "://" + server.host + request_path[0]
 
 
-def _http_call(url, method, authorization, token, **kw):
+def _build_http_request(url, method, authorization, token, **kw):
     """
     :param url: http request url
     :param method: http request method
     :param authorization: push authorization
     :param kw: params
+    :return: (method, url, headers, body)
     """
-    params = urllib.parse.urlencode(_encode_params(**kw)).encode("utf-8")
-    http_url = f"{url}?{params}" if method == Constants.__HTTP_GET__ else url
-    http_body = None if method == Constants.__HTTP_GET__ else params
-    req = urllib.request.Request(http_url, data=http_body)
+    params = urllib.parse.urlencode(_encode_params(**kw))
+    if method == Constants.__HTTP_GET__:
+        http_method, http_url, http_body = "GET", f"{url}?{params}", None
+    else:
+        http_method, http_url, http_body = "POST", url, params.encode("utf-8")
+    headers = {"Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"}
     if authorization:
-        req.add_header("Authorization", "key=%s" % authorization)
+        headers["Authorization"] = "key=%s" % authorization
     if token:
-        req.add_header("X-PUSH-AUDIT-TOKEN", token)
+        headers["X-PUSH-AUDIT-TOKEN"] = token
     if Constants.auto_switch_host and ServerSwitch().need_refresh_host_list():
-        req.add_header("X-PUSH-HOST-LIST", "true")
-    req.add_header("Content-Type", "application/x-www-form-urlencoded;charset=UTF-8")
-    try:
-        resp = urllib.request.urlopen(req, timeout=5)
-        headers = resp.getheaders()
-        host_list = None
-        for header in headers:
-            if header[0] == "X-PUSH-HOST-LIST":
-                host_list = header[1]
-        if host_list:
-            ServerSwitch().initialize(host_list)
-        r = _parse_json(resp.read().decode())
-        if hasattr(r, "code"):
-            if r.code != 0:
-                raise APIError(r.code, r.get("description", ""), r.get("reason", ""))
-        return r
-    except urllib.error.URLError as e:
-        raise APIError("-5", e.read(), "http error")
+        headers["X-PUSH-HOST-LIST"] = "true"
+    return http_method, http_url, headers, http_body
+
+
+def _handle_response(resp):
+    """
+    :param resp: httpx.Response
+    """
+    resp.raise_for_status()
+    host_list = resp.headers.get("X-PUSH-HOST-LIST")
+    if host_list:
+        ServerSwitch().initialize(host_list)
+    r = _parse_json(resp.text)
+    if hasattr(r, "code"):
+        if r.code != 0:
+            raise APIError(r.code, r.get("description", ""), r.get("reason", ""))
+    return r
 
 
 def _encode_params(**kw):
@@ -95,21 +139,113 @@ def _encode_params(**kw):
 
 
 class Base:
-    def __init__(self, security, token=None):
+    """
+    连接池由 httpx 维护, 同一个 host 的请求复用连接
+    构造方法可选参数:
+    @:param timeout 超时时间(秒), 默认为 Constants.access_timeout, 也可以传入 httpx.Timeout
+    @:param transport 自定义 httpx transport(测试时使用)
+    """
+
+    def __init__(self, security, token=None, timeout=None, transport=None):
         self.security = security
         self.token = token
         self.proxy_ip = None
         self.proxy_port = None
         self.proxy = False
+        if timeout is None:
+            timeout = Constants.access_timeout / 1000
+        self.timeout = timeout
+        self.transport = transport
+        self._client = None
+        # AsyncClient 不能跨事件循环使用, 每个事件循环各自持有一个
+        self._async_clients = weakref.WeakKeyDictionary()
 
     def set_proxy(self, proxy_ip, proxy_port):
         self.proxy_ip = proxy_ip
         self.proxy_port = proxy_port
         self.proxy = True
+        self.close()
 
     def set_token(self, token):
         self.token = token
 
+    def set_timeout(self, timeout):
+        self.timeout = timeout
+        self.close()
+
+    def _client_kwargs(self):
+        kwargs = {
+            "timeout": self.timeout,
+            "http2": _HTTP2,
+            "limits": httpx.Limits(
+                max_connections=Constants.max_connections,
+                max_keepalive_connections=Constants.max_keepalive_connections,
+            ),
+        }
+        if self.proxy:
+            kwargs["proxy"] = f"http://{self.proxy_ip}:{self.proxy_port}"
+        if self.transport:
+            kwargs["transport"] = self.transport
+        return kwargs
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.Client(**self._client_kwargs())
+        return self._client
+
+    @property
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(**self._client_kwargs())
+            self._async_clients[loop] = client
+        return client
+
+    def close(self):
+        """
+        关闭连接池, 之后的请求会重新创建
+        异步连接池需要在各自的事件循环中关闭, 这里提交到对应的事件循环执行,
+        事件循环已关闭时连接随之释放. 需要等待关闭完成时在事件循环中调用 aclose
+        """
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        clients, self._async_clients = self._async_clients, weakref.WeakKeyDictionary()
+        for loop, client in list(clients.items()):
+            if not loop.is_closed():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+
+    async def aclose(self):
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    def _http_call(self, url, method, **kw):
+        http_method, http_url, headers, http_body = _build_http_request(
+            url, method, self.security, self.token, **kw
+        )
+        try:
+            resp = self.client.request(
+                http_method, http_url, headers=headers, content=http_body
+            )
+            return _handle_response(resp)
+        except httpx.HTTPError as e:
+            raise APIError("-5", str(e), "http error")
+
+    async def _ahttp_call(self, url, method, **kw):
+        http_method, http_url, headers, http_body = _build_http_request(
+            url, method, self.security, self.token, **kw
+        )
+        try:
+            resp = await self.async_client.request(
+                http_method, http_url, headers=headers, content=http_body
+            )
+            return _handle_response(resp)
+        except httpx.HTTPError as e:
+            raise APIError("-5", str(e), "http error")
+
     def _call_request(self, request_path, method, **kw):
         """
         call http request(include auto select server)
@@ -118,24 +254,60 @@ class Base:
         :param kw: params
         """
         start = time.time()
-        server = ServerSwitch().select_server(request_path)
-        self.build_proxy()
+        server, available = ServerSwitch().select_available_server(request_path)
+        self._check_circuit(server, available)
         request_url = _build_request_url(server, request_path)
         try:
-            ret = _http_call(request_url, method, self.security, self.token, **kw)
-            if time.time() - start > 5:
-                server.decr_priority()
-            else:
-                server.incr_priority()
+            ret = self._http_call(request_url, method, **kw)
+            self._feedback(server, start)
             return ret
         except APIError as ex:
-            logging.error(
-                "%s request: [%s] error [%s]"
-                % (Constants.http_protocol, request_url, ex)
-            )
-            server.decr_priority()
+            self._on_error(server, request_url, ex)
+            raise ex
+
+    async def _acall_request(self, request_path, method, **kw):
+        start = time.time()
+        server, available = ServerSwitch().select_available_server(request_path)
+        self._check_circuit(server, available)
+        request_url = _build_request_url(server, request_path)
+        try:
+            ret = await self._ahttp_call(request_url, method, **kw)
+            self._feedback(server, start)
+            return ret
+        except APIError as ex:
+            self._on_error(server, request_url, ex)
             raise ex
 
+    @staticmethod
+    def _check_circuit(server, available):
+        """
+        host熔断时直接失败, 不发送请求
+        """
+        _count("request", server.host)
+        if not available:
+            _count("circuit_open", server.host)
+            raise APIError("-6", "circuit open for %s" % server.host, "circuit breaker")
+
+    @staticmethod
+    def _feedback(server, start):
+        _count("success", server.host)
+        server.record_success()
+        if time.time() - start > 5:
+            server.decr_priority()
+        else:
+            server.incr_priority()
+
+    @staticmethod
+    def _on_error(server, request_url, ex):
+        logging.error(
+            "%s request: [%s] error [%s]" % (Constants.http_protocol, request_url, ex)
+        )
+        _count("error", server.host)
+        # 服务端返回的业务错误(如reg_id无效)不算host故障
+        if ex.error_code == "-5":
+            server.record_failure()
+        server.decr_priority()
+
     def http_post(self, request_path, **kw):
         logging.info("POST %s" % request_path[0])
         return self._call_request(request_path, Constants.__HTTP_POST__, **kw)
@@ -144,43 +316,72 @@ class Base:
         logging.info("GET %s" % request_path[0])
         return self._call_request(request_path, Constants.__HTTP_GET__, **kw)
 
-    def build_proxy(self):
-        if self.proxy:
-            opener = urllib.request.build_opener(
-                urllib.request.ProxyHandler({f"{self.proxy_ip}:{self.proxy_port}"}),
-                urllib.request.HTTPHandler(debuglevel=1),
-            )
-            urllib.request.install_opener(opener)
+    async def ahttp_post(self, request_path, **kw):
+        logging.info("POST %s" % request_path[0])
+        return await self._acall_request(request_path, Constants.__HTTP_POST__, **kw)
+
+    async def ahttp_get(self, request_path, **kw):
+        logging.info("GET %s" % request_path[0])
+        return await self._acall_request(request_path, Constants.__HTTP_GET__, **kw)
 
     def _try_http_request(
         self, request_path, retry_times, method=Constants.__HTTP_POST__, **kw
     ):
-        is_fail, try_time, result, sleep_time = True, 0, None, 1
-        while is_fail and try_time < retry_times:
+        """
+        只有网络错误(-5)才会重试, 两次尝试之间按指数退避等待
+        retry_times 为 1 时不重试也不等待, 由调用方(如 Celery 任务)自行安排重试
+        """
+        try_time = 0
+        while True:
             try:
                 if method == Constants.__HTTP_POST__:
-                    result = self.http_post(request_path, **kw)
+                    return self.http_post(request_path, **kw)
                 elif method == Constants.__HTTP_GET__:
-                    result = self.http_get(request_path, **kw)
-                else:
-                    raise APIError(
-                        "-2", "not support %s http request" % method, "http error"
-                    )
-                is_fail = False
+                    return self.http_get(request_path, **kw)
+                raise APIError(
+                    "-2", "not support %s http request" % method, "http error"
+                )
             except APIError as ex:
-                """
-                URLError failure retry
-                """
-                if ex.error_code == "-5":
-                    is_fail = True
-                logging.error(
-                    "code:[%s] - description:[%s] - reason:[%s]"
-                    % (ex.error_code, ex.error, ex.request)
+                try_time += 1
+                if not self._should_retry(ex, try_time, retry_times):
+                    raise
+            time.sleep(_backoff(try_time))
+
+    async def _atry_http_request(
+        self, request_path, retry_times, method=Constants.__HTTP_POST__, **kw
+    ):
+        """
+        _try_http_request 的异步版本, 等待重试时不阻塞事件循环
+        """
+        try_time = 0
+        while True:
+            try:
+                if method == Constants.__HTTP_POST__:
+                    return await self.ahttp_post(request_path, **kw)
+                elif method == Constants.__HTTP_GET__:
+                    return await self.ahttp_get(request_path, **kw)
+                raise APIError(
+                    "-2", "not support %s http request" % method, "http error"
                 )
+            except APIError as ex:
                 try_time += 1
-                time.sleep(sleep_time)
-                if 2 * sleep_time < _MAX_BACKOFF_DELAY:
-                    sleep_time *= 2
-        if not result:
-            raise APIError("-3", "retry %s time failure" % retry_times, "request error")
-        return result
+                if not self._should_retry(ex, try_time, retry_times):
+                    raise
+            await asyncio.sleep(_backoff(try_time))
+
+    @staticmethod
+    def _should_retry(ex, try_time, retry_times):
+        logging.error(
+            "code:[%s] - description:[%s] - reason:[%s]"
+            % (ex.error_code, ex.error, ex.request)
+        )
+        if ex.error_code != "-5":
+            return False
+        if try_time >= retry_times:
+            if retry_times > 1:
+                raise APIError(
+                    "-3", "retry %s time failure" % retry_times, "request error"
+                ) from ex
+            return False
+        _count("retry")
+        return True
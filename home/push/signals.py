@@ -0,0 +1,16 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import MiPush
+from .tasks import invalidate_enable_devices
+
+
+@receiver([post_save, post_delete], sender=MiPush)
+def mipush_changed(sender, **kwargs):
+    """设备变化后启用的设备缓存失效
+
+    提交前后各删除一次，避免提交前其他请求缓存了旧数据
+    """
+    invalidate_enable_devices()
+    transaction.on_commit(invalidate_enable_devices)
@@ -1,23 +1,67 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
 from celery import shared_task
+from celery.utils.time import get_exponential_backoff_interval
 from django.conf import settings
-from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from home.utils import is_shared_cache
 
+from .mipush.APIError import APIError
 from .mipush.APIMessage import Constants, PushMessage
 from .mipush.APISender import APISender
+from .mipush.APISenderBase import metrics_snapshot
+from .models import MiPush
+
+logger = logging.getLogger("push")
 
 sender = APISender(settings.MI_PUSH_APP_SECRET)
 
+# 每次请求最多包含的设备数
+# <https://dev.mi.com/console/doc/detail?pId=1278#_2_1>
+MAX_REG_IDS_PER_REQUEST = 1000
+# 同时发送的请求数
+MAX_CONCURRENT_REQUESTS = 8
+# 重试间隔（秒），每次翻倍并随机抖动，最长不超过 RETRY_BACKOFF_MAX
+RETRY_BACKOFF = 5
+RETRY_BACKOFF_MAX = 300
+# 可以重试的错误码：网络错误（-5）与服务器熔断中（-6），其他错误重试也不会成功
+RETRYABLE_ERROR_CODES = {"-5", "-6"}
+
+
+# 启用推送的设备缓存在默认缓存中，设备保存或删除时失效（见 signals.py）
+# 只在配置了 Redis 等多个进程共享的缓存时缓存，进程内缓存无法在其他进程中失效
+ENABLE_DEVICES_CACHE_KEY = "push:enable_devices"
+ENABLE_DEVICES_CACHE_TIMEOUT = 60 * 60
+
+
+def get_enable_devices() -> list[tuple[int, str]]:
+    """获取所有启用的设备的用户 ID 与设备标识码
+
+    一次查询获取，不需要加载用户
+    """
+    shared = is_shared_cache()
+    devices = cache.get(ENABLE_DEVICES_CACHE_KEY) if shared else None
+    if devices is None:
+        devices = list(MiPush.objects.filter(enable=True).order_by("pk").values_list("user_id", "reg_id"))
+        if shared:
+            cache.set(ENABLE_DEVICES_CACHE_KEY, devices, ENABLE_DEVICES_CACHE_TIMEOUT)
+    return devices
+
+
+def invalidate_enable_devices():
+    cache.delete(ENABLE_DEVICES_CACHE_KEY)
+
 
 def get_enable_reg_ids() -> list[str]:
     """获取所有启用的设备标识码"""
-    users = get_user_model().objects.exclude(mipush__enable=False)
-    return [mipush.reg_id for user in users for mipush in user.mipush.all()]  # type: ignore
+    return [reg_id for _, reg_id in get_enable_devices()]
 
 
 def get_enable_reg_ids_except_user(user) -> list[str]:
     """获取除指定用户的所有启用的设备标识码"""
-    users = get_user_model().objects.exclude(pk=user.id).exclude(mipush__enable=False)
-    return [mipush.reg_id for user in users for mipush in user.mipush.all()]  # type: ignore
+    return [reg_id for user_id, reg_id in get_enable_devices() if user_id != user.id]
 
 
 def build_message(
@@ -56,8 +100,37 @@ def build_message(
     return message
 
 
-@shared_task(max_retries=3, default_retry_delay=5)
+def split_reg_ids(reg_ids: list[str], size: int = MAX_REG_IDS_PER_REQUEST) -> list[list[str]]:
+    """将设备标识码按每次请求的上限分批"""
+    return [reg_ids[i : i + size] for i in range(0, len(reg_ids), size)]
+
+
+def is_retryable(error: APIError) -> bool:
+    return str(error.error_code) in RETRYABLE_ERROR_CODES
+
+
+def send_batches(message: dict, batches: list[list[str]]) -> list:
+    """同时发送多批消息
+
+    返回每批的结果，推送服务返回错误的批次对应的是 APIError，其他异常直接抛出
+    """
+
+    def send(batch: list[str]):
+        # 请求失败时由任务重试，这里不再重试
+        try:
+            return sender.send(dict(message), ",".join(batch), retry_times=1)
+        except APIError as e:
+            return e
+
+    if len(batches) == 1:
+        return [send(batches[0])]
+    with ThreadPoolExecutor(max_workers=min(len(batches), MAX_CONCURRENT_REQUESTS)) as executor:
+        return list(executor.map(send, batches))
+
+
+@shared_task(bind=True, max_retries=5)
 def push_to_users(
+    self,
     reg_ids: list[str],
     title: str,
     description: str,
@@ -68,10 +141,32 @@ def push_to_users(
 
     支持向一个或多个用户推送消息
 
-    根据 regids, 发送消息到指定的一组设备上, regids 的个数不得超过 1000 个。
+    根据 regids, 发送消息到指定的一组设备上, 每次请求的 regids 不得超过 1000 个。
     <https://dev.mi.com/console/doc/detail?pId=1278#_2_1>
+    超过时分批同时发送，只重试因为网络错误或者熔断失败的批次，其他错误只记录日志。
+    重试通过 Celery 延后执行，不占用 worker 等待。
     """
-    if settings.MI_PUSH_APP_SECRET:
-        message = build_message(title, description, payload, is_important)
-        return sender.send(message.message_dict(), ",".join(reg_ids))
-    return "未设置 MI_PUSH_APP_SECRET，不推送"
+    if not settings.MI_PUSH_APP_SECRET:
+        return "未设置 MI_PUSH_APP_SECRET，不推送"
+
+    message = build_message(title, description, payload, is_important).message_dict()
+    batches = split_reg_ids(reg_ids)
+    results = send_batches(message, batches)
+
+    errors = [(batch, result) for batch, result in zip(batches, results, strict=True) if isinstance(result, APIError)]
+    rejected = [(batch, error) for batch, error in errors if not is_retryable(error)]
+    if rejected:
+        logger.error(f"推送失败 {len(rejected)}/{len(batches)} 批，不再重试：{rejected[0][1]}")
+    failed = [(batch, error) for batch, error in errors if is_retryable(error)]
+    if failed:
+        logger.warning(f"推送失败 {len(failed)}/{len(batches)} 批：{failed[0][1]}，统计：{metrics_snapshot()}")
+        failed_reg_ids = [reg_id for batch, _ in failed for reg_id in batch]
+        raise self.retry(
+            args=[failed_reg_ids, title, description, payload, is_important],
+            kwargs={},
+            exc=failed[0][1],
+            countdown=get_exponential_backoff_interval(
+                RETRY_BACKOFF, self.request.retries, RETRY_BACKOFF_MAX, full_jitter=True
+            ),
+        )
+    return [str(result) if isinstance(result, APIError) else result for result in results]
@@ -1,7 +1,11 @@
+import asyncio
 from unittest import mock
+from urllib.parse import parse_qs
 
+import httpx
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from strawberry import relay
 
 from home.push.tasks import (
@@ -12,6 +16,12 @@ from home.push.tasks import (
 from home.tests import GraphQLTestCase
 
 from . import types
+from .health import CacheHealthStore, failures_key, open_key
+from .mipush.APIConstants import Constants
+from .mipush.APIError import APIError
+from .mipush.APIHostSwitch import LocalHealthStore, ServerSwitch
+from .mipush.APISender import APISender
+from .mipush.APISenderBase import _MAX_BACKOFF_DELAY, _backoff, metrics
 from .models import MiPush
 from .tasks import push_to_users, sender
 
@@ -305,6 +315,62 @@ class DisabledPushTests(TestCase):
         reg_ids = get_enable_reg_ids_except_user(self.user)
         self.assertEqual(set(reg_ids), {"regidofuser2", "regid2ofuser2"})
 
+    def test_get_enable_reg_ids_partially_disabled(self):
+        """用户禁用了部分设备时，仍然推送给启用的设备"""
+        MiPush.objects.create(
+            user=self.user, enable=True, reg_id="regid2ofuser1", device_id="deviceid2ofuser1", model="model"
+        )
+
+        with self.assertNumQueries(1):
+            reg_ids = get_enable_reg_ids()
+        self.assertEqual(set(reg_ids), {"regid2ofuser1", "regidofuser2", "regid2ofuser2"})
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class EnableDevicesCacheTests(GraphQLTestCase):
+    fixtures = ["users", "push"]
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.get(username="test")
+        self.client.authenticate(self.user)
+        # 当作多个进程共享的缓存
+        patcher = mock.patch("home.push.tasks.is_shared_cache", return_value=True)
+        self.shared = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_not_shared(self):
+        """进程内缓存无法在其他进程中失效，不缓存"""
+        self.shared.return_value = False
+        get_enable_reg_ids()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_enable_reg_ids(), ["regidofuser1", "regid2ofuser1"])
+
+    def test_cache(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_enable_reg_ids(), ["regidofuser1", "regid2ofuser1"])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_enable_reg_ids_except_user(self.user), ["regidofuser1", "regid2ofuser1"])
+
+        # 更新设备后缓存失效
+        mutation = """
+            mutation updateMiPush($input: UpdateMiPushInput!) {
+                updateMiPush(input: $input) {
+                    ... on MiPush {
+                        regId
+                    }
+                }
+            }
+        """
+        variables = {"input": {"regId": "testRegId", "deviceId": "deviceidofuser1", "model": "modelofuser1"}}
+        self.client.execute(mutation, variables)
+
+        self.assertEqual(get_enable_reg_ids(), ["testRegId", "regid2ofuser1"])
+        self.assertEqual(get_enable_reg_ids_except_user(self.user), ["regid2ofuser1"])
+
+        MiPush.objects.get(reg_id="regid2ofuser1").delete()
+        self.assertEqual(get_enable_reg_ids(), ["testRegId"])
+
 
 class MiPushMessageTest(TestCase):
     fixtures = ["users", "push"]
@@ -363,3 +429,279 @@ class TaskTests(TestCase):
             push_to_users(["1"], "title", "description", "/board")
 
             self.assertFalse(mock_send.call_args_list)
+
+    @mock.patch.object(sender, "send", side_effect=lambda message, reg_id, retry_times: {"reg_id": reg_id})
+    def test_push_to_users_in_batches(self, mock_send):
+        """超过 1000 个设备时分批推送"""
+        reg_ids = [f"regid{i}" for i in range(2500)]
+
+        results = push_to_users(reg_ids, "title", "description", "/board")
+
+        self.assertEqual(mock_send.call_count, 3)
+        sent = sorted((call.args[1].split(",") for call in mock_send.call_args_list), key=len, reverse=True)
+        self.assertEqual([len(batch) for batch in sent], [1000, 1000, 500])
+        self.assertEqual(sorted(reg_id for batch in sent for reg_id in batch), sorted(reg_ids))
+        # 结果与批次顺序一致
+        self.assertEqual(results[2], {"reg_id": ",".join(reg_ids[2000:])})
+
+    def test_push_to_users_retry_failed_batches(self):
+        """只重试失败的批次"""
+        reg_ids = [f"regid{i}" for i in range(2500)]
+        calls = []
+
+        def send(message, reg_id, retry_times):
+            calls.append(reg_id)
+            if reg_id.startswith("regid1000,") and calls.count(reg_id) == 1:
+                raise APIError("-5", "timeout", "http error")
+            return {"reg_id": reg_id}
+
+        with (
+            mock.patch.object(sender, "send", side_effect=send),
+            mock.patch("home.push.tasks.get_exponential_backoff_interval", return_value=3) as mock_backoff,
+            self.assertLogs("push", level="WARNING"),
+        ):
+            result = push_to_users.apply(args=[reg_ids, "title", "description", "/board"])
+
+        # 重试间隔按重试次数指数增长并随机抖动
+        mock_backoff.assert_called_once_with(5, 0, 300, full_jitter=True)
+
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(calls[-1], ",".join(reg_ids[1000:2000]))
+        self.assertEqual(result.get(), [{"reg_id": ",".join(reg_ids[1000:2000])}])
+
+    def test_push_to_users_not_retry_rejected(self):
+        """推送服务拒绝的批次不重试，只记录日志"""
+
+        def send(message, reg_id, retry_times):
+            if reg_id == "regid1":
+                raise APIError(10017, "失败", "测试")
+            return {"reg_id": reg_id}
+
+        with (
+            mock.patch.object(sender, "send", side_effect=send) as mock_send,
+            self.assertLogs("push", level="ERROR"),
+        ):
+            result = push_to_users.apply(args=[["regid1"], "title", "description", "/board"])
+
+        mock_send.assert_called_once()
+        self.assertEqual(result.get(), ["APIError: 10017: 失败, request: 测试"])
+
+    @mock.patch.object(sender, "send", side_effect=TypeError("错误"))
+    def test_push_to_users_unexpected_error(self, mock_send):
+        """其他异常不当作推送失败重试"""
+        result = push_to_users.apply(args=[["regid1"], "title", "description", "/board"])
+
+        self.assertIsInstance(result.result, TypeError)
+        mock_send.assert_called_once()
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class TransportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.requests: list[httpx.Request] = []
+
+        def handler(request: httpx.Request):
+            self.requests.append(request)
+            if b"timeout" in request.content:
+                raise httpx.ConnectError("连接失败", request=request)
+            if b"fail" in request.content:
+                return httpx.Response(200, json={"code": 10017, "description": "失败", "reason": "测试"})
+            return httpx.Response(200, json={"code": 0, "result": "ok", "data": {"id": "1"}})
+
+        self.sender = APISender("secret", transport=httpx.MockTransport(handler))
+        self.server = ServerSwitch().default_server
+        self.addCleanup(self.server.record_success)
+
+    def test_send(self):
+        """同一个发送者复用连接池"""
+        message = build_message("title", "description", "/board", False).message_dict()
+
+        result = self.sender.send(message, "regid1,regid2")
+        self.sender.send(message, "regid3")
+
+        self.assertEqual(result.result, "ok")
+        self.assertEqual(len(self.requests), 2)
+        request = self.requests[0]
+        self.assertEqual(request.method, "POST")
+        self.assertEqual(request.url.path, "/v3/message/regid")
+        self.assertEqual(request.headers["Authorization"], "key=secret")
+        self.assertEqual(parse_qs(request.content.decode())["registration_id"], ["regid1,regid2"])
+        self.assertIs(self.sender.client, self.sender.client)
+
+    async def test_asend(self):
+        message = build_message("title", "description", "/board", False).message_dict()
+
+        result = await self.sender.asend(message, "regid1")
+        await self.sender.aclose()
+
+        self.assertEqual(result.data.id, "1")
+        self.assertEqual(parse_qs(self.requests[0].content.decode())["registration_id"], ["regid1"])
+
+    async def test_close_async_client(self):
+        """close 同样会关闭事件循环中的异步连接池"""
+        client = self.sender.async_client
+
+        self.sender.close()
+        # 关闭在事件循环的下一轮执行
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+        self.assertTrue(client.is_closed)
+        self.assertIsNot(self.sender.async_client, client)
+        await self.sender.aclose()
+
+    @mock.patch("home.push.mipush.APISenderBase.time.sleep")
+    def test_send_error(self, mock_sleep):
+        """服务端返回错误时不重试"""
+        message = build_message("fail", "description", "/board", False).message_dict()
+
+        with self.assertRaises(APIError) as context, self.assertLogs(level="ERROR"):
+            self.sender.send(message, "regid1", retry_times=3)
+
+        self.assertEqual(context.exception.error_code, 10017)
+        self.assertEqual(len(self.requests), 1)
+        mock_sleep.assert_not_called()
+
+    @mock.patch("home.push.mipush.APISenderBase.time.sleep")
+    def test_send_network_error(self, mock_sleep):
+        """网络错误时等待后重试，只尝试一次时不等待"""
+        message = build_message("timeout", "description", "/board", False).message_dict()
+
+        with self.assertRaises(APIError) as context, self.assertLogs(level="ERROR"):
+            self.sender.send(message, "regid1", retry_times=3)
+
+        self.assertEqual(context.exception.error_code, "-3")
+        self.assertEqual(len(self.requests), 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        # 退避时间随机，但不超过 2 的尝试次数次方
+        for (delay,), upper in zip((call.args for call in mock_sleep.call_args_list), [2, 4], strict=True):
+            self.assertLessEqual(delay, upper)
+
+        with self.assertRaises(APIError) as context, self.assertLogs(level="ERROR"):
+            self.sender.send(message, "regid1", retry_times=1)
+        self.assertEqual(context.exception.error_code, "-5")
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    def test_backoff_limit(self):
+        """重试的等待时间有上限，不会长时间阻塞发送的线程"""
+        with mock.patch("home.push.mipush.APISenderBase.random.uniform", side_effect=lambda a, b: b):
+            self.assertEqual(_backoff(1), 2)
+            self.assertEqual(_backoff(20), _MAX_BACKOFF_DELAY)
+
+    def test_circuit_breaker(self):
+        """同一个 host 连续失败后熔断，一段时间后再放行"""
+        message = build_message("timeout", "description", "/board", False).message_dict()
+        open_before = metrics["circuit_open"]
+
+        with self.assertLogs(level="ERROR"):
+            for _ in range(Constants.circuit_breaker_threshold):
+                with self.assertRaises(APIError):
+                    self.sender.send(dict(message), "regid1", retry_times=1)
+            with self.assertRaises(APIError) as context:
+                self.sender.send(dict(message), "regid1", retry_times=1)
+
+        self.assertEqual(context.exception.error_code, "-6")
+        self.assertEqual(len(self.requests), Constants.circuit_breaker_threshold)
+        self.assertEqual(metrics["circuit_open"], open_before + 1)
+
+        # 熔断状态保存在缓存中，其他进程同样可以看到
+        self.assertEqual(CacheHealthStore().open_hosts([self.server.host, "other"]), {self.server.host})
+
+        # 超过重置时间后放行，成功后关闭
+        cache.delete(open_key(self.server.host))
+        message = build_message("title", "description", "/board", False).message_dict()
+        self.assertEqual(self.sender.send(message, "regid1", retry_times=1).result, "ok")
+        self.assertIsNone(cache.get(failures_key(self.server.host)))
+
+    def test_health_store_round_trips(self):
+        """成功的请求只在选择 host 时查询一次熔断状态"""
+        message = build_message("title", "description", "/board", False).message_dict()
+        store = ServerSwitch().health_store
+        self.assertIsInstance(store, CacheHealthStore)
+
+        with (
+            mock.patch.object(store, "open_hosts", wraps=store.open_hosts) as open_hosts,
+            mock.patch.object(store, "reset", wraps=store.reset) as reset,
+        ):
+            self.sender.send(message, "regid1", retry_times=1)
+
+        open_hosts.assert_called_once()
+        reset.assert_not_called()
+
+
+class ServerSwitchTests(TestCase):
+    def setUp(self):
+        self.switch = ServerSwitch()
+        store, servers, inited = self.switch.health_store, self.switch.servers, self.switch.inited
+
+        def restore():
+            self.switch.health_store, self.switch.servers, self.switch.inited = store, servers, inited
+            self.switch.invalidate()
+
+        self.addCleanup(restore)
+        self.switch.set_health_store(LocalHealthStore())
+        self.switch.inited = False
+        self.switch.initialize("a.com:1:90:10:5,b.com:1:10:10:5,a.com:1:90:10:5,invalid")
+
+    def select(self):
+        return self.switch.select_server(Constants.request_path.V3_REGID_MESSAGE).host
+
+    def test_initialize(self):
+        """刷新时替换 host 列表并去重，已有的 host 保留权重"""
+        self.assertEqual([server.host for server in self.switch.servers], ["a.com", "b.com", Constants.host_production])
+        a = self.switch.servers[0]
+        a.decr_priority()
+
+        self.switch.inited = False
+        self.switch.initialize("a.com:1:90:10:5,c.com:1:50:10:5")
+
+        self.assertEqual([server.host for server in self.switch.servers], ["a.com", "c.com"])
+        self.assertIs(self.switch.servers[0], a)
+        self.assertEqual(a.priority, 80)
+
+    def test_select_server(self):
+        """按权重选择 host，权重变化后重新计算"""
+        # 权重分别为 90、10、90
+        with mock.patch("home.push.mipush.APIHostSwitch.random.random", return_value=0.5):
+            self.assertEqual(self.select(), "b.com")
+        with mock.patch("home.push.mipush.APIHostSwitch.random.random", return_value=0.0):
+            self.assertEqual(self.select(), "a.com")
+
+        self.switch.servers[0].decr_priority()
+        with mock.patch("home.push.mipush.APIHostSwitch.random.random", return_value=0.5):
+            # 权重变为 80、10、90，中点落在第三个 host
+            self.assertEqual(self.select(), Constants.host_production)
+
+    def test_priority_band(self):
+        """权重在同一个区间内变化时不重新计算前缀和"""
+        a = self.switch.servers[0]
+        a.decr_priority()
+        table = self.switch._get_table()
+
+        # 权重 1 到 90 分为 4 个区间，80、85 与 75 在同一个区间内
+        a.incr_priority()
+        a.decr_priority()
+        self.assertEqual(a.priority, 75)
+        self.assertIs(self.switch._get_table(), table)
+
+        a.decr_priority()
+        self.assertIsNot(self.switch._get_table(), table)
+
+    def test_skip_open_host(self):
+        """跳过熔断中的 host"""
+        for _ in range(Constants.circuit_breaker_threshold):
+            self.switch.servers[0].record_failure()
+
+        hosts = set()
+        for value in [0.0, 0.3, 0.6, 0.99]:
+            with mock.patch("home.push.mipush.APIHostSwitch.random.random", return_value=value):
+                hosts.add(self.select())
+        self.assertEqual(hosts, {"b.com", Constants.host_production})
+        self.assertFalse(self.switch.servers[0].is_available())
+
+        # 全部熔断时照常选择，请求时直接失败
+        for server in self.switch.servers[1:]:
+            for _ in range(Constants.circuit_breaker_threshold):
+                server.record_failure()
+        self.assertIn(self.select(), {"a.com", "b.com", Constants.host_production})
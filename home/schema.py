@@ -6,6 +6,7 @@ import home.board.schema
 import home.push.schema
 import home.storage.schema
 import home.users.schema
+from home.board.cache import FrontPageCache
 
 Query = merge_types(
     "Query",
@@ -25,11 +26,22 @@ Mutation = merge_types(
         home.push.schema.Mutation,
     ),
 )
+Subscription = merge_types(
+    "Subscription",
+    (
+        home.storage.schema.Subscription,
+        home.board.schema.Subscription,
+    ),
+)
 
 
 schema = strawberry.Schema(
     query=Query,
     mutation=Mutation,
+    subscription=Subscription,
     # https://strawberry-graphql.github.io/strawberry-django/guide/optimizer/
-    extensions=[DjangoOptimizerExtension],
+    # 使用 only 时，自定义解析器需要通过 only/select_related 声明用到的字段，
+    # 不然异步执行时访问未加载的字段会在事件循环中查询数据库
+    # FrontPageCache 缓存话题列表的查询结果
+    extensions=[DjangoOptimizerExtension(), FrontPageCache],
 )
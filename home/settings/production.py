@@ -52,6 +52,18 @@ ADMINS = list(
     )
 )
 
+# Cache
+# https://docs.djangoproject.com/zh-hans/5.2/topics/cache/#redis
+# 未配置 Redis 时使用默认的进程内缓存
+
+if os.getenv("CACHE_REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("CACHE_REDIS_URL"),
+        }
+    }
+
 # Celery
 # https://docs.celeryproject.org/en/stable/getting-started/brokers/redis.html
 
@@ -94,6 +94,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     # 数据相关
     "mptt",
     "django_celery_beat",
@@ -209,6 +210,15 @@ LOGIN_URL = "/admin/"
 
 MPTT_DEFAULT_LEVEL_INDICATOR = "--"
 
+# Cache
+# https://docs.djangoproject.com/zh-hans/5.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
 # Celery
 # https://docs.celeryproject.org/en/stable/getting-started/brokers/redis.html
 
@@ -237,6 +247,16 @@ MI_PUSH_APP_ID = "app_id"
 MI_PUSH_APP_KEY = "app_key"
 MI_PUSH_APP_SECRET = "app_secret"
 
+# 物品管理
+
+# 已删除物品的保留天数，超过后会被彻底删除
+DELETED_ITEM_RETENTION_DAYS = 30
+
+# 留言板
+
+# 话题关闭超过该天数后会被归档
+ARCHIVE_CLOSED_TOPICS_AFTER_DAYS = 180
+
 # Files
 # https://docs.djangoproject.com/zh-hans/3.1/topics/files/
 
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Item, Picture, Storage
+from .models import DailyExpiryDigest, Item, Picture, Storage
 
 
 class StorageAdmin(admin.ModelAdmin):
@@ -33,13 +33,23 @@ class ItemAdmin(admin.ModelAdmin):
         "created_at",
         "created_by",
     )
+    list_filter = ("is_deleted",)
     search_fields = ["name", "description"]
 
+    def get_queryset(self, request):
+        # 后台需要能看到已删除的物品
+        return Item.all_objects.all()
+
     @admin.display(description="耗材")
     def get_consumables(self, obj):
         return "\n".join([p.name for p in obj.consumables.all()])
 
 
+class DailyExpiryDigestAdmin(admin.ModelAdmin):
+    list_display = ("created_at", "expired", "today", "week", "month")
+
+
 admin.site.register(Storage, StorageAdmin)
 admin.site.register(Item, ItemAdmin)
 admin.site.register(Picture, PictureAdmin)
+admin.site.register(DailyExpiryDigest, DailyExpiryDigestAdmin)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class StorageConfig(AppConfig):
     name = "home.storage"
     verbose_name = "存储管理"
+
+    def ready(self):
+        from . import signals  # noqa: F401
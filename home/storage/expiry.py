@@ -0,0 +1,98 @@
+"""物品过期提醒
+
+即将过期的物品通过 expired_at 上的部分索引（仅包含未删除的物品）查询，
+每日摘要在一次聚合查询中统计各个时间段内过期的物品数量。
+摘要由定时任务每天生成并保存，查询时读取最近一次的结果。
+"""
+
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+
+from django.db.models import Count, Q, QuerySet
+from django.utils import timezone
+
+from .models import DailyExpiryDigest, Item
+
+# 摘要的生成间隔，已过期的物品只统计这段时间内过期的，每个物品只提醒一次
+DIGEST_INTERVAL = timedelta(days=1)
+# 摘要中统计的时间段
+DIGEST_BUCKETS = (
+    ("today", timedelta(days=1)),
+    ("week", timedelta(days=7)),
+    ("month", timedelta(days=30)),
+)
+
+
+@dataclass
+class ExpiryDigest:
+    expired: int
+    today: int
+    week: int
+    month: int
+    created_at: datetime
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.expired or self.today or self.week or self.month)
+
+    def __str__(self) -> str:
+        parts = [f"{self.expired} 个物品过去一天内过期"] if self.expired else []
+        for label, count in (("今天", self.today), ("一周内", self.week), ("一个月内", self.month)):
+            if count:
+                parts.append(f"{count} 个物品{label}过期")
+        return "，".join(parts)
+
+
+def expiring_items(within: timedelta) -> QuerySet[Item]:
+    """在指定时间内过期的物品，不包括已经过期的物品
+
+    按过期时间从近到远排序
+    """
+    now = timezone.now()
+    return Item.objects.filter(expired_at__gte=now, expired_at__lte=now + within).order_by("expired_at", "id")
+
+
+def expiry_digest() -> ExpiryDigest:
+    """统计过去一天内过期与各时间段内过期的物品数量
+
+    时间段之间不重叠，一周内不包括今天过期的物品
+    """
+    now = timezone.now()
+    expired_after = now - DIGEST_INTERVAL
+    aggregates = {"expired": Count("id", filter=Q(expired_at__lt=now))}
+    start = now
+    for name, delta in DIGEST_BUCKETS:
+        aggregates[name] = Count("id", filter=Q(expired_at__gte=start, expired_at__lt=now + delta))
+        start = now + delta
+    # 只扫描索引中从上一次摘要到最后一个时间段的部分
+    counts = Item.objects.filter(expired_at__gte=expired_after, expired_at__lt=start).aggregate(**aggregates)
+    return ExpiryDigest(**counts, created_at=now)
+
+
+def save_expiry_digest() -> ExpiryDigest:
+    """生成并保存今天的摘要，只保留最近一次的结果"""
+    digest = expiry_digest()
+    record = DailyExpiryDigest.objects.create(**asdict(digest))
+    DailyExpiryDigest.objects.exclude(pk=record.pk).delete()
+    return digest
+
+
+def latest_expiry_digest() -> ExpiryDigest:
+    """最近一次保存的摘要
+
+    超过生成间隔还没有新的摘要时（如未配置定时任务），实时统计一次
+    """
+    record = (
+        DailyExpiryDigest.objects.filter(created_at__gt=timezone.now() - DIGEST_INTERVAL)
+        .order_by("-created_at")
+        .first()
+    )
+    if record is None:
+        return expiry_digest()
+    return ExpiryDigest(
+        expired=record.expired,
+        today=record.today,
+        week=record.week,
+        month=record.month,
+        created_at=record.created_at,
+    )
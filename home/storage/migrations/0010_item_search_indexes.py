@@ -0,0 +1,37 @@
+from django.db import migrations
+
+# 表名，字段名，索引名
+TRIGRAM_INDEXES = [
+    ("storage_item", "name", "storage_item_name_trgm"),
+    ("storage_item", "description", "storage_item_description_trgm"),
+    ("storage_storage", "name", "storage_storage_name_trgm"),
+]
+
+
+def create_trigram_indexes(apps, schema_editor):
+    """创建 pg_trgm 扩展与 GIN 索引
+
+    仅支持 PostgreSQL，其他数据库直接跳过
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for table, column, name in TRIGRAM_INDEXES:
+        schema_editor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin ({column} gin_trgm_ops)")
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for _, _, name in TRIGRAM_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("storage", "0009_remove_name_unique_constraint"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, reverse_code=drop_trigram_indexes),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:40
+
+from django.db import migrations, models
+
+
+def fill_ancestor_path(apps, schema_editor):
+    """按树的顺序填充已有位置的祖先路径"""
+    Storage = apps.get_model("storage", "Storage")
+    paths = {}
+    storages = list(Storage.objects.order_by("tree_id", "lft"))
+    for storage in storages:
+        storage.ancestor_path = paths[storage.parent_id] if storage.parent_id else []
+        paths[storage.id] = [*storage.ancestor_path, {"id": storage.id, "name": storage.name}]
+    Storage.objects.bulk_update(storages, ["ancestor_path"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("storage", "0010_item_search_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="storage",
+            name="ancestor_path",
+            field=models.JSONField(blank=True, default=list, editable=False, verbose_name="祖先路径"),
+        ),
+        migrations.RunPython(fill_ancestor_path, reverse_code=migrations.RunPython.noop),
+    ]
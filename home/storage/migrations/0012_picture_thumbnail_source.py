@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("storage", "0011_storage_ancestor_path"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="picture",
+            name="thumbnail_source",
+            field=models.CharField(blank=True, editable=False, max_length=100, verbose_name="缩略图来源"),
+        ),
+    ]
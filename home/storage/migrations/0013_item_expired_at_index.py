@@ -0,0 +1,20 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("storage", "0012_picture_thumbnail_source"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                condition=models.Q(("is_deleted", False)), fields=["expired_at"], name="storage_item_expired_at_alive"
+            ),
+        ),
+    ]
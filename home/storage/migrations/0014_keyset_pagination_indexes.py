@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("storage", "0013_item_expired_at_index"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name="item",
+            options={"ordering": ["name", "id"], "verbose_name": "物品", "verbose_name_plural": "物品"},
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(fields=["name", "id"], name="storage_item_name_id"),
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(fields=["edited_at", "id"], name="storage_item_edited_at_id"),
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(fields=["created_at", "id"], name="storage_item_created_at_id"),
+        ),
+    ]
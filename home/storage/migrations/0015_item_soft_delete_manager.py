@@ -0,0 +1,97 @@
+# Generated by Django 5.2.8 on 2026-10-18 02:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+# 物品的三元组索引，见 0010_item_search_indexes
+ITEM_TRIGRAM_INDEXES = [
+    ("name", "storage_item_name_trgm"),
+    ("description", "storage_item_description_trgm"),
+]
+
+
+def make_trigram_indexes_partial(apps, schema_editor):
+    """搜索只会查询未删除的物品，重建为仅包含未删除物品的部分索引"""
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for column, name in ITEM_TRIGRAM_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {name}")
+        schema_editor.execute(
+            f"CREATE INDEX {name} ON storage_item USING gin ({column} gin_trgm_ops) WHERE NOT is_deleted"
+        )
+
+
+def make_trigram_indexes_full(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for column, name in ITEM_TRIGRAM_INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {name}")
+        schema_editor.execute(f"CREATE INDEX {name} ON storage_item USING gin ({column} gin_trgm_ops)")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("storage", "0014_keyset_pagination_indexes"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(make_trigram_indexes_partial, reverse_code=make_trigram_indexes_full),
+        migrations.AlterModelOptions(
+            name="item",
+            options={
+                "default_manager_name": "objects",
+                "ordering": ["name", "id"],
+                "verbose_name": "物品",
+                "verbose_name_plural": "物品",
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name="item",
+            name="storage_item_name_id",
+        ),
+        migrations.RemoveIndex(
+            model_name="item",
+            name="storage_item_edited_at_id",
+        ),
+        migrations.RemoveIndex(
+            model_name="item",
+            name="storage_item_created_at_id",
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                condition=models.Q(("is_deleted", False)), fields=["name", "id"], name="storage_item_name_id_alive"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                condition=models.Q(("is_deleted", False)),
+                fields=["edited_at", "id"],
+                name="storage_item_edited_id_alive",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                condition=models.Q(("is_deleted", False)),
+                fields=["created_at", "id"],
+                name="storage_item_created_id_alive",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                condition=models.Q(("is_deleted", False)),
+                fields=["storage", "name", "id"],
+                name="storage_item_storage_alive",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="item",
+            index=models.Index(
+                condition=models.Q(("is_deleted", True)), fields=["deleted_at"], name="storage_item_deleted_at_dead"
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("storage", "0015_item_soft_delete_manager"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyExpiryDigest",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("expired", models.PositiveIntegerField(verbose_name="过去一天内过期")),
+                ("today", models.PositiveIntegerField(verbose_name="今天过期")),
+                ("week", models.PositiveIntegerField(verbose_name="一周内过期")),
+                ("month", models.PositiveIntegerField(verbose_name="一个月内过期")),
+                ("created_at", models.DateTimeField(verbose_name="生成时间")),
+            ],
+            options={
+                "verbose_name": "每日过期摘要",
+                "verbose_name_plural": "每日过期摘要",
+                "get_latest_by": "created_at",
+            },
+        ),
+    ]
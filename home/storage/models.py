@@ -4,9 +4,32 @@ import uuid
 from django.conf import settings
 from django.db import models
 from django.utils import timezone
+from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey
 
 
+class StorageManager(TreeManager):
+    def rebuild(self, *args, **kwargs):
+        """根据 parent 重建树之后同步更新祖先路径
+
+        通过 QuerySet.update 修改 parent 时不会经过 save，需要之后调用 rebuild
+        """
+        super().rebuild(*args, **kwargs)
+        self.rebuild_paths()
+
+    def rebuild_paths(self):
+        """根据 parent 重新计算所有位置的祖先路径
+
+        位置不多，直接按先序遍历全部计算一遍，父节点总是在子节点之前
+        """
+        storages = list(self.order_by("tree_id", "lft"))
+        paths: dict[int, list[dict]] = {}
+        for storage in storages:
+            storage.ancestor_path = paths[storage.parent_id] if storage.parent_id else []  # type: ignore
+            paths[storage.pk] = storage.path
+        self.bulk_update(storages, ["ancestor_path"])
+
+
 class Storage(MPTTModel):
     id = models.AutoField("ID", primary_key=True, auto_created=True)
     name = models.CharField("名字", max_length=200)
@@ -19,11 +42,41 @@ class Storage(MPTTModel):
         blank=True,
     )
     description = models.CharField("备注", max_length=200, blank=True)
+    # 从根节点到父节点的 ID 与名字，例如 [{"id": 1, "name": "阳台"}]
+    # 用于渲染位置路径，避免逐级查询父节点
+    ancestor_path = models.JSONField("祖先路径", default=list, blank=True, editable=False)
+
+    objects = StorageManager()
 
     @property
     def ancestors(self):
         return self.get_ancestors()
 
+    @property
+    def path(self) -> list[dict]:
+        """从根节点到当前节点的路径"""
+        return [*self.ancestor_path, {"id": self.id, "name": self.name}]
+
+    def save(self, *args, **kwargs):
+        old = None
+        if self.pk:
+            old = Storage.objects.filter(pk=self.pk).values("name", "ancestor_path").first()
+
+        self.ancestor_path = self.parent.path if self.parent else []
+        super().save(*args, **kwargs)
+
+        # 名字或者位置发生变化时，同步更新所有子孙节点的路径
+        if old and (old["name"] != self.name or old["ancestor_path"] != self.ancestor_path):
+            self.update_descendant_paths()
+
+    def update_descendant_paths(self):
+        paths = {self.id: self.path}
+        descendants = list(self.get_descendants().order_by("lft"))
+        for descendant in descendants:
+            descendant.ancestor_path = paths[descendant.parent_id]  # type: ignore
+            paths[descendant.id] = descendant.path
+        Storage.objects.bulk_update(descendants, ["ancestor_path"])
+
     class Meta:  # type: ignore
         verbose_name = "位置"
         verbose_name_plural = "位置"
@@ -35,6 +88,35 @@ class Storage(MPTTModel):
         return self.name
 
 
+class ItemQuerySet(models.QuerySet):
+    # GraphQL 查询默认会排除已删除的物品，需要包括它们时通过 with_deleted 明确标记
+    include_deleted = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone.include_deleted = self.include_deleted
+        return clone
+
+    def with_deleted(self):
+        """标记查询需要包括已删除的物品"""
+        clone = self.all()
+        clone.include_deleted = True
+        return clone
+
+    def alive(self):
+        return self.filter(is_deleted=False)
+
+    def deleted(self):
+        return self.filter(is_deleted=True)
+
+
+class AliveItemManager(models.Manager.from_queryset(ItemQuerySet)):
+    """默认排除已删除的物品"""
+
+    def get_queryset(self):
+        return super().get_queryset().alive()
+
+
 class Item(models.Model):
     id = models.AutoField("ID", primary_key=True, auto_created=True)
     name = models.CharField("名字", max_length=200)
@@ -83,10 +165,42 @@ class Item(models.Model):
         blank=True,
     )
 
+    # 包括已删除的物品，仅用于回收站相关的操作
+    all_objects = ItemQuerySet.as_manager()
+    objects = AliveItemManager()
+
     class Meta:
         verbose_name = "物品"
         verbose_name_plural = "物品"
-        ordering = ["name"]
+        # 关联查询（如位置下的物品、耗材）也会使用默认管理器
+        default_manager_name = "objects"
+        # 排序中包含主键，游标分页时才能唯一确定位置
+        ordering = ["name", "id"]
+        # 默认管理器只查询未删除的物品，所以常用的索引都只包含未删除的物品
+        indexes = [
+            # 游标分页时按 (排序字段, id) 定位
+            models.Index(
+                fields=["name", "id"], condition=models.Q(is_deleted=False), name="storage_item_name_id_alive"
+            ),
+            models.Index(
+                fields=["edited_at", "id"], condition=models.Q(is_deleted=False), name="storage_item_edited_id_alive"
+            ),
+            models.Index(
+                fields=["created_at", "id"], condition=models.Q(is_deleted=False), name="storage_item_created_id_alive"
+            ),
+            models.Index(
+                fields=["storage", "name", "id"],
+                condition=models.Q(is_deleted=False),
+                name="storage_item_storage_alive",
+            ),
+            models.Index(
+                fields=["expired_at"], condition=models.Q(is_deleted=False), name="storage_item_expired_at_alive"
+            ),
+            # 回收站与清理任务只查询已删除的物品
+            models.Index(
+                fields=["deleted_at"], condition=models.Q(is_deleted=True), name="storage_item_deleted_at_dead"
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -96,11 +210,22 @@ class Item(models.Model):
         self.deleted_at = timezone.now()
         self.save()
 
+    async def asoft_delete(self):
+        """delete 的异步版本"""
+        self.is_deleted = True
+        self.deleted_at = timezone.now()
+        await self.asave()
+
     def restore(self):
         self.is_deleted = False
         self.deleted_at = None
         self.save()
 
+    async def arestore(self):
+        self.is_deleted = False
+        self.deleted_at = None
+        await self.asave()
+
 
 def get_file_path(instance, filename):
     """生成独一无二的 ID
@@ -113,6 +238,9 @@ def get_file_path(instance, filename):
 
 
 class Picture(models.Model):
+    # 缩略图根据这些字段生成，变化后需要重新生成
+    THUMBNAIL_FIELDS = frozenset({"picture", "box_x", "box_y", "box_h", "box_w"})
+
     id = models.AutoField("ID", primary_key=True, auto_created=True)
     description = models.CharField(
         "备注",
@@ -145,6 +273,8 @@ class Picture(models.Model):
     box_y = models.FloatField("边界框中心点 Y")
     box_h = models.FloatField("边界框高")
     box_w = models.FloatField("边界框宽")
+    # 生成缩略图时的图片名称，与当前图片不同时说明缩略图还未生成
+    thumbnail_source = models.CharField("缩略图来源", max_length=100, blank=True, editable=False)
 
     class Meta:
         verbose_name = "图片"
@@ -152,3 +282,45 @@ class Picture(models.Model):
 
     def __str__(self):
         return self.description or self.picture.name.split("/")[-1]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录数据库中的值，保存时比较是否需要重新生成缩略图；延迟加载的字段不读取，避免额外的查询
+        if cls.THUMBNAIL_FIELDS <= set(field_names):
+            instance._thumbnail_values = instance.thumbnail_values()
+        return instance
+
+    def thumbnail_values(self) -> tuple:
+        return self.picture.name, self.box_x, self.box_y, self.box_w, self.box_h
+
+    def thumbnail_changed(self) -> bool:
+        """与上次读取或者保存时相比，生成缩略图的字段是否变化，不知道之前的值时视为变化
+
+        同时记录当前的值，在保存后调用
+        """
+        values = self.thumbnail_values()
+        changed = getattr(self, "_thumbnail_values", None) != values
+        self._thumbnail_values = values
+        return changed
+
+
+class DailyExpiryDigest(models.Model):
+    """每日过期摘要
+
+    由定时任务每天生成一次，查询摘要时直接读取，不需要每次重新统计
+    """
+
+    expired = models.PositiveIntegerField("过去一天内过期")
+    today = models.PositiveIntegerField("今天过期")
+    week = models.PositiveIntegerField("一周内过期")
+    month = models.PositiveIntegerField("一个月内过期")
+    created_at = models.DateTimeField("生成时间")
+
+    class Meta:
+        verbose_name = "每日过期摘要"
+        verbose_name_plural = "每日过期摘要"
+        get_latest_by = "created_at"
+
+    def __str__(self):
+        return f"{self.created_at:%Y-%m-%d} 过期摘要"
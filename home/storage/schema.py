@@ -1,26 +1,92 @@
+from collections import defaultdict
+from collections.abc import AsyncGenerator, Iterable
+from dataclasses import asdict
 from datetime import datetime
 
 import strawberry
 import strawberry_django
+from asgiref.sync import sync_to_async
 from django.core.exceptions import ValidationError
+from django.db import models as django_models
+from django.db import transaction
 from django.utils import timezone
 from strawberry import relay
 from strawberry.file_uploads import Upload
 from strawberry.types import Info
 
-from home.utils import IsAuthenticated
+from home.uploads import UploadSlot, check_uploaded, create_upload_slot
+from home.utils import IsAuthenticated, achannel_group_send
 
-from . import models, types
+from . import expiry, models, search, types
+
+
+async def aresolve_nodes[T: django_models.Model](
+    ids: Iterable[relay.GlobalID | None],
+    model: type[T],
+    queryset: django_models.QuerySet[T] | None = None,
+) -> dict[relay.GlobalID, T]:
+    """通过一次查询获取多个 GlobalID 对应的对象
+
+    默认使用模型的默认管理器查询，不存在或者类型不符的 ID 不会出现在结果中
+    """
+    if queryset is None:
+        queryset = model._default_manager.all()
+    type_name = model._meta.object_name
+    valid_ids = {id for id in ids if id and id.type_name == type_name and id.node_id.isdigit()}
+    objs = await queryset.ain_bulk({int(id.node_id) for id in valid_ids})
+    return {id: objs[int(id.node_id)] for id in valid_ids if int(id.node_id) in objs}
+
+
+def item_changed_group(storage_id: int | str | None) -> str:
+    """位置下物品变化的通道层组名"""
+    return f"storage.{storage_id}.items"
+
+
+async def apublish_items_changed(
+    items: Iterable[models.Item], old_storage_ids: dict[int, int | None] | None = None
+) -> None:
+    """通知订阅了物品所在位置的客户端
+
+    每个位置只发送一条包含所有变化物品的消息。
+    物品被移动时，可以通过 old_storage_ids（物品 ID 到原来位置 ID）同时通知原来的位置
+    """
+    old_storage_ids = old_storage_ids or {}
+    groups: dict[int, list[int]] = defaultdict(list)
+    for item in items:
+        for storage_id in {item.storage_id, old_storage_ids.get(item.pk)} - {None}:  # type: ignore
+            groups[storage_id].append(item.pk)  # type: ignore
+    for storage_id, ids in groups.items():
+        await achannel_group_send(item_changed_group(storage_id), {"type": "item.changed", "ids": ids})
+
+
+async def aresolve_consumables(item: models.Item, consumable_ids: list[relay.GlobalID]) -> list[models.Item]:
+    """获取并检查需要添加的耗材"""
+    consumables = await aresolve_nodes(consumable_ids, models.Item)
+    if len(consumables) != len(set(consumable_ids)):
+        raise ValidationError("耗材不存在")
+    # 不能添加自己作为自己的耗材
+    if any(consumable.pk == item.pk for consumable in consumables.values()):
+        raise ValidationError("不能添加自己作为自己的耗材")
+    return list(consumables.values())
 
 
 @strawberry.type
 class Query:
-    item: types.Item = strawberry_django.node(permission_classes=[IsAuthenticated])
-    items: strawberry_django.relay.DjangoListConnection[types.Item] = strawberry_django.connection(
+    @strawberry_django.field(permission_classes=[IsAuthenticated])
+    def item(self, info: Info, id: relay.GlobalID) -> types.Item:
+        """通过 ID 获取物品
+
+        已删除的物品也可以获取，恢复前需要能查看它们
+        """
+        if id.type_name != "Item" or not id.node_id.isdigit():
+            raise ValidationError("物品不存在")
+        return models.Item.all_objects.with_deleted().filter(pk=id.node_id)  # type: ignore
+
+    items: strawberry_django.relay.DjangoCursorConnection[types.Item] = strawberry_django.connection(
         permission_classes=[IsAuthenticated]
     )
     storage: types.Storage = strawberry_django.node(permission_classes=[IsAuthenticated])
-    storages: strawberry_django.relay.DjangoListConnection[types.Storage] = strawberry_django.connection(
+    storages: strawberry_django.relay.DjangoCursorConnection[types.Storage] = strawberry_django.connection(
         permission_classes=[IsAuthenticated]
     )
     picture: types.Picture = strawberry_django.node(permission_classes=[IsAuthenticated])
@@ -28,11 +94,53 @@ class Query:
         permission_classes=[IsAuthenticated]
     )
 
+    @strawberry_django.connection(
+        strawberry_django.relay.DjangoListConnection[types.Item],
+        permission_classes=[IsAuthenticated],
+    )
+    def search_items(self, info: Info, query: str) -> Iterable[models.Item]:
+        """按相似度搜索物品"""
+        return search.search_items(query)
+
+    @strawberry_django.connection(
+        strawberry_django.relay.DjangoCursorConnection[types.Item],
+        permission_classes=[IsAuthenticated],
+    )
+    def deleted_items(self, info: Info) -> Iterable[models.Item]:
+        """已删除的物品，最近删除的排在前面"""
+        return models.Item.all_objects.with_deleted().deleted().order_by("-deleted_at")
+
+    @strawberry_django.connection(
+        strawberry_django.relay.DjangoCursorConnection[types.Item],
+        permission_classes=[IsAuthenticated],
+    )
+    def expiring_items(self, info: Info, within: types.Duration) -> Iterable[models.Item]:  # type: ignore
+        """在指定时间内过期的物品，按过期时间排序"""
+        return expiry.expiring_items(within)
+
+    @strawberry_django.field(permission_classes=[IsAuthenticated])
+    def expiry_digest(self, info: Info) -> types.ExpiryDigest:
+        """最近一次生成的每日过期摘要"""
+        return types.ExpiryDigest(**asdict(expiry.latest_expiry_digest()))
+
+
+@strawberry.type
+class Subscription:
+    @strawberry.subscription(permission_classes=[IsAuthenticated])
+    async def item_changed(self, info: Info, storage_id: relay.GlobalID) -> AsyncGenerator[types.Item]:
+        """位置下的物品被添加、修改、删除或恢复"""
+        ws = info.context["ws"]
+        async with ws.listen_to_channel("item.changed", groups=[item_changed_group(storage_id.node_id)]) as messages:
+            async for message in messages:
+                # 已删除的物品也需要通知，客户端据此移除它
+                async for item in models.Item.all_objects.filter(pk__in=message["ids"]).order_by("pk"):
+                    yield item  # type: ignore
+
 
 @strawberry.type
 class Mutation:
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def add_storage(
+    async def add_storage(
         self,
         info: Info,
         name: str,
@@ -43,17 +151,18 @@ class Mutation:
         if parent_id:
             # 检查上一级位置是否存在
             try:
-                parent = parent_id.resolve_node_sync(info, ensure_type=models.Storage)
+                parent = await parent_id.resolve_node(info, ensure_type=models.Storage)
             except Exception:
                 raise ValidationError("上一级位置不存在")
 
             storage.parent = parent
 
-        storage.save()
+        # 保存时会更新 MPTT 树与下级位置的路径，asave 在线程中执行
+        await storage.asave()
         return storage  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def update_storage(
+    async def update_storage(
         self,
         info: Info,
         id: relay.GlobalID,
@@ -63,7 +172,7 @@ class Mutation:
     ) -> types.Storage:
         # 检查需要修改的位置是否存在
         try:
-            storage = id.resolve_node_sync(info, ensure_type=models.Storage)
+            storage = await id.resolve_node(info, ensure_type=models.Storage)
         except Exception:
             raise ValidationError("无法修改不存在的位置")
 
@@ -78,7 +187,7 @@ class Mutation:
             # 为空则说明是根位置，即 家
             if parent_id:
                 try:
-                    parent = parent_id.resolve_node_sync(info, ensure_type=models.Storage)
+                    parent = await parent_id.resolve_node(info, ensure_type=models.Storage)
                 except Exception:
                     raise ValidationError("上一级位置不存在")
             else:
@@ -86,21 +195,21 @@ class Mutation:
 
             storage.parent = parent
 
-        storage.save()
+        await storage.asave()
         return storage  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def delete_storage(self, info: Info, storage_id: relay.GlobalID) -> types.Storage:
+    async def delete_storage(self, info: Info, storage_id: relay.GlobalID) -> types.Storage:
         try:
-            storage = storage_id.resolve_node_sync(info, ensure_type=models.Storage)
+            storage = await storage_id.resolve_node(info, ensure_type=models.Storage)
         except Exception:
             raise ValidationError("无法删除不存在的位置")
 
-        storage.delete()
+        await storage.adelete()
         return storage  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def add_item(
+    async def add_item(
         self,
         info: Info,
         name: str,
@@ -111,7 +220,7 @@ class Mutation:
         expired_at: datetime | None,
     ) -> types.Item:
         try:
-            storage = storage_id.resolve_node_sync(info, ensure_type=models.Storage)
+            storage = await storage_id.resolve_node(info, ensure_type=models.Storage)
         except Exception:
             raise ValidationError("位置不存在")
 
@@ -129,14 +238,16 @@ class Mutation:
             price=price,
             expired_at=expired_at,
         )
-        item.created_by = info.context.request.user
-        item.edited_by = info.context.request.user
+        user = await info.context.request.auser()
+        item.created_by = user
+        item.edited_by = user
         item.edited_at = timezone.now()
-        item.save()
+        await item.asave()
+        await apublish_items_changed([item])
         return item  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def update_item(
+    async def update_item(
         self,
         info: Info,
         id: relay.GlobalID,
@@ -147,17 +258,18 @@ class Mutation:
         expired_at: datetime | None,
         storage_id: relay.GlobalID | None,
     ) -> types.Item:
-        try:
-            item = id.resolve_node_sync(info, ensure_type=models.Item)
-        except Exception:
+        # 已删除的物品也可以修改
+        item = (await aresolve_nodes([id], models.Item, models.Item.all_objects.all())).get(id)
+        if item is None:
             raise ValidationError("无法修改不存在的物品")
+        old_storage_id = item.storage_id  # type: ignore
 
         if name and name != item.name:
             item.name = name
 
         if storage_id is not strawberry.UNSET and storage_id is not None:
             try:
-                storage = storage_id.resolve_node_sync(info, ensure_type=models.Storage)
+                storage = await storage_id.resolve_node(info, ensure_type=models.Storage)
             except Exception:
                 raise ValidationError("位置不存在")
 
@@ -175,122 +287,298 @@ class Mutation:
         if expired_at is not strawberry.UNSET:
             item.expired_at = expired_at
 
-        item.edited_by = info.context.request.user
+        item.edited_by = await info.context.request.auser()
         item.edited_at = timezone.now()
         # 如果修改已删除的物品，则自动恢复它
         if item.is_deleted:
-            item.restore()
+            await item.arestore()
         else:
-            item.save()
+            await item.asave()
+        await apublish_items_changed([item], {item.pk: old_storage_id})
         return item  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def delete_item(self, info: Info, item_id: relay.GlobalID) -> types.Item:
+    async def delete_item(self, info: Info, item_id: relay.GlobalID) -> types.Item:
         try:
-            item = item_id.resolve_node_sync(info, ensure_type=models.Item)
+            item = await item_id.resolve_node(info, ensure_type=models.Item)
         except Exception:
             raise ValidationError("无法删除不存在的物品")
 
-        item.delete()
+        await item.asoft_delete()
+        await apublish_items_changed([item])
         return item  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def restore_item(self, info: Info, item_id: relay.GlobalID) -> types.Item:
-        try:
-            item = item_id.resolve_node_sync(info, ensure_type=models.Item)
-        except Exception:
+    async def restore_item(self, info: Info, item_id: relay.GlobalID) -> types.Item:
+        item = (await aresolve_nodes([item_id], models.Item, models.Item.all_objects.all())).get(item_id)
+        if item is None:
             raise ValidationError("物品不存在")
 
-        item.restore()
+        await item.arestore()
+        await apublish_items_changed([item])
         return item  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def add_consumable(
+    async def bulk_add_items(self, info: Info, items: list[types.BulkAddItemInput]) -> types.BulkItemsPayload:
+        """批量添加物品
+
+        有错误的行会被跳过，并在 errors 中返回
+        """
+        storages = await aresolve_nodes((data.storage_id for data in items), models.Storage)
+        user = await info.context.request.auser()
+        now = timezone.now()
+
+        objs: list[models.Item] = []
+        errors: list[types.BulkItemError] = []
+        for index, data in enumerate(items):
+            storage = storages.get(data.storage_id)
+            if storage is None:
+                errors.append(types.BulkItemError(index=index, message="位置不存在"))
+                continue
+            objs.append(
+                models.Item(
+                    name=data.name,
+                    number=data.number,
+                    description=data.description,
+                    storage=storage,
+                    price=data.price,
+                    expired_at=data.expired_at,
+                    created_by=user,
+                    edited_by=user,
+                    edited_at=now,
+                )
+            )
+
+        # bulk_create 本身就在事务中执行
+        await models.Item.objects.abulk_create(objs)
+        await apublish_items_changed(objs)
+        return types.BulkItemsPayload(items=objs, errors=errors)  # type: ignore
+
+    @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
+    async def bulk_update_items(self, info: Info, items: list[types.BulkUpdateItemInput]) -> types.BulkItemsPayload:
+        """批量修改物品
+
+        和 updateItem 一样，修改已删除的物品会自动恢复它
+        """
+        existing = await aresolve_nodes((data.id for data in items), models.Item, models.Item.all_objects.all())
+        storages = await aresolve_nodes((data.storage_id for data in items), models.Storage)
+        user = await info.context.request.auser()
+        now = timezone.now()
+
+        objs: dict[int, models.Item] = {}
+        old_storage_ids: dict[int, int | None] = {}
+        errors: list[types.BulkItemError] = []
+        for index, data in enumerate(items):
+            item = existing.get(data.id)
+            if item is None:
+                errors.append(types.BulkItemError(index=index, message="无法修改不存在的物品"))
+                continue
+            old_storage_ids.setdefault(item.id, item.storage_id)  # type: ignore
+
+            if data.storage_id is not strawberry.UNSET and data.storage_id is not None:
+                storage = storages.get(data.storage_id)
+                if storage is None:
+                    errors.append(types.BulkItemError(index=index, message="位置不存在"))
+                    continue
+                item.storage = storage
+
+            if data.name:
+                item.name = data.name
+            if data.number is not strawberry.UNSET and data.number is not None:
+                item.number = data.number
+            if data.description is not strawberry.UNSET and data.description is not None:
+                item.description = data.description
+            if data.price is not strawberry.UNSET:
+                item.price = data.price
+            if data.expired_at is not strawberry.UNSET:
+                item.expired_at = data.expired_at
+
+            item.edited_by = user
+            item.edited_at = now
+            item.is_deleted = False
+            item.deleted_at = None
+            objs[item.id] = item
+
+        # 需要包括已删除的物品，不然它们无法被恢复；bulk_update 本身就在事务中执行
+        await models.Item.all_objects.abulk_update(
+            objs.values(),
+            [
+                "name",
+                "number",
+                "description",
+                "price",
+                "expired_at",
+                "storage",
+                "edited_by",
+                "edited_at",
+                "is_deleted",
+                "deleted_at",
+            ],
+        )
+        await apublish_items_changed(objs.values(), old_storage_ids)
+        return types.BulkItemsPayload(items=list(objs.values()), errors=errors)  # type: ignore
+
+    @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
+    async def bulk_delete_items(self, info: Info, item_ids: list[relay.GlobalID]) -> types.BulkItemsPayload:
+        """批量删除物品"""
+        existing = await aresolve_nodes(item_ids, models.Item)
+        now = timezone.now()
+
+        objs: dict[int, models.Item] = {}
+        errors: list[types.BulkItemError] = []
+        for index, item_id in enumerate(item_ids):
+            item = existing.get(item_id)
+            if item is None:
+                errors.append(types.BulkItemError(index=index, message="无法删除不存在的物品"))
+                continue
+            item.is_deleted = True
+            item.deleted_at = now
+            objs[item.id] = item
+
+        await models.Item.objects.filter(pk__in=objs).aupdate(is_deleted=True, deleted_at=now)
+        await apublish_items_changed(objs.values())
+        return types.BulkItemsPayload(items=list(objs.values()), errors=errors)  # type: ignore
+
+    @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
+    async def add_consumable(
         self,
         info: Info,
         id: relay.GlobalID,
         consumable_ids: list[relay.GlobalID],
     ) -> types.Item:
         try:
-            item = id.resolve_node_sync(info, ensure_type=models.Item)
+            item = await id.resolve_node(info, ensure_type=models.Item)
         except Exception:
             raise ValidationError("无法修改不存在的物品")
 
-        for consumable_id in consumable_ids:
-            try:
-                consumable = consumable_id.resolve_node_sync(info, ensure_type=models.Item)
-            except Exception:
-                raise ValidationError("耗材不存在")
-            # 不能添加自己作为自己的耗材
-            if item.name == consumable.name:
-                raise ValidationError("不能添加自己作为自己的耗材")
-            item.consumables.add(consumable)
+        consumables = await aresolve_consumables(item, consumable_ids)
+        # add 会先查询已有的耗材，只插入缺少的那部分
+        await item.consumables.aadd(*consumables)
 
-        item.edited_by = info.context.request.user
+        item.edited_by = await info.context.request.auser()
         item.edited_at = timezone.now()
-        item.save()
+        await item.asave()
         return item  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def delete_consumable(
+    async def delete_consumable(
         self,
         info: Info,
         id: relay.GlobalID,
         consumable_ids: list[relay.GlobalID],
     ) -> types.Item:
         try:
-            item = id.resolve_node_sync(info, ensure_type=models.Item)
+            item = await id.resolve_node(info, ensure_type=models.Item)
         except Exception:
             raise ValidationError("无法修改不存在的物品")
 
-        for consumable_id in consumable_ids:
-            try:
-                consumable = consumable_id.resolve_node_sync(info, ensure_type=models.Item)
-            except Exception:
-                raise ValidationError("耗材不存在")
-            item.consumables.remove(consumable)
+        consumables = await aresolve_nodes(consumable_ids, models.Item)
+        if len(consumables) != len(set(consumable_ids)):
+            raise ValidationError("耗材不存在")
+        await item.consumables.aremove(*consumables.values())
 
-        item.edited_by = info.context.request.user
+        item.edited_by = await info.context.request.auser()
         item.edited_at = timezone.now()
-        item.save()
+        await item.asave()
         return item  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def add_picture(
+    async def set_consumables(
+        self,
+        info: Info,
+        id: relay.GlobalID,
+        consumable_ids: list[relay.GlobalID],
+    ) -> types.Item:
+        """替换物品的全部耗材"""
+        try:
+            item = await id.resolve_node(info, ensure_type=models.Item)
+        except Exception:
+            raise ValidationError("无法修改不存在的物品")
+
+        consumables = await aresolve_consumables(item, consumable_ids)
+        item.edited_by = await info.context.request.auser()
+        item.edited_at = timezone.now()
+
+        # 事务不能跨越异步代码，替换耗材与保存物品在同一个线程中执行
+        @sync_to_async
+        def save():
+            with transaction.atomic():
+                # set 会和已有的耗材比较，只删除和添加有变化的部分
+                item.consumables.set(consumables)
+                item.save()
+
+        await save()
+        return item  # type: ignore
+
+    @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
+    async def create_picture_upload_slot(
+        self,
+        info: Info,
+        item_id: relay.GlobalID,
+        filename: str,
+        content_type: str,
+    ) -> UploadSlot:
+        """获取直传图片的上传地址
+
+        上传完成后，将返回的 key 作为 addPicture 或 updatePicture 的 uploadKey
+        """
+        try:
+            item = await item_id.resolve_node(info, ensure_type=models.Item)
+        except Exception:
+            raise ValidationError("无法给不存在的物品添加图片")
+
+        # 创建 S3 客户端时可能需要读取凭证
+        return await sync_to_async(create_upload_slot)(models.Picture(item=item), "picture", filename, content_type)
+
+    @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
+    async def add_picture(
         self,
         info: Info,
         item_id: relay.GlobalID,
-        file: Upload,
+        file: Upload | None,
+        upload_key: str | None,
         description: str,
         box_x: float,
         box_y: float,
         box_h: float,
         box_w: float,
     ) -> types.Picture:
+        """添加图片
+
+        通过 file 上传，或者提供直传完成的 uploadKey
+        """
         try:
-            item = item_id.resolve_node_sync(info, ensure_type=models.Item)
+            item = await item_id.resolve_node(info, ensure_type=models.Item)
         except Exception:
             raise ValidationError("无法给不存在的物品添加图片")
 
         picture = models.Picture(
             item=item,
-            picture=file,
             description=description,
             box_x=box_x,
             box_y=box_y,
             box_h=box_h,
             box_w=box_w,
-            created_by=info.context.request.user,
+            created_by=await info.context.request.auser(),
         )
-        picture.save()
+        # 文件的读写都是同步的，检查与保存（包括写入上传的文件）在线程中执行
+        if upload_key:
+            prefix = f"item_pictures/{item.id}-"
+            picture.picture.name = await sync_to_async(check_uploaded)(picture, "picture", upload_key, prefix)
+        elif file:
+            picture.picture = file  # type: ignore
+        else:
+            raise ValidationError("请上传图片")
+        await picture.asave()
         return picture  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def update_picture(
+    async def update_picture(
         self,
         info: Info,
         id: relay.GlobalID,
         file: Upload | None,
+        upload_key: str | None,
         description: str | None,
         box_x: float | None,
         box_y: float | None,
@@ -298,13 +586,16 @@ class Mutation:
         box_w: float | None,
     ) -> types.Picture:
         try:
-            picture = id.resolve_node_sync(info, ensure_type=models.Picture)
+            picture = await id.resolve_node(info, ensure_type=models.Picture)
         except Exception:
             raise ValidationError("无法修改不存在的图片")
 
         if description is not strawberry.UNSET and description is not None:
             picture.description = description
-        if file:
+        if upload_key:
+            prefix = f"item_pictures/{picture.item_id}-"  # type: ignore
+            picture.picture = await sync_to_async(check_uploaded)(picture, "picture", upload_key, prefix)  # type: ignore
+        elif file:
             picture.picture = file  # type: ignore
         if box_x is not strawberry.UNSET and box_x is not None:
             picture.box_x = box_x
@@ -315,15 +606,15 @@ class Mutation:
         if box_w is not strawberry.UNSET and box_w is not None:
             picture.box_w = box_w
 
-        picture.save()
+        await picture.asave()
         return picture  # type: ignore
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def delete_picture(self, info: Info, picture_id: relay.GlobalID) -> types.Picture:
+    async def delete_picture(self, info: Info, picture_id: relay.GlobalID) -> types.Picture:
         try:
-            picture = picture_id.resolve_node_sync(info, ensure_type=models.Picture)
+            picture = await picture_id.resolve_node(info, ensure_type=models.Picture)
         except Exception:
             raise ValidationError("无法删除不存在的图片")
 
-        picture.delete()
+        await picture.adelete()
         return picture  # type: ignore
@@ -0,0 +1,122 @@
+"""物品搜索
+
+PostgreSQL 下使用 pg_trgm 的词相似度（word_similarity）匹配并排序，
+配合 GIN 索引（见 0010_item_search_indexes）避免全表扫描。
+物品与位置分别查询后合并，条件都落在各自的表上才能使用对应的索引（见 _filter_matched）。
+其他数据库（如测试使用的 SQLite）退化为 icontains 匹配，并按匹配位置粗略排序。
+"""
+
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db import connection
+from django.db.models import Case, F, FloatField, Lookup, Q, QuerySet, Value, When
+from django.db.models.functions import Greatest
+
+from .models import Item, Storage
+
+# 各字段在排序时的权重，名字最重要
+NAME_WEIGHT = 1.0
+DESCRIPTION_WEIGHT = 0.6
+STORAGE_WEIGHT = 0.4
+
+
+class ILike(Lookup):
+    """PostgreSQL 的 ILIKE
+
+    icontains 在 PostgreSQL 上生成 UPPER(字段) LIKE UPPER(...)，
+    gin_trgm_ops 索引建立在字段本身上，只能用于 ILIKE 而不能用于 UPPER(字段)
+    """
+
+    lookup_name = "ilike"
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} ILIKE {rhs}", (*lhs_params, *rhs_params)
+
+
+def contains(field: str, query: str) -> Q:
+    """字段包含 query（不区分大小写），可以使用 gin_trgm_ops 索引"""
+    return Q(ILike(F(field), f"%{connection.ops.prep_for_like_query(query)}%"))
+
+
+def search_items(query: str, name_only: bool = False) -> QuerySet[Item]:
+    """搜索物品
+
+    结果按相似度从高到低排序，相似度相同时按名字排序。
+    相似度通过 similarity 注解返回。
+    """
+    query = query.strip()
+    queryset = Item.objects.all()
+    if not query:
+        return queryset.none()
+
+    if connection.vendor == "postgresql":
+        queryset = _trigram_search(queryset, query, name_only)
+    else:
+        queryset = _fallback_search(queryset, query, name_only)
+
+    return queryset.order_by(F("similarity").desc(), "name", "id")
+
+
+def _trigram_search(queryset: QuerySet[Item], query: str, name_only: bool) -> QuerySet[Item]:
+    """基于 pg_trgm 的搜索
+
+    ILIKE 与 %> 运算符都能使用 gin_trgm_ops 索引。
+    """
+    condition = contains("name", query) | Q(name__trigram_word_similar=query)
+    similarity = TrigramWordSimilarity(query, "name") * NAME_WEIGHT
+    storage_condition = None
+    if not name_only:
+        condition |= contains("description", query) | Q(description__trigram_word_similar=query)
+        storage_condition = contains("name", query) | Q(name__trigram_word_similar=query)
+        similarity = Greatest(
+            similarity,
+            TrigramWordSimilarity(query, "description") * DESCRIPTION_WEIGHT,
+            # 未分类物品没有位置，PostgreSQL 的 GREATEST 会忽略其中的 NULL
+            TrigramWordSimilarity(query, "storage__name") * STORAGE_WEIGHT,
+        )
+    return _filter_matched(queryset, condition, storage_condition).annotate(similarity=similarity)
+
+
+def _fallback_search(queryset: QuerySet[Item], query: str, name_only: bool) -> QuerySet[Item]:
+    """不支持 pg_trgm 时的搜索
+
+    仅做子串匹配，完全匹配 > 前缀匹配 > 包含 > 备注或位置匹配。
+    """
+    condition = Q(name__icontains=query)
+    storage_condition = None
+    if not name_only:
+        condition |= Q(description__icontains=query)
+        storage_condition = Q(name__icontains=query)
+    similarity = Case(
+        When(name__iexact=query, then=Value(NAME_WEIGHT)),
+        When(name__istartswith=query, then=Value(NAME_WEIGHT * 0.9)),
+        When(name__icontains=query, then=Value(NAME_WEIGHT * 0.8)),
+        When(description__icontains=query, then=Value(DESCRIPTION_WEIGHT)),
+        default=Value(STORAGE_WEIGHT),
+        output_field=FloatField(),
+    )
+    return _filter_matched(queryset, condition, storage_condition).annotate(similarity=similarity)
+
+
+def _filter_matched(queryset: QuerySet[Item], condition: Q, storage_condition: Q | None) -> QuerySet[Item]:
+    """筛选物品本身匹配或者所在位置匹配的物品
+
+    物品与位置的条件通过 JOIN 用 OR 连接时，每一行都要计算条件，用不上各自的 GIN 索引。
+    所以分别查询后用 UNION 合并：物品表的条件都在同一张表上，可以合并各字段的索引扫描（BitmapOr），
+    位置先按名字的索引找到匹配的位置，再通过 storage_item_storage_alive 索引找到其中的物品。
+
+    在 PostgreSQL 中 EXPLAIN 时应看到 storage_item_name_trgm、storage_item_description_trgm 与
+    storage_storage_name_trgm 上的 Bitmap Index Scan，而不是 storage_item 上的 Seq Scan
+    （数据很少时规划器仍可能选择全表扫描，可以临时 SET enable_seqscan = off 确认）
+    """
+    if storage_condition is None:
+        return queryset.filter(condition)
+    storages = Storage.objects.filter(storage_condition).values("pk")
+    matched = (
+        Item.objects.filter(condition)
+        .order_by()
+        .values("pk")
+        .union(Item.objects.filter(storage__in=storages).order_by().values("pk"))
+    )
+    return queryset.filter(pk__in=matched)
@@ -0,0 +1,33 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django_cleanup.signals import cleanup_post_delete
+
+from home.thumbnails import delete_thumbnails
+
+from .models import Picture
+from .tasks import generate_picture_thumbnails
+
+
+@receiver(post_save, sender=Picture)
+def picture_saved(sender, instance: Picture, created: bool, raw: bool, update_fields, **kwargs):
+    """图片或边界框变化后重新生成缩略图
+
+    只修改备注等其他字段时不需要重新生成
+    """
+    if raw:
+        return
+    if update_fields is not None and not Picture.THUMBNAIL_FIELDS & update_fields:
+        return
+    # 总是调用，记录保存后的值
+    changed = instance.thumbnail_changed()
+    if not (created or changed):
+        return
+    transaction.on_commit(lambda: generate_picture_thumbnails.delay(instance.pk))  # type: ignore
+
+
+@receiver(cleanup_post_delete, sender=Picture)
+def picture_file_deleted(sender, file, file_name: str, success: bool, **kwargs):
+    """原图被 django_cleanup 删除时，一并删除缩略图"""
+    if success:
+        delete_thumbnails(file.storage, file_name)
@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.utils import timezone
+
+from home.push.tasks import get_enable_reg_ids, push_to_users
+from home.thumbnails import generate_thumbnails
+
+from .expiry import save_expiry_digest
+from .models import Item, Picture
+
+
+@shared_task
+def generate_picture_thumbnails(picture_id: int):
+    """生成物品图片的缩略图
+
+    缩略图只包含边界框内的部分
+    """
+    picture = Picture.objects.filter(pk=picture_id).first()
+    if picture is None:
+        return
+
+    name = picture.picture.name
+    box = (picture.box_x, picture.box_y, picture.box_w, picture.box_h)
+    if generate_thumbnails(picture.picture, box=box):
+        # 图片可能在生成期间被替换，仅在图片未变化时标记
+        Picture.objects.filter(pk=picture_id, picture=name).update(thumbnail_source=name)
+
+
+@shared_task
+def send_expiry_digest():
+    """推送每日过期提醒
+
+    需要在后台添加定时任务，所有用户共享同一份摘要，合并为一次推送
+    生成的摘要会保存下来，查询摘要时直接读取
+    """
+    digest = save_expiry_digest()
+    if digest.is_empty:
+        return "没有即将过期的物品"
+
+    reg_ids = get_enable_reg_ids()
+    if not reg_ids:
+        return "没有启用推送的设备"
+
+    push_to_users.delay(reg_ids, "物品过期提醒", str(digest), "/storage/expiring")  # type: ignore
+    return str(digest)
+
+
+@shared_task
+def purge_deleted_items():
+    """彻底删除超过保留时间的已删除物品
+
+    物品的图片会一起删除，图片文件与缩略图由删除信号清理
+    """
+    deleted_before = timezone.now() - timedelta(days=settings.DELETED_ITEM_RETENTION_DAYS)
+    _, deleted = Item.all_objects.deleted().filter(deleted_at__lt=deleted_before).delete()
+    return f"删除了 {deleted.get(Item._meta.label, 0)} 个物品"
@@ -1,13 +1,26 @@
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from PIL import Image
+from storages.backends.s3 import S3Storage
 from strawberry import relay
 
-from home.tests import GraphQLTestCase
+from home.tests import IN_MEMORY_CHANNEL_LAYERS, GraphQLTestCase, get_ws_client, subscribe
 
 from . import types
-from .models import Item, Picture, Storage
+from .models import DailyExpiryDigest, Item, Picture, Storage
+from .search import search_items
+from .tasks import generate_picture_thumbnails, purge_deleted_items, send_expiry_digest
 
 
 class ModelTests(TestCase):
@@ -60,6 +73,55 @@ class StorageModelTests(TestCase):
 
         self.assertEqual(list(toolbox.get_children()), [])
 
+    def test_path(self):
+        """测试位置路径"""
+        balcony = Storage.objects.get(name="阳台")
+        locker = Storage.objects.get(name="阳台储物柜")
+        toolbox = Storage.objects.get(name="工具箱")
+
+        self.assertEqual(balcony.path, [{"id": 1, "name": "阳台"}])
+        self.assertEqual(
+            toolbox.path,
+            [{"id": 1, "name": "阳台"}, {"id": 2, "name": "阳台储物柜"}, {"id": 3, "name": "工具箱"}],
+        )
+
+        # 新建的位置
+        box = Storage(name="盒子", parent=toolbox)
+        box.save()
+        self.assertEqual(box.ancestor_path, toolbox.path)
+
+        # 修改名称会同步更新子孙节点
+        locker.name = "储物柜"
+        locker.save()
+        box.refresh_from_db()
+        self.assertEqual(
+            [node["name"] for node in box.path],
+            ["阳台", "储物柜", "工具箱", "盒子"],
+        )
+
+        # 移动位置
+        toolbox.refresh_from_db()
+        toolbox.parent = None
+        toolbox.save()
+        box.refresh_from_db()
+        self.assertEqual([node["name"] for node in box.path], ["工具箱", "盒子"])
+
+        balcony.refresh_from_db()
+        toolbox.refresh_from_db()
+        toolbox.move_to(balcony)
+        box.refresh_from_db()
+        self.assertEqual([node["name"] for node in box.path], ["阳台", "工具箱", "盒子"])
+
+    def test_path_rebuild(self):
+        """通过 update 修改 parent 后重建树，同时更新路径"""
+        Storage.objects.filter(name="工具箱").update(parent=None)
+        Storage.objects.rebuild()
+
+        toolbox = Storage.objects.get(name="工具箱")
+        self.assertEqual(toolbox.ancestor_path, [])
+        toolbox2 = Storage.objects.get(name="工具箱2")
+        self.assertEqual([node["name"] for node in toolbox2.path], ["阳台", "阳台储物柜", "工具箱2"])
+
 
 class StorageTests(GraphQLTestCase):
     fixtures = ["users", "storage"]
@@ -93,8 +155,9 @@ class StorageTests(GraphQLTestCase):
 
         name = content.data["storage"]["name"]
         self.assertEqual(name, storage.name)
-        item = content.data["storage"]["items"]["edges"][1]["node"]
-        self.assertEqual(item["name"], "垃圾")
+        # 不包括已删除的物品
+        names = [item["node"]["name"] for item in content.data["storage"]["items"]["edges"]]
+        self.assertEqual(names, ["口罩", "手表", "电池"])
 
     def test_get_storage_connection_filter(self):
         """测试位置下的 Connection 能否使用 filter"""
@@ -233,6 +296,107 @@ class StorageTests(GraphQLTestCase):
         self.assertEqual([item["node"]["name"] for item in items], ["口罩"])
         self.assertEqual(storages, [])
 
+    def test_get_storage_path(self):
+        query = """
+            query storages {
+                storages(filters: {level: {exact: 2}}) {
+                    edges {
+                        node {
+                            name
+                            path {
+                                id
+                                name
+                            }
+                        }
+                    }
+                }
+                items {
+                    edges {
+                        node {
+                            name
+                            path {
+                                name
+                            }
+                        }
+                    }
+                }
+            }
+        """
+        content = self.client.execute(query)
+
+        toolbox = content.data["storages"]["edges"][0]["node"]
+        self.assertEqual(toolbox["name"], "工具箱")
+        self.assertEqual(
+            toolbox["path"],
+            [
+                {"id": relay.to_base64(types.Storage, 1), "name": "阳台"},
+                {"id": relay.to_base64(types.Storage, 2), "name": "阳台储物柜"},
+                {"id": relay.to_base64(types.Storage, 3), "name": "工具箱"},
+            ],
+        )
+        paths = {
+            item["node"]["name"]: [node["name"] for node in item["node"]["path"]]
+            for item in content.data["items"]["edges"]
+        }
+        self.assertEqual(paths["口罩"], ["阳台", "阳台储物柜"])
+        self.assertEqual(paths["未分类"], [])
+
+    def test_search_items(self):
+        """搜索物品，按相似度排序"""
+        query = """
+            query searchItems($query: String!) {
+                searchItems(query: $query) {
+                    edges {
+                        node {
+                            name
+                        }
+                    }
+                }
+            }
+        """
+
+        content = self.client.execute(query, {"query": "手表"})
+
+        names = [item["node"]["name"] for item in content.data["searchItems"]["edges"]]
+        # 名字匹配的排在备注匹配的前面
+        self.assertEqual(names, ["手表", "电池"])
+
+        content = self.client.execute(query, {"query": "垃圾"})
+
+        # 不包含已删除的物品
+        self.assertEqual(content.data["searchItems"]["edges"], [])
+
+        content = self.client.execute(query, {"query": " "})
+
+        self.assertEqual(content.data["searchItems"]["edges"], [])
+
+    def test_search_items_by_storage(self):
+        """通过位置名称搜索物品"""
+        query = """
+            query searchItems($query: String!, $first: Int) {
+                searchItems(query: $query, first: $first) {
+                    edges {
+                        node {
+                            name
+                        }
+                    }
+                }
+            }
+        """
+
+        content = self.client.execute(query, {"query": "储物柜", "first": 2})
+
+        names = [item["node"]["name"] for item in content.data["searchItems"]["edges"]]
+        self.assertEqual(names, ["口罩", "手表"])
+
+    def test_search_items_query(self):
+        """物品与位置分别匹配后合并，筛选条件不通过 JOIN 跨表，才能使用各自的索引"""
+        sql = str(search_items("储物柜").query)
+
+        where = sql[sql.index(" WHERE ") :]
+        self.assertIn("UNION", where)
+        self.assertNotIn('"storage_storage"."name"', where)
+
     def test_add_storage(self):
         """添加位置"""
         mutation = """
@@ -577,6 +741,39 @@ class ItemTests(GraphQLTestCase):
         item = content.data["item"]["pictures"]["edges"][0]["node"]
         self.assertEqual(item["description"], "测试一")
 
+    def test_get_items_resolved_in_event_loop(self):
+        """列表中每一行的自定义字段都已加载，不需要切换到线程执行"""
+        query = """
+            query items {
+                items {
+                    edges {
+                        node {
+                            name
+                            path {
+                                name
+                            }
+                            pictures {
+                                edges {
+                                    node {
+                                        name
+                                        url
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        """
+
+        with mock.patch("home.utils.sync_to_async", wraps=sync_to_async) as patched:
+            content = self.client.execute(query)
+
+        items = {edge["node"]["name"]: edge["node"] for edge in content.data["items"]["edges"]}
+        self.assertEqual([node["name"] for node in items["雨伞"]["path"]], ["阳台"])
+        self.assertTrue(items["雨伞"]["pictures"]["edges"])
+        patched.assert_not_called()
+
     def test_get_item_missing_storage(self):
         """获取没有位置的物品"""
         missing = Item.objects.get(name="未分类")
@@ -656,15 +853,54 @@ class ItemTests(GraphQLTestCase):
 
         self.assertEqual(len(content.data["items"]["edges"]), 5)
 
+    def test_get_items_keyset_pagination(self):
+        """游标中记录排序字段，翻页时不受其他物品修改的影响"""
+        query = """
+            query items($after: String) {
+                items(filters: {}, order: {editedAt: DESC}, first: 2, after: $after) {
+                    edges {
+                        node {
+                            name
+                        }
+                    }
+                    pageInfo {
+                        hasNextPage
+                        endCursor
+                    }
+                }
+            }
+        """
+        content = self.client.execute(query)
+
+        names = [item["node"]["name"] for item in content.data["items"]["edges"]]
+        self.assertEqual(names, ["雨伞", "口罩"])
+        self.assertTrue(content.data["items"]["pageInfo"]["hasNextPage"])
+        cursor = content.data["items"]["pageInfo"]["endCursor"]
+
+        # 第一页的物品被修改后不会影响第二页的内容
+        Item.objects.filter(name="雨伞").update(edited_at=timezone.now())
+
+        content = self.client.execute(query, {"after": cursor})
+
+        names = [item["node"]["name"] for item in content.data["items"]["edges"]]
+        self.assertEqual(names, ["未分类", "电池"])
+
+        content = self.client.execute(query, {"after": content.data["items"]["pageInfo"]["endCursor"]})
+
+        names = [item["node"]["name"] for item in content.data["items"]["edges"]]
+        self.assertEqual(names, ["手表"])
+        self.assertFalse(content.data["items"]["pageInfo"]["hasNextPage"])
+
     def test_get_deleted_items(self):
         """测试获取已删除的物品"""
         query = """
-            query items {
-                items(filters: {isDeleted: true}) {
+            query deletedItems {
+                deletedItems {
                     edges {
                         node {
                             id
                             name
+                            isDeleted
                         }
                     }
                 }
@@ -672,8 +908,95 @@ class ItemTests(GraphQLTestCase):
         """
         content = self.client.execute(query)
 
-        self.assertEqual(len(content.data["items"]["edges"]), 1)
-        self.assertEqual(content.data["items"]["edges"][0]["node"]["name"], "垃圾")
+        self.assertEqual(len(content.data["deletedItems"]["edges"]), 1)
+        self.assertEqual(content.data["deletedItems"]["edges"][0]["node"]["name"], "垃圾")
+        self.assertEqual(content.data["deletedItems"]["edges"][0]["node"]["isDeleted"], True)
+
+    def test_get_deleted_item(self):
+        """通过 ID 可以获取已删除的物品"""
+        query = """
+            query item($id: ID!) {
+                item(id: $id) {
+                    name
+                    isDeleted
+                }
+            }
+        """
+        content = self.client.execute(query, {"id": relay.to_base64(types.Item, "5")})
+        self.assertEqual(content.data["item"], {"name": "垃圾", "isDeleted": True})
+
+        content = self.client.execute(query, {"id": relay.to_base64(types.Storage, "1")}, asserts_errors=False)
+        self.assertEqual(content.errors[0]["message"], "物品不存在")
+
+    def test_get_items_is_deleted_filter(self):
+        """已弃用的 isDeleted 过滤器仍然可以使用"""
+        query = """
+            query items($isDeleted: Boolean!) {
+                items(filters: {isDeleted: $isDeleted}) {
+                    edges {
+                        node {
+                            name
+                        }
+                    }
+                }
+            }
+        """
+        content = self.client.execute(query, {"isDeleted": False})
+        self.assertEqual(len(content.data["items"]["edges"]), 5)
+
+        # 物品列表只包括未删除的物品
+        content = self.client.execute(query, {"isDeleted": True})
+        self.assertEqual(content.data["items"]["edges"], [])
+
+    def test_get_items_exclude_deleted(self):
+        """不提供 filters 参数时也不会返回已删除的物品"""
+        query = """
+            query items {
+                items {
+                    edges {
+                        node {
+                            name
+                        }
+                    }
+                }
+                storages(filters: {name: {exact: "阳台储物柜"}}) {
+                    edges {
+                        node {
+                            items {
+                                edges {
+                                    node {
+                                        name
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        """
+        content = self.client.execute(query)
+
+        names = [item["node"]["name"] for item in content.data["items"]["edges"]]
+        self.assertNotIn("垃圾", names)
+        self.assertEqual(len(names), 5)
+        storage = content.data["storages"]["edges"][0]["node"]
+        names = [item["node"]["name"] for item in storage["items"]["edges"]]
+        self.assertEqual(names, ["口罩", "手表", "电池"])
+
+    def test_purge_deleted_items(self):
+        """彻底删除超过保留时间的已删除物品"""
+        umbrella = Item.objects.get(name="雨伞")
+        umbrella.delete()
+        Item.all_objects.filter(pk=umbrella.pk).update(deleted_at=timezone.now() - timedelta(days=31))
+        # 还在保留时间内
+        Item.all_objects.filter(name="垃圾").update(deleted_at=timezone.now() - timedelta(days=29))
+
+        result = purge_deleted_items()
+
+        self.assertEqual(result, "删除了 1 个物品")
+        self.assertFalse(Item.all_objects.filter(name="雨伞").exists())
+        self.assertFalse(Picture.objects.filter(item_id=umbrella.pk).exists())
+        self.assertTrue(Item.all_objects.filter(name="垃圾").exists())
 
     def test_get_missing_storage_items(self):
         """获取没有存放位置的物品"""
@@ -830,7 +1153,8 @@ class ItemTests(GraphQLTestCase):
 
         self.client.execute(mutation, variables)
 
-        deleted_umbrella = Item.objects.get(name="雨伞")
+        self.assertFalse(Item.objects.filter(name="雨伞").exists())
+        deleted_umbrella = Item.all_objects.get(name="雨伞")
         self.assertEqual(deleted_umbrella.is_deleted, True)
 
     def test_restore_item(self):
@@ -843,15 +1167,16 @@ class ItemTests(GraphQLTestCase):
             }
         """
 
-        umbrella = Item.objects.get(name="雨伞")
         variables = {
-            "input": {"itemId": relay.to_base64(types.Item, umbrella.id)},
+            "input": {"itemId": relay.to_base64(types.Item, "5")},
         }
 
-        self.client.execute(mutation, variables)
+        content = self.client.execute(mutation, variables)
 
-        restore_umbrella = Item.objects.get(name="雨伞")
-        self.assertEqual(restore_umbrella.is_deleted, False)
+        self.assertEqual(content.data["restoreItem"]["__typename"], "Item")
+        restored = Item.objects.get(name="垃圾")
+        self.assertEqual(restored.is_deleted, False)
+        self.assertIsNone(restored.deleted_at)
 
     def test_update_item(self):
         """更新物品"""
@@ -947,7 +1272,7 @@ class ItemTests(GraphQLTestCase):
             }
         }
 
-        old_item = Item.objects.get(pk=5)
+        old_item = Item.all_objects.get(pk=5)
         self.assertEqual(old_item.name, "垃圾")
         self.assertEqual(old_item.is_deleted, True)
 
@@ -1155,6 +1480,359 @@ class ItemTests(GraphQLTestCase):
         self.assertEqual(data["messages"][0]["message"], "位置不存在")
 
 
+class ExpiryTests(GraphQLTestCase):
+    fixtures = ["users", "storage", "push"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+        now = timezone.now()
+        Item.objects.filter(name="口罩").update(expired_at=now + timedelta(days=3))
+        Item.objects.filter(name="手表").update(expired_at=now + timedelta(hours=1))
+        Item.objects.filter(name="电池").update(expired_at=now + timedelta(days=20))
+        Item.objects.filter(name="雨伞").update(expired_at=now - timedelta(hours=2))
+        # 已删除的物品不需要提醒
+        Item.objects.filter(name="垃圾").update(expired_at=now + timedelta(hours=2))
+
+    def test_expiring_items(self):
+        query = """
+            query expiringItems($within: Duration!) {
+                expiringItems(within: $within) {
+                    edges {
+                        node {
+                            name
+                        }
+                    }
+                }
+            }
+        """
+
+        content = self.client.execute(query, {"within": "P7D"})
+        names = [item["node"]["name"] for item in content.data["expiringItems"]["edges"]]
+        # 按过期时间排序，不包括已过期的雨伞
+        self.assertEqual(names, ["手表", "口罩"])
+
+        content = self.client.execute(query, {"within": "PT2H"})
+        names = [item["node"]["name"] for item in content.data["expiringItems"]["edges"]]
+        self.assertEqual(names, ["手表"])
+
+        content = self.client.execute(query, {"within": "一周"}, asserts_errors=False)
+        self.assertIsNotNone(content.errors)
+
+    def test_expiry_digest(self):
+        query = """
+            query expiryDigest {
+                expiryDigest {
+                    expired
+                    today
+                    week
+                    month
+                }
+            }
+        """
+
+        # 一天前就过期的物品已经提醒过，不再统计
+        Item.objects.filter(name="未分类").update(expired_at=timezone.now() - timedelta(days=2))
+
+        content = self.client.execute(query)
+
+        self.assertEqual(content.data["expiryDigest"], {"expired": 1, "today": 1, "week": 1, "month": 1})
+
+    def test_expiry_digest_saved(self):
+        """查询时读取定时任务保存的摘要"""
+        query = """
+            query expiryDigest {
+                expiryDigest {
+                    expired
+                    month
+                    createdAt
+                }
+            }
+        """
+
+        with mock.patch("home.storage.tasks.push_to_users.delay"):
+            send_expiry_digest()
+        created_at = DailyExpiryDigest.objects.get().created_at
+
+        # 之后的修改在下一次生成摘要前不会反映到摘要中
+        Item.objects.filter(name="电池").update(expired_at=None)
+        content = self.client.execute(query)
+        self.assertEqual(
+            content.data["expiryDigest"],
+            {"expired": 1, "month": 1, "createdAt": created_at.isoformat()},
+        )
+
+        # 只保留最近一次的摘要
+        with mock.patch("home.storage.tasks.push_to_users.delay"):
+            send_expiry_digest()
+        self.assertEqual(DailyExpiryDigest.objects.count(), 1)
+
+        # 摘要超过一天没有更新时实时统计
+        DailyExpiryDigest.objects.update(created_at=timezone.now() - timedelta(days=2))
+        content = self.client.execute(query)
+        self.assertEqual(content.data["expiryDigest"]["month"], 0)
+
+    @mock.patch("home.storage.tasks.push_to_users.delay")
+    def test_send_expiry_digest(self, mock_push):
+        result = send_expiry_digest()
+
+        self.assertEqual(result, "1 个物品过去一天内过期，1 个物品今天过期，1 个物品一周内过期，1 个物品一个月内过期")
+        # 所有设备合并为一次推送
+        mock_push.assert_called_once()
+        reg_ids, title, description, payload = mock_push.call_args.args
+        self.assertCountEqual(reg_ids, ["regidofuser1", "regid2ofuser1"])
+        self.assertEqual(title, "物品过期提醒")
+        self.assertEqual(description, result)
+        self.assertEqual(payload, "/storage/expiring")
+
+    @mock.patch("home.storage.tasks.push_to_users.delay")
+    def test_send_expiry_digest_empty(self, mock_push):
+        Item.objects.update(expired_at=None)
+
+        self.assertEqual(send_expiry_digest(), "没有即将过期的物品")
+        mock_push.assert_not_called()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ItemSubscriptionTests(GraphQLTestCase):
+    fixtures = ["users", "storage"]
+
+    query = """
+        subscription itemChanged($storageId: ID!) {
+            itemChanged(storageId: $storageId) {
+                name
+                isDeleted
+                storage {
+                    name
+                }
+            }
+        }
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+    async def test_item_deleted(self):
+        mutation = """
+            mutation deleteItem($input: DeleteItemInput!) {
+                deleteItem(input: $input) {
+                    __typename
+                }
+            }
+        """
+        ws_client = get_ws_client(self.user)
+        await subscribe(
+            ws_client, self.query, {"storageId": relay.to_base64(types.Storage, 1)}, group="storage.1.items"
+        )
+
+        await sync_to_async(self.execute_on_commit)(mutation, {"input": {"itemId": relay.to_base64(types.Item, 1)}})
+
+        response = await ws_client.receive_json_from()
+        self.assertEqual(
+            response["payload"]["data"]["itemChanged"], {"name": "雨伞", "isDeleted": True, "storage": {"name": "阳台"}}
+        )
+        await ws_client.disconnect()
+
+    async def test_item_moved(self):
+        """移动物品时，原来的位置也会收到通知"""
+        mutation = """
+            mutation updateItem($input: UpdateItemInput!) {
+                updateItem(input: $input) {
+                    __typename
+                }
+            }
+        """
+        ws_client = get_ws_client(self.user)
+        await subscribe(
+            ws_client, self.query, {"storageId": relay.to_base64(types.Storage, 1)}, group="storage.1.items"
+        )
+
+        await sync_to_async(self.execute_on_commit)(
+            mutation,
+            {
+                "input": {
+                    "id": relay.to_base64(types.Item, 1),
+                    "storageId": relay.to_base64(types.Storage, 3),
+                }
+            },
+        )
+
+        response = await ws_client.receive_json_from()
+        self.assertEqual(
+            response["payload"]["data"]["itemChanged"],
+            {"name": "雨伞", "isDeleted": False, "storage": {"name": "工具箱"}},
+        )
+        await ws_client.disconnect()
+
+    def test_channel_layer_error(self):
+        """通道层不可用时只记录日志，不影响修改"""
+        mutation = """
+            mutation deleteItem($input: DeleteItemInput!) {
+                deleteItem(input: $input) {
+                    __typename
+                }
+            }
+        """
+
+        with (
+            mock.patch("home.utils.get_channel_layer") as mocked,
+            self.assertLogs("home.utils", "ERROR"),
+        ):
+            mocked.return_value.group_send = mock.AsyncMock(side_effect=ConnectionError)
+            self.execute_on_commit(mutation, {"input": {"itemId": relay.to_base64(types.Item, 1)}})
+
+        mocked.return_value.group_send.assert_awaited_once()
+        self.assertTrue(Item.all_objects.get(pk=1).is_deleted)
+
+
+class BulkItemTests(GraphQLTestCase):
+    fixtures = ["users", "storage"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+    def test_bulk_add_items(self):
+        mutation = """
+            mutation bulkAddItems($input: BulkAddItemsInput!) {
+                bulkAddItems(input: $input) {
+                    ... on BulkItemsPayload {
+                        items {
+                            id
+                            name
+                            storage {
+                                name
+                            }
+                        }
+                        errors {
+                            index
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        storage_id = relay.to_base64(types.Storage, 1)
+        variables = {
+            "input": {
+                "items": [
+                    {"name": "test1", "number": 1, "description": "", "storageId": storage_id},
+                    {"name": "test2", "number": 2, "description": "", "storageId": relay.to_base64(types.Storage, 0)},
+                    {"name": "test3", "number": 3, "description": "some", "storageId": storage_id, "price": 1.5},
+                ]
+            }
+        }
+
+        with mock.patch("home.storage.schema.achannel_group_send") as mocked:
+            content = self.client.execute(mutation, variables)
+
+        data = content.data["bulkAddItems"]
+        self.assertEqual([item["name"] for item in data["items"]], ["test1", "test3"])
+        self.assertEqual(data["items"][0]["storage"]["name"], "阳台")
+        self.assertEqual(data["errors"], [{"index": 1, "message": "位置不存在"}])
+
+        item = Item.objects.get(name="test3")
+        self.assertEqual(item.price, 1.5)
+        self.assertEqual(item.created_by, self.user)
+        self.assertFalse(Item.objects.filter(name="test2").exists())
+        # 同一个位置只发送一条通知
+        mocked.assert_awaited_once_with(
+            "storage.1.items", {"type": "item.changed", "ids": [Item.objects.get(name="test1").pk, item.pk]}
+        )
+
+    def test_bulk_update_items(self):
+        mutation = """
+            mutation bulkUpdateItems($input: BulkUpdateItemsInput!) {
+                bulkUpdateItems(input: $input) {
+                    ... on BulkItemsPayload {
+                        items {
+                            name
+                            number
+                            isDeleted
+                            storage {
+                                name
+                            }
+                        }
+                        errors {
+                            index
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {
+            "input": {
+                "items": [
+                    {"id": relay.to_base64(types.Item, 1), "number": 10},
+                    {"id": relay.to_base64(types.Item, 0), "number": 10},
+                    {"id": relay.to_base64(types.Item, 2), "storageId": relay.to_base64(types.Storage, 0)},
+                    {
+                        "id": relay.to_base64(types.Item, 5),
+                        "name": "宝贝",
+                        "storageId": relay.to_base64(types.Storage, 3),
+                    },
+                ]
+            }
+        }
+
+        content = self.client.execute(mutation, variables)
+
+        data = content.data["bulkUpdateItems"]
+        self.assertEqual(
+            data["items"],
+            [
+                {"name": "雨伞", "number": 10, "isDeleted": False, "storage": {"name": "阳台"}},
+                {"name": "宝贝", "number": 1, "isDeleted": False, "storage": {"name": "工具箱"}},
+            ],
+        )
+        self.assertEqual(
+            data["errors"],
+            [{"index": 1, "message": "无法修改不存在的物品"}, {"index": 2, "message": "位置不存在"}],
+        )
+        self.assertEqual(Item.objects.get(pk=1).number, 10)
+        self.assertEqual(Item.objects.get(pk=2).storage_id, 2)
+        self.assertFalse(Item.objects.get(pk=5).is_deleted)
+
+    def test_bulk_delete_items(self):
+        mutation = """
+            mutation bulkDeleteItems($input: BulkDeleteItemsInput!) {
+                bulkDeleteItems(input: $input) {
+                    ... on BulkItemsPayload {
+                        items {
+                            name
+                            isDeleted
+                        }
+                        errors {
+                            index
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {
+            "input": {
+                "itemIds": [
+                    relay.to_base64(types.Item, 1),
+                    relay.to_base64(types.Storage, 2),
+                    relay.to_base64(types.Item, 2),
+                ]
+            }
+        }
+
+        content = self.client.execute(mutation, variables)
+
+        data = content.data["bulkDeleteItems"]
+        self.assertEqual(data["items"], [{"name": "雨伞", "isDeleted": True}, {"name": "口罩", "isDeleted": True}])
+        self.assertEqual(data["errors"], [{"index": 1, "message": "无法删除不存在的物品"}])
+        self.assertTrue(Item.all_objects.get(pk=1).is_deleted)
+        self.assertIsNotNone(Item.all_objects.get(pk=2).deleted_at)
+        self.assertFalse(Item.objects.get(pk=3).is_deleted)
+
+
 class ConsumableTests(GraphQLTestCase):
     """耗材相关的测试"""
 
@@ -1272,6 +1950,84 @@ class ConsumableTests(GraphQLTestCase):
         names = [item["node"]["name"] for item in content.data["addConsumable"]["consumables"]["edges"]]
         self.assertEqual(set(names), {"口罩"})
 
+    def test_add_consumable_query_count(self):
+        """添加耗材的查询次数与耗材数量无关"""
+        mutation = """
+            mutation addConsumable($input: AddConsumableInput!) {
+                addConsumable(input: $input) {
+                    ... on Item {
+                        id
+                    }
+                }
+            }
+        """
+        item = Item.objects.get(pk=6)
+
+        def count_queries(consumable_ids):
+            variables = {
+                "input": {
+                    "id": relay.to_base64(types.Item, item.pk),
+                    "consumableIds": [relay.to_base64(types.Item, pk) for pk in consumable_ids],
+                }
+            }
+            with CaptureQueriesContext(connection) as context:
+                self.client.execute(mutation, variables)
+            return len(context.captured_queries)
+
+        one = count_queries([1])
+        many = count_queries([2, 3, 4])
+
+        self.assertEqual(one, many)
+        self.assertEqual(set(item.consumables.values_list("pk", flat=True)), {1, 2, 3, 4})
+
+    def test_set_consumables(self):
+        """替换全部耗材"""
+        mutation = """
+            mutation setConsumables($input: SetConsumablesInput!) {
+                setConsumables(input: $input) {
+                    ... on Item {
+                        consumables {
+                            edges {
+                                node {
+                                    name
+                                }
+                            }
+                        }
+                    }
+                    ... on OperationInfo {
+                        messages {
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {
+            "input": {
+                "id": relay.to_base64(types.Item, "3"),
+                "consumableIds": [relay.to_base64(types.Item, "1"), relay.to_base64(types.Item, "2")],
+            }
+        }
+
+        content = self.client.execute(mutation, variables)
+
+        names = [item["node"]["name"] for item in content.data["setConsumables"]["consumables"]["edges"]]
+        self.assertEqual(set(names), {"雨伞", "口罩"})
+
+        # 有错误时不做任何修改
+        variables["input"]["consumableIds"] = [relay.to_base64(types.Item, "4"), relay.to_base64(types.Item, "3")]
+
+        content = self.client.execute(mutation, variables)
+
+        self.assertEqual(content.data["setConsumables"]["messages"][0]["message"], "不能添加自己作为自己的耗材")
+        self.assertEqual(set(Item.objects.get(pk=3).consumables.values_list("pk", flat=True)), {1, 2})
+
+        variables["input"]["consumableIds"] = []
+
+        content = self.client.execute(mutation, variables)
+
+        self.assertEqual(content.data["setConsumables"]["consumables"]["edges"], [])
+
     def test_error_add_consumable_item_not_exist(self):
         """物品不存在的情况"""
         mutation = """
@@ -1573,6 +2329,110 @@ class PictureTests(GraphQLTestCase):
         self.assertEqual(picture["__typename"], "Picture")
         self.assertEqual(picture["description"], "test")
 
+    def test_create_picture_upload_slot(self):
+        """获取直传图片的地址"""
+        mutation = """
+            mutation createPictureUploadSlot($input: CreatePictureUploadSlotInput!) {
+                createPictureUploadSlot(input: $input) {
+                    ... on UploadSlot {
+                        key
+                        url
+                        fields
+                    }
+                    ... on OperationInfo {
+                        messages {
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {
+            "input": {
+                "itemId": relay.to_base64(types.Item, "1"),
+                "filename": "test.jpg",
+                "contentType": "image/jpeg",
+            }
+        }
+
+        # 默认的存储不支持直传
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["createPictureUploadSlot"]["messages"][0]["message"], "当前存储不支持直传")
+
+        s3 = S3Storage(
+            bucket_name="bucket",
+            access_key="key",
+            secret_key="secret",
+            endpoint_url="http://127.0.0.1:9000",
+            region_name="us-east-1",
+        )
+        with mock.patch.object(Picture._meta.get_field("picture"), "storage", s3):
+            content = self.client.execute(mutation, variables)
+
+        slot = content.data["createPictureUploadSlot"]
+        self.assertTrue(slot["key"].startswith("item_pictures/1-"))
+        self.assertTrue(slot["key"].endswith(".jpg"))
+        self.assertEqual(slot["url"], "http://127.0.0.1:9000/bucket")
+        self.assertEqual(slot["fields"]["key"], slot["key"])
+        self.assertEqual(slot["fields"]["Content-Type"], "image/jpeg")
+
+        # 只允许图片的后缀名
+        variables["input"]["filename"] = "test.html"
+        with mock.patch.object(Picture._meta.get_field("picture"), "storage", s3):
+            content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["createPictureUploadSlot"]["messages"][0]["message"], "只能上传图片")
+
+    def test_add_picture_upload_key(self):
+        """通过直传的文件添加图片"""
+        mutation = """
+            mutation addPicture($input: AddPictureInput!) {
+                addPicture(input: $input) {
+                    ... on Picture {
+                        name
+                        url
+                    }
+                    ... on OperationInfo {
+                        messages {
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {
+            "input": {
+                "itemId": relay.to_base64(types.Item, "1"),
+                "uploadKey": "item_pictures/1-uploaded.jpg",
+                "description": "test",
+                "boxX": 0.1,
+                "boxY": 0.1,
+                "boxH": 0.1,
+                "boxW": 0.1,
+            }
+        }
+
+        # 文件还没有上传
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["addPicture"]["messages"][0]["message"], "文件还未上传完成")
+
+        default_storage.save("item_pictures/1-uploaded.jpg", ContentFile(b"file_text"))
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["addPicture"]["url"], "/item_pictures/1-uploaded.jpg")
+
+        # 已经被其他图片使用的文件不能再次使用
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["addPicture"]["messages"][0]["message"], "文件已被使用")
+
+        # 不能使用其他物品的文件
+        variables["input"]["itemId"] = relay.to_base64(types.Item, "2")
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["addPicture"]["messages"][0]["message"], "无效的文件")
+
+        # 必须提供文件
+        del variables["input"]["uploadKey"]
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["addPicture"]["messages"][0]["message"], "请上传图片")
+
     def test_add_picture_not_exist(self):
         test_file = SimpleUploadedFile(name="test.txt", content=b"file_text")
 
@@ -1726,3 +2586,93 @@ class PictureTests(GraphQLTestCase):
         data = content.data["updatePicture"]
         self.assertEqual(data["__typename"], "OperationInfo")
         self.assertEqual(data["messages"][0]["message"], "无法修改不存在的图片")
+
+
+class PictureThumbnailTests(GraphQLTestCase):
+    fixtures = ["users", "storage"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.get(username="he0119")
+        self.client.authenticate(self.user)
+
+        buffer = BytesIO()
+        Image.new("RGB", (1000, 800), "red").save(buffer, "JPEG")
+        self.picture = Picture(
+            item=Item.objects.get(pk=1),
+            picture=SimpleUploadedFile(name="test.jpg", content=buffer.getvalue()),
+            description="",
+            box_x=0.5,
+            box_y=0.5,
+            box_w=0.5,
+            box_h=0.5,
+        )
+        with mock.patch.object(generate_picture_thumbnails, "delay") as mock_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.picture.save()
+        mock_delay.assert_called_once_with(self.picture.pk)
+
+    def get_thumbnail_url(self, width: int, format: str = "WEBP") -> str:
+        query = """
+            query picture($id: ID!, $width: Int!, $format: ThumbnailFormat!) {
+                picture(id: $id) {
+                    thumbnailUrl(width: $width, format: $format)
+                }
+            }
+        """
+        variables = {"id": relay.to_base64(types.Picture, self.picture.pk), "width": width, "format": format}
+        content = self.client.execute(query, variables)
+        return content.data["picture"]["thumbnailUrl"]
+
+    def test_thumbnail(self):
+        name = self.picture.picture.name
+        root = name.rsplit(".", 1)[0]
+
+        # 还没生成缩略图时返回原图
+        self.assertEqual(self.get_thumbnail_url(200), f"/{name}")
+
+        generate_picture_thumbnails(self.picture.pk)
+
+        self.picture.refresh_from_db()
+        self.assertEqual(self.picture.thumbnail_source, name)
+        self.assertEqual(self.get_thumbnail_url(200), f"/{root}.256w.webp")
+        self.assertEqual(self.get_thumbnail_url(2000, "JPEG"), f"/{root}.1024w.jpeg")
+
+        storage = self.picture.picture.storage
+        # 只保留边界框内的部分，且不会放大图片
+        with storage.open(f"{root}.1024w.jpeg") as f:
+            self.assertEqual(Image.open(f).size, (500, 400))
+        with storage.open(f"{root}.128w.webp") as f:
+            self.assertEqual(Image.open(f).size, (128, 102))
+
+        # 删除图片时一并删除缩略图
+        with self.captureOnCommitCallbacks(execute=True):
+            self.picture.delete()
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(storage.exists(f"{root}.128w.webp"))
+
+    def test_regenerate_on_change(self):
+        """只有图片或边界框变化时才重新生成缩略图"""
+        picture = Picture.objects.get(pk=self.picture.pk)
+
+        with mock.patch.object(generate_picture_thumbnails, "delay") as mock_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                picture.description = "新的备注"
+                picture.save()
+                picture.box_x = 0.4
+                picture.save(update_fields=["description"])
+        mock_delay.assert_not_called()
+
+        with mock.patch.object(generate_picture_thumbnails, "delay") as mock_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                picture.save()
+                picture.save()
+        mock_delay.assert_called_once_with(picture.pk)
+
+    def test_thumbnail_invalid_image(self):
+        self.picture.picture.save("test.txt", ContentFile(b"file_text"), save=False)
+        Picture.objects.filter(pk=self.picture.pk).update(picture=self.picture.picture.name)
+
+        generate_picture_thumbnails(self.picture.pk)
+
+        self.picture.refresh_from_db()
+        self.assertEqual(self.picture.thumbnail_source, "")
@@ -1,16 +1,36 @@
-from typing import Optional
+from datetime import datetime, timedelta
+from typing import NewType, Optional
 
 import strawberry
 import strawberry_django
 from django.db.models import Q
+from django.utils.dateparse import parse_duration
+from django.utils.duration import duration_iso_string
 from strawberry import relay
 from strawberry_django import FilterLookup
 
+from home.thumbnails import ThumbnailFormat, thumbnail_url
 from home.users.types import User
+from home.utils import loaded_resolver
 
 from . import models
 
 
+def _parse_duration(value: str) -> timedelta:
+    duration = parse_duration(value)
+    if duration is None:
+        raise ValueError(f"无效的时长: {value}")
+    return duration
+
+
+Duration = strawberry.scalar(
+    NewType("Duration", timedelta),
+    description="ISO 8601 格式的时长，例如 P7D",
+    serialize=duration_iso_string,
+    parse_value=_parse_duration,
+)
+
+
 @strawberry_django.order_type(models.Item, one_of=False)
 class ItemOrder:
     created_at: strawberry.auto
@@ -38,11 +58,14 @@ class ItemFilter:
     name: strawberry.auto
     description: strawberry.auto
     expired_at: strawberry.auto
-    # FIXME: 现在这样只能在提供了 filter 参数的情况下，才会生效（就算参数为空字典也行）。
-    is_deleted: bool = False
-    """ 默认排除已删除的物品 """
     storage: StorageFilterLookup | None = strawberry.UNSET
 
+    @strawberry_django.filter_field(
+        deprecation_reason="物品列表默认排除已删除的物品，已删除的物品请使用 deletedItems 查询",
+    )
+    def is_deleted(self, value: bool, prefix: str) -> Q:
+        return Q(**{f"{prefix}is_deleted": value})
+
     @strawberry_django.filter_field(filter_none=True)
     def consumables(self, value: bool | None, prefix: str) -> Q:
         if value is None:
@@ -66,7 +89,30 @@ class PictureFilter:
     item: ItemFilter | None = strawberry.UNSET
 
 
-@strawberry_django.type(models.Item, filters=ItemFilter, order=ItemOrder)
+@strawberry.type
+class StoragePathNode:
+    """位置路径中的一级"""
+
+    id: relay.GlobalID
+    name: str
+
+
+def to_path_nodes(path: list[dict]) -> list[StoragePathNode]:
+    return [StoragePathNode(id=relay.GlobalID("Storage", str(node["id"])), name=node["name"]) for node in path]
+
+
+# 自定义解析器用到的字段，已加载时解析器直接在事件循环中执行（见 loaded_resolver）
+ITEM_PATH_FIELDS = ["storage__id", "storage__name", "storage__ancestor_path"]
+STORAGE_PATH_FIELDS = ["id", "name", "ancestor_path"]
+
+
+# 游标分页需要读取排序字段，嵌套的连接在优化器 only 之前就生成了游标，所以在类型上声明这些字段总是加载
+@strawberry_django.type(
+    models.Item,
+    filters=ItemFilter,
+    order=ItemOrder,
+    only=["name", "created_at", "edited_at", "expired_at", "deleted_at"],
+)
 class Item(relay.Node):
     name: strawberry.auto
     number: strawberry.auto
@@ -80,29 +126,51 @@ class Item(relay.Node):
     edited_by: User
     is_deleted: strawberry.auto
     deleted_at: strawberry.auto
-    consumables: strawberry_django.relay.DjangoListConnection["Item"] = strawberry_django.connection(
+    consumables: strawberry_django.relay.DjangoCursorConnection["Item"] = strawberry_django.connection(
         filters=ItemFilter, order=ItemOrder
     )
     pictures: strawberry_django.relay.DjangoListConnection["Picture"] = strawberry_django.connection(
         filters=PictureFilter, order=PictureOrder
     )
 
+    @classmethod
+    def get_queryset(cls, queryset, info, **kwargs):
+        # 预取关联的物品（位置下的物品、耗材）时使用的是基础管理器，需要在这里排除已删除的物品
+        # 回收站等需要已删除物品的查询通过 ItemQuerySet.with_deleted 明确标记
+        if getattr(queryset, "include_deleted", False):
+            return queryset
+        return queryset.filter(is_deleted=False)
+
+    @strawberry_django.field(only=ITEM_PATH_FIELDS, select_related=["storage"])
+    @loaded_resolver(*ITEM_PATH_FIELDS)
+    def path(self) -> list[StoragePathNode]:
+        """物品所在位置的路径，未分类物品为空"""
+        if self.storage is None:
+            return []
+        return to_path_nodes(self.storage.path)  # type: ignore
+
 
 @strawberry_django.type(models.Storage, filters=StorageFilter)
 class Storage(relay.Node):
     name: strawberry.auto
     description: strawberry.auto
     parent: Optional["Storage"]
-    children: strawberry_django.relay.DjangoListConnection["Storage"] = strawberry_django.connection(
+    children: strawberry_django.relay.DjangoCursorConnection["Storage"] = strawberry_django.connection(
         filters=StorageFilter
     )
-    items: strawberry_django.relay.DjangoListConnection[Item] = strawberry_django.connection(
+    items: strawberry_django.relay.DjangoCursorConnection[Item] = strawberry_django.connection(
         filters=ItemFilter, order=ItemOrder
     )
     ancestors: strawberry_django.relay.DjangoListConnection["Storage"] = strawberry_django.connection(
         filters=StorageFilter
     )
 
+    @strawberry_django.field(only=STORAGE_PATH_FIELDS)
+    @loaded_resolver(*STORAGE_PATH_FIELDS)
+    def path(self) -> list[StoragePathNode]:
+        """从根节点到当前位置的路径"""
+        return to_path_nodes(self.path)  # type: ignore
+
     # NOTE: 如果是像下面这样写就会报错
     # AttributeError: 'str' object has no attribute 'CONNECTION_CLASS'
     # @strawberry_django.connection
@@ -110,7 +178,7 @@ class Storage(relay.Node):
     #     return self.get_ancestors()
 
 
-@strawberry_django.type(models.Picture, filters=PictureFilter, order=PictureOrder)
+@strawberry_django.type(models.Picture, filters=PictureFilter, order=PictureOrder, only=["created_at"])
 class Picture(relay.Node):
     description: strawberry.auto
     item: Item
@@ -121,10 +189,67 @@ class Picture(relay.Node):
     box_h: strawberry.auto
     box_w: strawberry.auto
 
-    @strawberry.field
+    @strawberry_django.field(only=["picture"])
+    @loaded_resolver("picture")
     def name(self, info) -> str:
         return self.picture.name.split("/")[-1]  # type: ignore
 
-    @strawberry.field
+    @strawberry_django.field(only=["picture"])
+    @loaded_resolver("picture")
     def url(self, info) -> str:
         return self.picture.url  # type: ignore
+
+    @strawberry_django.field(only=["picture", "thumbnail_source"])
+    @loaded_resolver("picture", "thumbnail_source")
+    def thumbnail_url(self, info, width: int, format: ThumbnailFormat = ThumbnailFormat.WEBP) -> str:
+        """边界框内的缩略图，缩略图未生成时返回原图"""
+        return thumbnail_url(self.picture, self.thumbnail_source, width, format)  # type: ignore
+
+
+@strawberry.input
+class BulkAddItemInput:
+    name: str
+    number: int
+    storage_id: relay.GlobalID
+    description: str
+    price: float | None = None
+    expired_at: datetime | None = None
+
+
+@strawberry.input
+class BulkUpdateItemInput:
+    id: relay.GlobalID
+    name: str | None = strawberry.UNSET
+    number: int | None = strawberry.UNSET
+    description: str | None = strawberry.UNSET
+    price: float | None = strawberry.UNSET
+    expired_at: datetime | None = strawberry.UNSET
+    storage_id: relay.GlobalID | None = strawberry.UNSET
+
+
+@strawberry.type
+class BulkItemError:
+    """批量操作中某一行的错误"""
+
+    index: int
+    """ 对应输入列表中的序号 """
+    message: str
+
+
+@strawberry.type
+class BulkItemsPayload:
+    items: list[Item]
+    """ 成功处理的物品 """
+    errors: list[BulkItemError]
+
+
+@strawberry.type
+class ExpiryDigest:
+    """过去一天内过期与各时间段内过期的物品数量，时间段之间不重叠"""
+
+    expired: int
+    today: int
+    week: int
+    month: int
+    created_at: datetime
+    """ 摘要的生成时间，各时间段从这个时间开始计算 """
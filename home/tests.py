@@ -1,10 +1,18 @@
+import asyncio
 from dataclasses import dataclass
 from typing import Any
 
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
 from django.test import TestCase
 from graphql import GraphQLFormattedError
+from strawberry.channels import GraphQLWSConsumer
+from strawberry.subscriptions import GRAPHQL_TRANSPORT_WS_PROTOCOL
 from strawberry_django.test.client import TestClient
 
+# 测试订阅时使用内存中的通道层，可以检查订阅是否已经加入组
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
 
 @dataclass
 class Response:
@@ -61,21 +69,50 @@ class GraphQLTestCase(TestCase):
         # 为了正确的类型提示
         self.client: MyTestClient  # type: ignore
 
+    def execute_on_commit(self, *args, **kwargs) -> Response:
+        """执行查询，并运行事务提交后的回调
 
-# def get_ws_client(user) -> WebsocketCommunicator:
-#     """获取 WebSocket 客户端"""
-#     from home.schema import schema
-
-#     class DebuggableGraphQLWSConsumer(GraphQLWSConsumer):
-#         async def get_context(self, *args, **kwargs):  # type: ignore[override]
-#             context = await super().get_context(*args, **kwargs)
-#             if context is None:
-#                 return None
-#             context["ws"].scope["user"] = user
-#             return context
-
-#     return WebsocketCommunicator(
-#         DebuggableGraphQLWSConsumer.as_asgi(schema=schema, subscription_protocols=(GRAPHQL_TRANSPORT_WS_PROTOCOL,)),
-#         "",
-#         subprotocols=[GRAPHQL_TRANSPORT_WS_PROTOCOL],
-#     )
+        订阅的通知在事务提交后才会发送
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.execute(*args, **kwargs)
+
+
+def get_ws_client(user) -> WebsocketCommunicator:
+    """获取 WebSocket 客户端"""
+    from home.schema import schema
+
+    class DebuggableGraphQLWSConsumer(GraphQLWSConsumer):
+        async def get_context(self, *args, **kwargs):  # type: ignore[override]
+            context = await super().get_context(*args, **kwargs)
+            if context is None:
+                return None
+            context["ws"].scope["user"] = user
+            return context
+
+    return WebsocketCommunicator(
+        DebuggableGraphQLWSConsumer.as_asgi(schema=schema, subscription_protocols=(GRAPHQL_TRANSPORT_WS_PROTOCOL,)),
+        "",
+        subprotocols=[GRAPHQL_TRANSPORT_WS_PROTOCOL],
+    )
+
+
+async def subscribe(ws_client: WebsocketCommunicator, query: str, variables: dict[str, Any] | None = None, group=""):
+    """连接并发送订阅请求
+
+    指定 group 时等待订阅加入通道层的组，避免之后发送的消息丢失
+    """
+    connected, _ = await ws_client.connect()
+    assert connected
+    await ws_client.send_json_to({"type": "connection_init"})
+    response = await ws_client.receive_json_from()
+    assert response["type"] == "connection_ack"
+    await ws_client.send_json_to(
+        {"id": "1", "type": "subscribe", "payload": {"query": query, "variables": variables or {}}}
+    )
+    if group:
+        channel_layer = get_channel_layer()
+        for _ in range(100):
+            if channel_layer.groups.get(group):  # type: ignore
+                break
+            await asyncio.sleep(0.01)
@@ -0,0 +1,121 @@
+"""图片缩略图
+
+为物品图片与头像生成几个固定宽度的缩略图，存放在原图旁边，例如
+item_pictures/1-xxx.jpg 对应 item_pictures/1-xxx.256w.webp 和 item_pictures/1-xxx.256w.jpeg
+"""
+
+import enum
+import logging
+import os
+from io import BytesIO
+
+import strawberry
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.db.models.fields.files import FieldFile
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# 缩略图的宽度，从小到大排列
+THUMBNAIL_WIDTHS = (128, 256, 512, 1024)
+THUMBNAIL_QUALITY = 80
+
+
+@strawberry.enum
+class ThumbnailFormat(enum.Enum):
+    WEBP = "webp"
+    JPEG = "jpeg"
+
+
+def thumbnail_name(name: str, width: int, format: ThumbnailFormat) -> str:
+    root, _ = os.path.splitext(name)
+    return f"{root}.{width}w.{format.value}"
+
+
+def choose_width(width: int) -> int:
+    """选择不小于所需宽度的最小缩略图，没有则使用最大的"""
+    for thumbnail_width in THUMBNAIL_WIDTHS:
+        if thumbnail_width >= width:
+            return thumbnail_width
+    return THUMBNAIL_WIDTHS[-1]
+
+
+def thumbnail_url(file: FieldFile, source: str, width: int, format: ThumbnailFormat) -> str:
+    """缩略图的地址
+
+    source 为生成缩略图时的原图名称，与当前图片不同说明缩略图还没有生成，直接返回原图
+    """
+    if not source or source != file.name:
+        return file.url
+    return file.storage.url(thumbnail_name(file.name, choose_width(width), format))
+
+
+def crop_box(image: Image.Image, box: tuple[float, float, float, float]) -> Image.Image:
+    """按边界框裁剪图片
+
+    边界框为相对于图片尺寸的中心点坐标与宽高
+    """
+    x, y, w, h = box
+    if w <= 0 or h <= 0:
+        return image
+    left = max(0, round((x - w / 2) * image.width))
+    upper = max(0, round((y - h / 2) * image.height))
+    right = min(image.width, round((x + w / 2) * image.width))
+    lower = min(image.height, round((y + h / 2) * image.height))
+    if right <= left or lower <= upper:
+        return image
+    return image.crop((left, upper, right, lower))
+
+
+def generate_thumbnails(
+    file: FieldFile,
+    box: tuple[float, float, float, float] | None = None,
+    square: bool = False,
+) -> bool:
+    """生成缩略图
+
+    box 为需要裁剪的边界框，square 为是否从中心裁剪为正方形
+    无法识别的图片返回 False
+    """
+    try:
+        with file.open("rb"):
+            image = Image.open(file)
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except (UnidentifiedImageError, OSError):
+        logger.warning("无法识别的图片 %s", file.name)
+        return False
+
+    if box:
+        image = crop_box(image, box)
+    if square:
+        size = min(image.width, image.height)
+        image = ImageOps.fit(image, (size, size))
+    image = image.convert("RGB")
+
+    storage = file.storage
+    for width in THUMBNAIL_WIDTHS:
+        thumbnail = image
+        # 不放大比缩略图还小的图片
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            thumbnail = image.resize((width, height), Image.Resampling.LANCZOS)
+        for format in ThumbnailFormat:
+            buffer = BytesIO()
+            thumbnail.save(buffer, format.name, quality=THUMBNAIL_QUALITY)
+            name = thumbnail_name(file.name, width, format)
+            # 覆盖之前生成的缩略图，不然部分存储会自动重命名
+            if storage.exists(name):
+                storage.delete(name)
+            storage.save(name, ContentFile(buffer.getvalue()))
+    return True
+
+
+def delete_thumbnails(storage: Storage, name: str) -> None:
+    """删除原图 name 对应的所有缩略图"""
+    for width in THUMBNAIL_WIDTHS:
+        for format in ThumbnailFormat:
+            thumbnail = thumbnail_name(name, width, format)
+            if storage.exists(thumbnail):
+                storage.delete(thumbnail)
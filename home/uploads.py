@@ -0,0 +1,90 @@
+"""文件直传
+
+使用 S3 存储时，为客户端生成预签名的上传表单，图片直接上传到 S3，
+不再经过应用服务器中转，工作进程既不需要缓存整个文件，也不会被上传过程阻塞。
+上传完成后，客户端再将对象的 key 传给对应的接口。
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import strawberry
+from django.core.exceptions import ValidationError
+from django.db.models import Model
+from django.utils import timezone
+from storages.backends.s3 import S3Storage
+from strawberry.scalars import JSON
+
+# 上传地址的有效期
+UPLOAD_EXPIRES = timedelta(minutes=10)
+# 允许上传的最大文件大小
+MAX_UPLOAD_SIZE = 20 * 1024 * 1024
+# 允许直传的图片后缀名
+ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "webp", "bmp", "heic", "heif"}
+
+
+@strawberry.type
+class UploadSlot:
+    """预签名的上传表单
+
+    客户端需要将 fields 中的所有字段与文件一起，以 multipart/form-data 格式 POST 到 url
+    """
+
+    key: str
+    """ 上传完成后提交给对应接口的文件名 """
+    url: str
+    fields: JSON
+    expires_at: datetime
+
+
+def create_upload_slot(instance: Model, field_name: str, filename: str, content_type: str) -> UploadSlot:
+    """为模型的文件字段生成直传表单
+
+    文件名由字段的 upload_to 生成，客户端提供的文件名只用来取后缀名
+    """
+    ext = os.path.splitext(filename)[1].lstrip(".").lower()
+    if ext not in ALLOWED_EXTENSIONS:
+        raise ValidationError("只能上传图片")
+    field = instance._meta.get_field(field_name)
+    storage = field.storage  # type: ignore
+    if not isinstance(storage, S3Storage):
+        raise ValidationError("当前存储不支持直传")
+    if not content_type.startswith("image/"):
+        raise ValidationError("只能上传图片")
+
+    name = field.generate_filename(instance, f"upload.{ext}")  # type: ignore
+    post = storage.bucket.meta.client.generate_presigned_post(
+        storage.bucket_name,
+        storage._normalize_name(name),
+        Fields={"Content-Type": content_type},
+        Conditions=[
+            {"Content-Type": content_type},
+            ["content-length-range", 1, MAX_UPLOAD_SIZE],
+        ],
+        ExpiresIn=int(UPLOAD_EXPIRES.total_seconds()),
+    )
+    return UploadSlot(
+        key=name,
+        url=post["url"],
+        fields=post["fields"],
+        expires_at=timezone.now() + UPLOAD_EXPIRES,
+    )
+
+
+def check_uploaded(instance: Model, field_name: str, key: str, prefix: str) -> str:
+    """检查直传的文件是否属于指定目录、已经上传完成，且没有被其他记录使用
+
+    django_cleanup 会在记录删除或更换文件后删除旧文件，
+    如果同一个文件被两条记录引用，其中一条的修改会删掉另一条正在使用的文件
+    """
+    if not key.startswith(prefix) or ".." in key:
+        raise ValidationError("无效的文件")
+    storage = instance._meta.get_field(field_name).storage  # type: ignore
+    if not storage.exists(key):
+        raise ValidationError("文件还未上传完成")
+    others = type(instance)._default_manager.filter(**{field_name: key})
+    if instance.pk is not None:
+        others = others.exclude(pk=instance.pk)
+    if others.exists():
+        raise ValidationError("文件已被使用")
+    return key
@@ -19,7 +19,7 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 from django.views.decorators.csrf import csrf_exempt
-from strawberry.django.views import GraphQLView
+from strawberry.django.views import AsyncGraphQLView
 
 from home.schema import schema
 
@@ -28,7 +28,7 @@ urlpatterns = [
     path("api/xiaoai/", include("home.xiaoai.urls")),
     path(
         "graphql/",
-        csrf_exempt(GraphQLView.as_view(schema=schema, multipart_uploads_enabled=True)),
+        csrf_exempt(AsyncGraphQLView.as_view(schema=schema, multipart_uploads_enabled=True)),
     ),
     path("oidc/", include("mozilla_django_oidc.urls")),
     *static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT),
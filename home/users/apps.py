@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     name = "home.users"
     verbose_name = "用户"
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -1,4 +1,5 @@
 import os
+import uuid
 
 from django.conf import settings
 from django.contrib.sessions.backends.db import SessionStore as DBStore
@@ -61,10 +62,10 @@ class Session(AbstractBaseSession):
 def get_file_path(instance, filename):
     """存放在专门的头像目录中
 
-    用户 ID + 后缀名命名
+    用户 ID + UUID4 命名，直传时不会覆盖正在使用的头像
     """
     ext = filename.split(".")[-1]
-    return os.path.join("avatar_pictures", f"{instance.user.id}.{ext}")
+    return os.path.join("avatar_pictures", f"{instance.user.id}-{uuid.uuid4()}.{ext}")
 
 
 class Avatar(models.Model):
@@ -83,6 +84,8 @@ class Avatar(models.Model):
         "添加时间",
         auto_now_add=True,
     )
+    # 生成缩略图时的头像名称，与当前头像不同时说明缩略图还未生成
+    thumbnail_source = models.CharField("缩略图来源", max_length=100, blank=True, editable=False)
 
     class Meta:
         verbose_name = "头像"
@@ -6,6 +6,7 @@ from strawberry import relay
 from strawberry.file_uploads import Upload
 from strawberry.types import Info
 
+from home.uploads import UploadSlot, check_uploaded, create_upload_slot
 from home.utils import IsAuthenticated
 
 from . import models, types
@@ -67,17 +68,33 @@ class Mutation:
             raise ValidationError("key not found")
 
     @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
-    def update_avatar(self, info: Info, file: Upload) -> types.Avatar:
+    def create_avatar_upload_slot(self, info: Info, filename: str, content_type: str) -> UploadSlot:
+        """获取直传头像的上传地址
+
+        上传完成后，将返回的 key 作为 updateAvatar 的 uploadKey
+        """
+        user = info.context.request.user
+        return create_upload_slot(models.Avatar(user=user), "avatar", filename, content_type)
+
+    @strawberry_django.input_mutation(permission_classes=[IsAuthenticated])
+    def update_avatar(self, info: Info, file: Upload | None, upload_key: str | None) -> types.Avatar:
+        """更新头像
+
+        通过 file 上传，或者提供直传完成的 uploadKey
+        """
         user = info.context.request.user
 
         if hasattr(user, "avatar"):
             avatar = user.avatar
+        else:
+            avatar = models.Avatar(user=user)
+
+        if upload_key:
+            avatar.avatar = check_uploaded(avatar, "avatar", upload_key, f"avatar_pictures/{user.id}-")
+        elif file:
             avatar.avatar = file
         else:
-            avatar = models.Avatar(
-                user=user,
-                avatar=file,
-            )
+            raise ValidationError("请上传头像")
 
         avatar.save()
 
@@ -0,0 +1,24 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django_cleanup.signals import cleanup_post_delete
+
+from home.thumbnails import delete_thumbnails
+
+from .models import Avatar
+from .tasks import generate_avatar_thumbnails
+
+
+@receiver(post_save, sender=Avatar)
+def avatar_saved(sender, instance: Avatar, raw: bool, **kwargs):
+    """头像变化后重新生成缩略图"""
+    if raw:
+        return
+    transaction.on_commit(lambda: generate_avatar_thumbnails.delay(instance.pk))  # type: ignore
+
+
+@receiver(cleanup_post_delete, sender=Avatar)
+def avatar_file_deleted(sender, file, file_name: str, success: bool, **kwargs):
+    """原头像被 django_cleanup 删除时，一并删除缩略图"""
+    if success:
+        delete_thumbnails(file.storage, file_name)
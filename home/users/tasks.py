@@ -1,8 +1,27 @@
 from celery import shared_task
 from django.core import management
 
+from home.thumbnails import generate_thumbnails
+
+from .models import Avatar
+
 
 @shared_task
 def clear_sessions():
     """清除过期的会话"""
     management.call_command("clearsessions")
+
+
+@shared_task
+def generate_avatar_thumbnails(avatar_id: int):
+    """生成头像的缩略图
+
+    头像会从中心裁剪为正方形
+    """
+    avatar = Avatar.objects.filter(pk=avatar_id).first()
+    if avatar is None:
+        return
+
+    name = avatar.avatar.name
+    if generate_thumbnails(avatar.avatar, square=True):
+        Avatar.objects.filter(pk=avatar_id, avatar=name).update(thumbnail_source=name)
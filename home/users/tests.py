@@ -1,6 +1,13 @@
+from io import BytesIO
+from unittest import mock
+
 from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test.testcases import TestCase
+from PIL import Image
+from storages.backends.s3 import S3Storage
 from strawberry import relay
 
 from home.tests import GraphQLTestCase
@@ -8,7 +15,7 @@ from home.utils import MyOIDCAB
 
 from . import types
 from .models import Avatar, Config, Session
-from .tasks import clear_sessions
+from .tasks import clear_sessions, generate_avatar_thumbnails
 
 
 class ModelTests(TestCase):
@@ -392,6 +399,119 @@ class UserAvatarTests(GraphQLTestCase):
         avatar = content.data["updateAvatar"]["avatar"]["url"]
         self.assertTrue(avatar.startswith("/avatar_pictures/1"))
 
+    def test_create_avatar_upload_slot(self):
+        """获取直传头像的地址"""
+        self.client.authenticate(self.user)
+
+        mutation = """
+            mutation createAvatarUploadSlot($input: CreateAvatarUploadSlotInput!) {
+                createAvatarUploadSlot(input: $input) {
+                    ... on UploadSlot {
+                        key
+                        fields
+                    }
+                    ... on OperationInfo {
+                        messages {
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {
+            "input": {
+                "filename": "test.JPG",
+                "contentType": "image/jpeg",
+            }
+        }
+
+        s3 = S3Storage(
+            bucket_name="bucket",
+            access_key="key",
+            secret_key="secret",
+            endpoint_url="http://127.0.0.1:9000",
+            region_name="us-east-1",
+        )
+        with mock.patch.object(Avatar._meta.get_field("avatar"), "storage", s3):
+            content = self.client.execute(mutation, variables)
+
+            slot = content.data["createAvatarUploadSlot"]
+            self.assertTrue(slot["key"].startswith("avatar_pictures/1-"))
+            self.assertTrue(slot["key"].endswith(".jpg"))
+            self.assertEqual(slot["fields"]["key"], slot["key"])
+
+            # 只允许图片的后缀名
+            variables["input"]["filename"] = "test.svg"
+            content = self.client.execute(mutation, variables)
+            self.assertEqual(content.data["createAvatarUploadSlot"]["messages"][0]["message"], "只能上传图片")
+
+    def test_update_avatar_upload_key(self):
+        """通过直传的文件更新头像"""
+        mutation = """
+            mutation updateAvatar($input: UpdateAvatarInput!) {
+                updateAvatar(input: $input) {
+                    ... on Avatar {
+                        avatar {
+                            url
+                        }
+                    }
+                    ... on OperationInfo {
+                        messages {
+                            message
+                        }
+                    }
+                }
+            }
+        """
+        variables = {"input": {"uploadKey": "avatar_pictures/2-uploaded.jpg"}}
+
+        # 不能使用其他用户的文件
+        self.client.authenticate(self.user)
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["updateAvatar"]["messages"][0]["message"], "无效的文件")
+
+        self.client.authenticate(self.user_without_avatar)
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["updateAvatar"]["messages"][0]["message"], "文件还未上传完成")
+
+        default_storage.save("avatar_pictures/2-uploaded.jpg", ContentFile(b"file_text"))
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["updateAvatar"]["avatar"]["url"], "/avatar_pictures/2-uploaded.jpg")
+
+        # 重复提交当前的头像不受影响
+        content = self.client.execute(mutation, variables)
+        self.assertEqual(content.data["updateAvatar"]["avatar"]["url"], "/avatar_pictures/2-uploaded.jpg")
+
+    def test_avatar_thumbnail(self):
+        self.client.authenticate(self.user_without_avatar)
+
+        buffer = BytesIO()
+        Image.new("RGB", (600, 400), "blue").save(buffer, "PNG")
+        avatar = Avatar(
+            user=self.user_without_avatar, avatar=SimpleUploadedFile(name="a.png", content=buffer.getvalue())
+        )
+        avatar.save()
+        generate_avatar_thumbnails(avatar.pk)
+
+        query = """
+            query viewer {
+                viewer {
+                    avatarThumbnailUrl(width: 100)
+                    avatar {
+                        thumbnailUrl(width: 300, format: JPEG)
+                    }
+                }
+            }
+        """
+        content = self.client.execute(query)
+
+        root = avatar.avatar.name.rsplit(".", 1)[0]
+        self.assertEqual(content.data["viewer"]["avatarThumbnailUrl"], f"/{root}.128w.webp")
+        self.assertEqual(content.data["viewer"]["avatar"]["thumbnailUrl"], f"/{root}.512w.jpeg")
+        # 头像会裁剪为正方形，且不会放大
+        with avatar.avatar.storage.open(f"{root}.512w.jpeg") as f:
+            self.assertEqual(Image.open(f).size, (400, 400))
+
 
 class SessionTests(GraphQLTestCase):
     fixtures = ["users"]
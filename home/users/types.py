@@ -5,6 +5,9 @@ from django.utils import timezone
 from strawberry import relay
 from strawberry.types import Info
 
+from home.thumbnails import ThumbnailFormat, thumbnail_url
+from home.utils import loaded_resolver
+
 from . import models
 
 
@@ -21,11 +24,13 @@ class Session(relay.Node):
     last_activity: strawberry.auto
     ip: strawberry.auto
 
-    @strawberry.field
+    @strawberry_django.field(only=["expire_date"])
+    @loaded_resolver("expire_date")
     def is_valid(self) -> bool:
         return self.expire_date > timezone.now()
 
-    @strawberry.field
+    @strawberry_django.field(only=["session_key"])
+    @loaded_resolver("session_key")
     def is_current(self, info: Info) -> bool:
         return info.context.request.session.session_key == self.session_key  # type: ignore
 
@@ -43,6 +48,12 @@ class Avatar(relay.Node):
     avatar: strawberry.auto
     created_at: strawberry.auto
 
+    @strawberry_django.field(only=["avatar", "thumbnail_source"])
+    @loaded_resolver("avatar", "thumbnail_source")
+    def thumbnail_url(self, width: int, format: ThumbnailFormat = ThumbnailFormat.WEBP) -> str:
+        """缩略图未生成时返回原图"""
+        return thumbnail_url(self.avatar, self.thumbnail_source, width, format)  # type: ignore
+
 
 @strawberry_django.type(get_user_model())
 class User(relay.Node):
@@ -53,9 +64,16 @@ class User(relay.Node):
     session: list[Session]
     avatar: Avatar
 
-    @strawberry_django.field(select_related=["avatar"])
+    @strawberry_django.field(select_related=["avatar"], only=["avatar__avatar"])
+    @loaded_resolver("avatar__avatar")
     def avatar_url(self) -> str | None:
         if hasattr(self, "avatar"):
             return self.avatar.avatar.url  # type: ignore
 
+    @strawberry_django.field(select_related=["avatar"], only=["avatar__avatar", "avatar__thumbnail_source"])
+    @loaded_resolver("avatar__avatar", "avatar__thumbnail_source")
+    def avatar_thumbnail_url(self, width: int, format: ThumbnailFormat = ThumbnailFormat.WEBP) -> str | None:
+        if hasattr(self, "avatar"):
+            return thumbnail_url(self.avatar.avatar, self.avatar.thumbnail_source, width, format)  # type: ignore
+
     configs: list[Config]
@@ -1,9 +1,21 @@
+import functools
+import logging
+from collections.abc import Callable
 from typing import Any
 
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.core.cache import BaseCache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models, transaction
 from mozilla_django_oidc.auth import OIDCAuthenticationBackend
 from strawberry.permission import BasePermission
 from strawberry.types import Info
 
+logger = logging.getLogger(__name__)
+
 
 class IsAuthenticated(BasePermission):
     """验证是否登录
@@ -14,19 +26,112 @@ class IsAuthenticated(BasePermission):
 
     message = "User is not authenticated"
 
-    # This method can also be async!
-    def has_permission(self, source: Any, info: Info, **kwargs) -> bool:
-        if isinstance(info.context, dict):
-            # NOTE: WebSocket 暂时没有使用了，所以跳过覆盖率测试
-            user = info.context["request"].scope["user"]  # pragma: no cover
-        else:
-            user = info.context.request.user
+    async def has_permission(self, source: Any, info: Info, **kwargs) -> bool:
+        user = await aget_user(info.context)
         return user.is_authenticated and user.is_active
 
 
-# def channel_group_send(group: str, message: dict) -> None:
-#     channel_layer = get_channel_layer()
-#     async_to_sync(channel_layer.group_send)(group, message)  # type: ignore
+async def aget_user(context: Any):
+    """获取当前用户
+
+    支持 websocket 和 http 两种上下文
+    """
+    if isinstance(context, dict):
+        # WebSocket 的用户由 AuthMiddlewareStack 提前加载
+        return context["request"].scope["user"]
+    # 异步视图中不能直接访问 request.user，不然会在事件循环中查询数据库
+    user = await context.request.auser()
+    # 之后的同步代码可以直接使用 request.user，不用再次查询
+    context.request.user = user
+    return user
+
+
+def get_user(context: Any):
+    """获取当前用户，同步代码中使用
+
+    支持 websocket 和 http 两种上下文，http 请求的用户应已经由 IsAuthenticated 加载
+    """
+    if isinstance(context, dict):
+        return context["request"].scope["user"]
+    return context.request.user
+
+
+def is_loaded(instance: models.Model, *fields: str) -> bool:
+    """读取这些字段是否不需要查询数据库
+
+    关联对象的字段用 __ 连接，如 storage__name，关联对象为空时视为已加载；
+    不是模型字段的名称（如 cached_property）检查是否已经缓存在实例中
+    """
+    for path in fields:
+        obj: Any = instance
+        *relations, name = path.split("__")
+        for relation in relations:
+            field = obj._meta.get_field(relation)
+            if not field.is_cached(obj):
+                return False
+            obj = field.get_cached_value(obj)
+            if obj is None:
+                break
+        else:
+            try:
+                name = obj._meta.get_field(name).attname
+            except FieldDoesNotExist:
+                pass
+            if name not in obj.__dict__:
+                return False
+    return True
+
+
+def loaded_resolver(*fields: str):
+    """需要的字段都已加载时直接在事件循环中执行同步的解析器，否则在线程中执行
+
+    异步视图中 strawberry_django 会把每个同步解析器放到线程中执行，
+    列表中的每一行都要切换一次线程。fields 通常与字段的 only 相同
+    """
+
+    def decorator[**P, R](func: Callable[P, R]) -> Callable[P, Any]:
+        @functools.wraps(func)
+        async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            if is_loaded(args[0], *fields):  # type: ignore
+                return func(*args, **kwargs)
+            return await sync_to_async(func)(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def is_shared_cache(backend: BaseCache | None = None) -> bool:
+    """缓存是否由多个进程共享，默认检查默认缓存
+
+    进程内缓存只在当前进程有效，DummyCache 不保存任何内容
+    """
+    if backend is None:
+        backend = caches["default"]
+    return not isinstance(backend, LocMemCache | DummyCache)
+
+
+async def _group_send(group: str, message: dict) -> None:
+    channel_layer = get_channel_layer()
+    if channel_layer is None:  # pragma: no cover
+        return
+    try:
+        await channel_layer.group_send(group, message)
+    except Exception:
+        # 通知失败不影响已经提交的修改
+        logger.exception("通道层消息发送失败 %s", group)
+
+
+def channel_group_send(group: str, message: dict) -> None:
+    """向通道层的组发送消息，用于推送订阅更新
+
+    在事务提交后发送，避免订阅者查询到未提交或者被回滚的数据
+    """
+    transaction.on_commit(lambda: async_to_sync(_group_send)(group, message))
+
+
+async def achannel_group_send(group: str, message: dict) -> None:
+    await sync_to_async(channel_group_send)(group, message)
 
 
 # def strtobool(val):
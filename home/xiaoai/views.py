@@ -8,7 +8,7 @@ from django.conf import settings
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 
-from home.storage.models import Item
+from home.storage.search import search_items
 
 # Get an instance of a logger
 logger = logging.getLogger("xiaoai")
@@ -64,7 +64,7 @@ def process_request(data: dict) -> dict:
 
 def find_item(name: str) -> str:
     """查找物品"""
-    items = Item.objects.filter(name__icontains=name)
+    items = search_items(name, name_only=True).select_related("storage")
     item_count = len(items)
 
     if item_count > 0: